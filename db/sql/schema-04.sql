@@ -0,0 +1,16 @@
+--liquibase formatted sql
+
+--changeset oppleo:004
+
+-- Time-of-use tariffs
+--      A row gives the tariff (€/kWh) for the off peak windows (off_peak_hours) or for the other hours, from
+--      valid_from on. The row with the latest valid_from before a moment applies. A NULL valid_from applies from the
+--      beginning of time. Without rows every session is priced at its flat tariff (charge_session.tariff).
+
+CREATE TABLE tariff_schedule (
+   id serial PRIMARY KEY,
+   off_peak BOOLEAN NOT NULL,
+   tariff DOUBLE PRECISION NOT NULL,
+   valid_from TIMESTAMP,
+   description VARCHAR(100)
+);
@@ -0,0 +1,148 @@
+print("Oppleo payload serializer benchmark")
+
+import argparse
+import gc
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel, measurePayloads
+from nl.oppleo.utils import PayloadSerializer
+
+"""
+ Compares serializing measurements the way Oppleo did before utils/PayloadSerializer.py (to_str() per consumer, every
+ value through str() and strftime, every consumer encoding its own json) with the shared payload (built once, the
+ timestamp from a cached date part, the json encoded once for the websocket, MQTT and HTTP consumers).
+ The measurements are built in memory, the database is not touched.
+
+    python benchmark_serializer.py
+    python benchmark_serializer.py --measurements 20000 --http 100 --repeat 21
+"""
+
+FIELDS = [ 'energy_device_id', 'created_at', 'kwh_l1', 'kwh_l2', 'kwh_l3', 'a_l1', 'a_l2', 'a_l3',
+           'p_l1', 'p_l2', 'p_l3', 'v_l1', 'v_l2', 'v_l3', 'kw_total', 'hz' ]
+HA_NAMES = [ 'EnergyDeviceID', 'Timestamp', 'E1', 'E2', 'E3', 'A1', 'A2', 'A3', 'P1', 'P2', 'P3', 'V1', 'V2', 'V3',
+             'TotalEnergy', 'Frequency' ]
+FACTOR_WHKM = 200
+
+
+def measurements(n:int) -> list:
+    start = datetime.now() - timedelta(seconds=10 * n)
+    result = []
+    for i in range(n):
+        m = EnergyDeviceMeasureModel()
+        m.set({ 'energy_device_id': 'benchmark', 'created_at': start + timedelta(seconds=10 * i),
+                'kwh_l1': 0.0, 'kwh_l2': 0.0, 'kwh_l3': 0.0, 'kw_total': 12345.6 + i / 100,
+                'a_l1': round(random.uniform(0, 16), 1), 'a_l2': round(random.uniform(0, 16), 1), 'a_l3': round(random.uniform(0, 16), 1),
+                'p_l1': round(random.uniform(0, 3.7), 3), 'p_l2': round(random.uniform(0, 3.7), 3), 'p_l3': round(random.uniform(0, 3.7), 3),
+                'v_l1': round(random.uniform(225, 235), 1), 'v_l2': round(random.uniform(225, 235), 1), 'v_l3': round(random.uniform(225, 235), 1),
+                'hz': round(random.uniform(49.9, 50.1), 2) })
+        m.id = i + 1
+        result.append(m)
+    return result
+
+
+def loaded(page:list) -> list:
+    # As loaded from the database by the route, new instances without a payload
+    result = []
+    for m in page:
+        copy = EnergyDeviceMeasureModel()
+        copy.set({ key: getattr(m, key) for key in FIELDS })
+        copy.id = m.id
+        result.append(copy)
+    return result
+
+
+def legacy_to_str(m) -> dict:
+    # EnergyDeviceMeasureModel.to_str() before the PayloadSerializer
+    return { key: str(getattr(m, key).strftime("%d/%m/%Y, %H:%M:%S")) if key == 'created_at' else str(getattr(m, key))
+                for key in FIELDS }
+
+
+def legacy_event(m) -> int:
+    # EnergyDevice (debug log line and event), websocket packet, MQTT message, Home Assistant energyUpdate
+    size = 0
+    f'{legacy_to_str(m)}'
+    data = legacy_to_str(m)
+    size += len(json.dumps([ 'status_update', { 'data': data, 'namespace': '/usage', 'public': True } ], separators=(',', ':')))
+    size += len(json.dumps({ 'data': data }, default=str))
+    ha = { name: data[key] for key, name in zip(FIELDS, HA_NAMES) }
+    ha['ChargeSpeed'] = str(round((float(data['p_l1']) + float(data['p_l2']) + float(data['p_l3'])) / FACTOR_WHKM, 1))
+    return size
+
+
+def payload_event(m) -> int:
+    # The debug log line only formats the payload when debug logging is on
+    size = 0
+    data = m.to_str()
+    size += len(PayloadSerializer.dumps([ 'status_update', { 'data': data, 'namespace': '/usage', 'public': True } ], separators=(',', ':')))
+    size += len(PayloadSerializer.dumps({ 'data': data }, default=str, separators=PayloadSerializer.SEPARATORS))
+    ha = { name: data[key] for key, name in zip(FIELDS, HA_NAMES) }
+    ha['ChargeSpeed'] = str(round((data.values['p_l1'] + data.values['p_l2'] + data.values['p_l3']) / FACTOR_WHKM, 1))
+    return size
+
+
+def run(fn, items) -> float:
+    # One pass, without the garbage collector walking the measurements held by the benchmark. Seconds per item.
+    batch = items() if callable(items) else items
+    gc.collect()
+    gc.disable()
+    start = time.perf_counter()
+    for item in batch:
+        fn(item)
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    return elapsed / len(batch)
+
+
+def compare(legacyLabel:str, legacy, newLabel:str, new, items, repeat:int) -> None:
+    # Legacy and new alternately, a busy moment of the machine slows both. The median of the passes and their range,
+    # one pass is not enough to tell the two apart.
+    legacyTimes, newTimes = [], []
+    for r in range(repeat):
+        legacyTimes.append(run(legacy, items))
+        newTimes.append(run(new, items))
+    for label, times in ((legacyLabel, legacyTimes), (newLabel, newTimes)):
+        print('  {:45s} {:8.2f}us per item, median of {} ({:.2f} - {:.2f}us)'.format(
+                label, statistics.median(times) * 1e6, repeat, min(times) * 1e6, max(times) * 1e6))
+    ratios = [ legacyTime / newTime for legacyTime, newTime in zip(legacyTimes, newTimes) ]
+    print('  {:.1f}x median ({:.1f}x - {:.1f}x per pass)'.format(
+            statistics.median(legacyTimes) / statistics.median(newTimes), min(ratios), max(ratios)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Oppleo payload serializer benchmark')
+    parser.add_argument('--measurements', type=int, default=10000, help='Number of measurements')
+    parser.add_argument('--http', type=int, default=100, help='Number of measurements per /usage_data response')
+    parser.add_argument('--requests', type=int, default=200, help='Number of /usage_data responses')
+    parser.add_argument('--repeat', type=int, default=11, help='Number of passes of every case')
+    args = parser.parse_args()
+
+    items = measurements(args.measurements)
+    timestamps = [ m.created_at for m in items ]
+
+    print('Timestamp formatting')
+    compare('strftime', lambda ts: str(ts.strftime("%d/%m/%Y, %H:%M:%S")),
+            'PayloadSerializer.timestamp_str', PayloadSerializer.timestamp_str, timestamps, args.repeat)
+
+    print('Measurement event (websocket, MQTT and Home Assistant)')
+    compare('to_str() per consumer', legacy_event,
+            'shared payload', payload_event, lambda: measurements(args.measurements), args.repeat)
+    assert json.loads(items[0].to_json()) == legacy_to_str(items[0]), 'Payload differs from the legacy format'
+
+    print('HTTP /usage_data/{}'.format(args.http))
+    for m in items[-args.http:]:
+        # Measured and published before the request
+        m.payload()
+    pages = lambda: [ loaded(items[-args.http:]) for i in range(args.requests) ]
+    compare('to_dict() and json.dumps', lambda page: json.dumps([ legacy_to_str(m) for m in page ]),
+            'cached payloads and PayloadSerializer.dumps',
+            lambda page: PayloadSerializer.dumps([ m.to_dict() for m in page ], separators=PayloadSerializer.SEPARATORS),
+            pages, args.repeat)
+    print('Payload cache {}'.format(measurePayloads.diag()))
+
+
+if __name__ == '__main__':
+    main()
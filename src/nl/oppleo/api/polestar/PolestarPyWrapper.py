@@ -9,7 +9,7 @@ from pypolestar import PolestarApi
 from pypolestar.auth import PolestarAuth
 
 from nl.oppleo.models.RfidModel import RfidModel
-from nl.oppleo.models.KeyValueStoreModel import KeyValueStoreModel
+from nl.oppleo.services.KeyValueStoreCache import KeyValueStoreCache
 
 
 class PolestarPyWrapper:
@@ -31,41 +31,18 @@ class PolestarPyWrapper:
             self.__logger.error('__pypolestar_loader - No rfid id to use as scope to obtain cache with!')
             # return empty cache
             return {}
-        kvstore = KeyValueStoreModel.get_scope(kvstore=self.__KVSTORE, scope=self.__rfid)
-        cache = {}
-        for kvobj in kvstore:
-            cache[kvobj.key] = kvobj.value
-        return cache
+        # Read-through, only the first access queries the database
+        return KeyValueStoreCache().get_scope(kvstore=self.__KVSTORE, scope=self.__rfid)
 
 
     def __pypolestar_dumper(self, cache):
         if self.__rfid is None:
             self.__logger.error('__pypolestar_dumper - No rfid id as scope object to write cache with!')
+            return
 
-        stored_cache = self.__pypolestar_loader()
-        # Generate diff
-        to_delete = list(set(stored_cache) - set(cache))
-        to_add = list(set(cache) - set(stored_cache))
-        to_update = list(set(cache) & set(stored_cache))
-
-        # Run through to-delete keys
-        for email in to_delete:
-            self.__logger.info('__pypolestar_dumper - delete kvstore={} scope={} email={}'.format(self.__KVSTORE, self.__rfid, email))
-            kvs = KeyValueStoreModel.get_value(kvstore=self.__KVSTORE, scope=self.__rfid, key=email)
-            kvs.delete()
-
-        # Run through to-add keys
-        for email in to_add:
-            self.__logger.info('__pypolestar_dumper - add kvstore={} scope={} email={}'.format(self.__KVSTORE, self.__rfid, email))
-            kvs = KeyValueStoreModel(kvstore=self.__KVSTORE, scope=self.__rfid, key=email, value=cache[email])
-            kvs.save()
-
-        # Run through to-update keys
-        for email in to_update:
-            self.__logger.info('__pypolestar_dumper - update kvstore={} scope={} email={}'.format(self.__KVSTORE, self.__rfid, email))
-            kvs = KeyValueStoreModel.get_value(kvstore=self.__KVSTORE, scope=self.__rfid, key=email)
-            kvs.value=cache[email]
-            kvs.save()
+        # One transaction (upsert and delete), skipped when the cache did not change
+        self.__logger.debug('__pypolestar_dumper - store kvstore={} scope={} keys={}'.format(self.__KVSTORE, self.__rfid, list(cache.keys())))
+        KeyValueStoreCache().put_scope(kvstore=self.__KVSTORE, scope=self.__rfid, values=cache)
 
     def __pypolestar_update_cache_entry(self, username:str=None, polestarAuth:PolestarAuth=None):
         # Update the cache entry with new tokens
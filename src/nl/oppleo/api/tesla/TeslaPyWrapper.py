@@ -7,7 +7,7 @@ from oauthlib.oauth2.rfc6749.errors import UnauthorizedClientError, MissingCodeE
 from nl.oppleo.config.OppleoSystemConfig import oppleoSystemConfig
 from nl.oppleo.services.PushMessage import pushMessage
 
-from nl.oppleo.models.KeyValueStoreModel import KeyValueStoreModel
+from nl.oppleo.services.KeyValueStoreCache import KeyValueStoreCache
 
 """
     https://github.com/tdorssers/TeslaPy
@@ -50,40 +50,17 @@ class TeslaPyWrapper:
             self.__logger.error('__teslapy_loader - No rfid id to use as scope to obtain cache with!')
             # return empty cache
             return {}
-        kvstore = KeyValueStoreModel.get_scope(kvstore=self.__KVSTORE, scope=self.__rfid)
-        cache = {}
-        for kvobj in kvstore:
-            cache[kvobj.key] = kvobj.value
-        return cache
+        # Read-through, only the first access queries the database
+        return KeyValueStoreCache().get_scope(kvstore=self.__KVSTORE, scope=self.__rfid)
 
     def __teslapy_dumper(self, cache):
         if self.__rfid is None:
             self.__logger.error('__teslapy_loader - No rfid id as scope object to write cache with!')
+            return
 
-        stored_cache = self.__teslapy_loader()
-        # Generate diff
-        to_delete = list(set(stored_cache) - set(cache))
-        to_add = list(set(cache) - set(stored_cache))
-        to_update = list(set(cache) & set(stored_cache))
-
-        # Run through to-delete keys
-        for email in to_delete:
-            self.__logger.info('__teslapy_dumper - delete kvstore={} scope={} email={}'.format(self.__KVSTORE, self.__rfid, email))
-            kvs = KeyValueStoreModel.get_value(kvstore=self.__KVSTORE, scope=self.__rfid, key=email)
-            kvs.delete()
-
-        # Run through to-add keys
-        for email in to_add:
-            self.__logger.info('__teslapy_dumper - add kvstore={} scope={} email={}'.format(self.__KVSTORE, self.__rfid, email))
-            kvs = KeyValueStoreModel(kvstore=self.__KVSTORE, scope=self.__rfid, key=email, value=cache[email])
-            kvs.save()
-
-        # Run through to-update keys
-        for email in to_update:
-            self.__logger.info('__teslapy_dumper - update kvstore={} scope={} email={}'.format(self.__KVSTORE, self.__rfid, email))
-            kvs = KeyValueStoreModel.get_value(kvstore=self.__KVSTORE, scope=self.__rfid, key=email)
-            kvs.value=cache[email]
-            kvs.save()
+        # One transaction (upsert and delete), skipped when the cache did not change
+        self.__logger.debug('__teslapy_dumper - store kvstore={} scope={} keys={}'.format(self.__KVSTORE, self.__rfid, list(cache.keys())))
+        KeyValueStoreCache().put_scope(kvstore=self.__KVSTORE, scope=self.__rfid, values=cache)
 
 
     def authorizeByRefreshToken(self, email:str=None, refresh_token:str=None, rfid:str=None) -> bool:
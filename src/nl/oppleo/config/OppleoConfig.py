@@ -4,6 +4,7 @@ import logging
 from datetime import datetime
 import os
 import re
+import threading
 
 import json
 from json import JSONDecodeError
@@ -11,6 +12,7 @@ from json import JSONDecodeError
 from nl.oppleo.models.ChargerConfigModel import ChargerConfigModel
 from nl.oppleo.models.EnergyDeviceModel import EnergyDeviceModel
 from nl.oppleo.models.ChargeSessionModel import ChargeSessionModel
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
 from nl.oppleo.config import Logger
 from nl.oppleo.utils.IPv4 import IPv4
 
@@ -124,11 +126,69 @@ class OppleoConfig(object, metaclass=Singleton):
     __upSinceDatetime = datetime.now()
     __softwareUpdateInProgress = False
 
-
     """
-        Global location to store all connected clients keyed by request.sid (websocket room)
+        Settings supported by update() (bulk): property name --> (charger_config column, allowed values, restart required)
+        Not included are settings with side effects beyond the column (chargerID, routerIPAddress) and internal values.
+    """
+    __bulkSettings = {
+        'chargerNameText'                   : ('charger_name_text', None, False),
+        'chargerTariff'                     : ('charger_tariff', None, False),
+        'useReloader'                       : ('use_reloader', None, True),
+        'factorWhkm'                        : ('factor_whkm', None, False),
+        'modbusInterval'                    : ('modbus_interval', range(1, 61), True),
+        'autoSessionEnabled'                : ('autosession_enabled', None, False),
+        'autoSessionMinutes'                : ('autosession_minutes', None, False),
+        'autoSessionEnergy'                 : ('autosession_energy', None, False),
+        'autoSessionCondenseSameOdometer'   : ('autosession_condense_same_odometer', None, False),
+        'pulseLedMin'                       : ('pulseled_min', None, True),
+        'pulseLedMax'                       : ('pulseled_max', None, True),
+        'gpioMode'                          : ('gpio_mode', ['BCM', 'BOARD'], True),
+        'pinLedRed'                         : ('pin_led_red', None, True),
+        'pinLedGreen'                       : ('pin_led_green', None, True),
+        'pinLedBlue'                        : ('pin_led_blue', None, True),
+        'pinBuzzer'                         : ('pin_buzzer', None, True),
+        'pinEvseSwitch'                     : ('pin_evse_switch', None, True),
+        'pinEvseLed'                        : ('pin_evse_led', None, True),
+        'offpeakEnabled'                    : ('peakhours_offpeak_enabled', None, False),
+        'allowPeakOnePeriod'                : ('peakhours_allow_peak_one_period', None, False),
+        'webChargeOnDashboard'              : ('webcharge_on_dashboard', None, False),
+        'wakeupVehicleOnDataRequest'        : ('wakeup_vehicle_on_data_request', None, False),
+        'authWebCharge'                     : ('auth_webcharge', None, False),
+        'restrictDashboardAccess'           : ('restrict_dashboard_access', None, False),
+        'restrictMenu'                      : ('restrict_menu', None, False),
+        'allowLocalDashboardAccess'         : ('allow_local_dashboard_access', None, False),
+        'receiptPrefix'                     : ('receipt_prefix', None, False),
+        'backupEnabled'                     : ('backup_enabled', None, False),
+        'backupInterval'                    : ('backup_interval', None, False),
+        'backupIntervalWeekday'             : ('backup_interval_weekday', None, False),
+        'backupIntervalCalday'              : ('backup_interval_calday', None, False),
+        'backupTimeOfDay'                   : ('backup_time_of_day', None, False),
+        'backupLocalHistory'                : ('backup_local_history', None, False),
+        'osBackupEnabled'                   : ('os_backup_enabled', None, False),
+        'osBackupType'                      : ('os_backup_type', None, False),
+        'osBackupHistory'                   : ('os_backup_history', None, False),
+        'smbBackupServerNameOrIPAddress'    : ('smb_backup_servername_or_ip_address', None, False),
+        'smbBackupUsername'                 : ('smb_backup_username', None, False),
+        'smbBackupPassword'                 : ('smb_backup_password', None, False),
+        'smbBackupServiceName'              : ('smb_backup_service_name', None, False),
+        'smbBackupRemotePath'               : ('smb_backup_remote_path', None, False),
+        'vehicleDataOnDashboard'            : ('vehicle_data_on_dashboard', None, False),
+        'webauthnExpectedOrigin'            : ('webauthn_expected_origin', None, False),
+        'behindSSLProxy'                    : ('behind_ssl_proxy', None, False)
+    }
+
+
+    """
+        Global location to store all connected clients keyed by request.sid (websocket room). The sid is per namespace
+        connection, a browser subscribed to three namespaces has three entries.
+        namespaceClients counts the clients per namespace { namespace: { 'clients': n, 'auth': n } }, so emitters can
+        skip namespaces nobody listens to. Authenticated clients are joined to the AUTH_ROOM of their namespace at
+        connect, private events are emitted to that room.
     """
     connectedClients = {}
+    namespaceClients = {}
+    AUTH_ROOM = 'auth'
+    __clientsLock = threading.Lock()
 
     """
         Application wide global variables or handles which can be picked op from here
@@ -145,6 +205,7 @@ class OppleoConfig(object, metaclass=Singleton):
     vcsmThread = None       # VehicleChargeStatusMonitorThread
     vuThread = None         # VehicleUtilThread (TeslaUtilThread) - background task, a.o. capture odometer
     mqttshThread = None     # MqttSendHistoryThread
+    wsqrbTask = None        # WebSocketQueueReaderBackgroundTask
     
     wsEmitQueue = None
 
@@ -159,6 +220,91 @@ class OppleoConfig(object, metaclass=Singleton):
         self.__logger.debug('Initializing Oppleo...')
         self.__chargerConfigModel = ChargerConfigModel.get_config()
 
+
+    def addConnectedClient(self, sid:str, namespace:str, auth:bool) -> bool:
+        with self.__clientsLock:
+            if sid in self.connectedClients:
+                return False
+            self.connectedClients[sid] = {
+                                'sid'       : sid,
+                                'auth'      : auth,
+                                'stats'     : 'connected',
+                                'namespace' : namespace
+                                }
+            counts = self.namespaceClients.setdefault(namespace, { 'clients': 0, 'auth': 0 })
+            counts['clients'] += 1
+            counts['auth'] += 1 if auth else 0
+            return True
+
+
+    def removeConnectedClient(self, sid:str) -> dict | None:
+        with self.__clientsLock:
+            client = self.connectedClients.pop(sid, None)
+            if client is not None and client['namespace'] in self.namespaceClients:
+                counts = self.namespaceClients[client['namespace']]
+                counts['clients'] -= 1
+                counts['auth'] -= 1 if client['auth'] else 0
+                if counts['clients'] <= 0:
+                    del self.namespaceClients[client['namespace']]
+            return client
+
+
+    """
+        True if an emit to the namespace reaches anyone, for private events an authenticated client, for a room (sid)
+        that client
+    """
+    def hasSubscribers(self, namespace:str, public:bool=False, room:str|None=None) -> bool:
+        if room is not None and room != self.AUTH_ROOM:
+            return room in self.connectedClients
+        counts = self.namespaceClients.get(namespace)
+        if counts is None:
+            return False
+        return counts['clients'] > 0 if public else counts['auth'] > 0
+
+    """
+        Bulk update of settings, keyed by property name (as used by /update_settings). String values are converted
+        to the column type. All values are validated together (KeyError, TypeError, ValueError) before any is changed,
+        saved in one transaction and announced once. Returns the list of changed property names.
+    """
+    def update(self, values:dict) -> list:
+        self.__logger.debug('update() - {}'.format(list(values.keys())))
+        unknown = [ param for param in values.keys() if param not in self.__bulkSettings ]
+        if len(unknown) > 0:
+            raise KeyError("No bulk update for {}".format(', '.join(unknown)))
+        columnValues = {}
+        allowed = {}
+        for param, value in values.items():
+            column, allowedValues, _ = self.__bulkSettings[param]
+            columnValues[column] = ChargerConfigModel.coerceValue(column, value)
+            if allowedValues is not None:
+                allowed[column] = allowedValues
+
+        changedColumns = self.__chargerConfigModel.setAndSaveAll(values=columnValues, allowed=allowed)
+        changed = [ param for param in values.keys() if self.__bulkSettings[param][0] in changedColumns ]
+        if len(changed) == 0:
+            return changed
+
+        if any(self.__bulkSettings[param][2] for param in changed):
+            self.__restartRequired = True
+        # Import here to prevent instantiation when OppleoSystemConfig is instantiated
+        from nl.oppleo.utils.OutboundEvent import OutboundEvent 
+        # Announce once
+        OutboundEvent.triggerEvent(
+                event='update', 
+                id=self.chargerID,
+                data={
+                    "restartRequired"           : self.__restartRequired,
+                    'softwareUpdateInProgress'  : self.__softwareUpdateInProgress,
+                    "upSince"                   : self.upSinceDatetimeStr,
+                    "clientsConnected"          : len(self.connectedClients),
+                    "settingsChanged"           : changed
+                },
+                namespace='/system_status',
+                public=False
+            )
+        return changed
+
+
     """
         chargerID --> charger_id
     """
@@ -176,6 +322,8 @@ class OppleoConfig(object, metaclass=Singleton):
 
         # Migrate all charge sessions to the new ID
         ChargeSessionModel.migrateEnergyDevice(fromEnergyDeviceId=oldChargerId, toEnergyDeviceId=value)
+        # The registered open sessions still carry the old ID
+        OpenChargeSessionRegistry().clear()
 
         # Update config
         self.__chargerConfigModel.setAndSave('charger_id', value)
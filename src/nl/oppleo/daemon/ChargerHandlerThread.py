@@ -27,6 +27,10 @@ from nl.oppleo.services.RfidReader import RfidReader
 from nl.oppleo.utils.UpdateOdometerUtil import UpdateOdometerUtil
 from nl.oppleo.utils.OutboundEvent import OutboundEvent 
 from nl.oppleo.services.HomeAssistantMqttHandlerThread import HomeAssistantMqttHandlerThread
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
+from nl.oppleo.services.RfidCache import RfidCache
+from nl.oppleo.services.WriteSpool import WriteSpool
+from nl.oppleo.services.TimeOfUseTariff import TimeOfUseTariff
 
 oppleoSystemConfig = OppleoSystemConfig()
 oppleoConfig = OppleoConfig()
@@ -122,7 +126,7 @@ class ChargerHandlerThread(object):
     def rfidAuthorized(self, rfid:str) -> bool:
         self.__logger.debug(".rfidAuthorized() - rfid:{}".format(rfid))
 
-        rfidData = RfidModel.get_one(rfid)
+        rfidData = RfidCache().get(rfid)
         if rfidData is None:
             self.__logger.warning("Unknown rfid offered ({}). Access denied and rfid value saved in db.".format(rfid))
             newRfid = RfidModel()
@@ -130,7 +134,8 @@ class ChargerHandlerThread(object):
             newRfid.save()
             return False
 
-        # Update last seen date
+        # Update last seen date, on a copy (the cached one is shared). The save updates the cache.
+        rfidData = rfidData.detached_copy()
         rfidData.last_used_at = datetime.now()
         rfidData.save()
 
@@ -142,8 +147,8 @@ class ChargerHandlerThread(object):
     def resume_session_if_applicable(self):
         self.__logger.debug(".resume_session_if_applicable()")
 
-        # Check if there was a charge session active when Oppleo was stopped.
-        openChargeSession = ChargeSessionModel.getOpenChargeSession(self.device)
+        # Check if there was a charge session active when Oppleo was stopped. (Re)load it into the registry.
+        openChargeSession = OpenChargeSessionRegistry().refresh(self.device)
         if openChargeSession is None:
             self.__logger.info("No open charge session to resume.")
         else:
@@ -197,7 +202,7 @@ class ChargerHandlerThread(object):
                 Case 1: open session. only the rfid used for this session can deactivate it.
                 Case 2: no open session. only a valid rfid can open the session
             """
-            openSession = ChargeSessionModel.getOpenChargeSession(self.device)
+            openSession = OpenChargeSessionRegistry().get(self.device)
 
             if openSession is not None:
                 # Case 1
@@ -269,9 +274,10 @@ class ChargerHandlerThread(object):
         charge_session = ChargeSessionModel()
         charge_session.set(data_for_session)
         charge_session.save()
+        OpenChargeSessionRegistry().track(charge_session)
         self.__logger.info('.start_charge_session() New charge session started with {}'.format(charge_session.id))
 
-        rfidObj = RfidModel.get_one(rfid)
+        rfidObj = RfidCache().get(rfid)
         if rfidObj is not None and bool(rfidObj.get_odometer): 
             # Try to add odometer
             self.__logger.debug('.start_charge_session() Update odometer for the vehicle in this rfid {}'.format(rfid))
@@ -321,8 +327,13 @@ class ChargerHandlerThread(object):
             self.__logger.error(".end_charge_session() - session end requested, but no open session provided. (charge_session=None, detect={})".format(detect))
             return
 
+        # The session can be the one published by the registry, do not modify that one
+        charge_session = charge_session.detached_copy()
         charge_session.end_value = 0
 
+        # Spooled energy updates and measurements first, they must not overwrite the end values
+        WriteSpool().drain()
+
         start_value = 0
         if (oppleoConfig.energyDevice is not None and 
             oppleoConfig.energyDevice.enabled and
@@ -341,8 +352,14 @@ class ChargerHandlerThread(object):
         else:
             charge_session.end_time = datetime.now()
         charge_session.total_energy = charge_session.end_value - charge_session.start_value
-        charge_session.total_price = round(charge_session.total_energy * charge_session.tariff * 100) /100
+        timeOfUseTariff = TimeOfUseTariff()
+        if timeOfUseTariff.enabled():
+            charge_session.total_price = timeOfUseTariff.recompute(charge_session)
+            timeOfUseTariff.forget(charge_session.id)
+        else:
+            charge_session.total_price = round(charge_session.total_energy * charge_session.tariff * 100) /100
         charge_session.save()
+        OpenChargeSessionRegistry().track(charge_session)
         # Emit websocket update
         self.__logger.debug('.end_charge_session() - Send msg charge_session_ended ...'.format(charge_session.to_str))
         OutboundEvent.triggerEvent(
@@ -490,11 +507,14 @@ class ChargerHandlerThread(object):
         self.__logger.debug('.handle_auto_session() enabled: {}'.format(oppleoConfig.autoSessionEnabled))
         # Open session, otherwise this method is not called
         if oppleoConfig.autoSessionEnabled: 
-            edmm = EnergyDeviceMeasureModel()
-            kwh_used = edmm.get_usage_since(
-                    oppleoConfig.chargerID,
-                    (datetime.today() - timedelta(minutes=oppleoConfig.autoSessionMinutes))
-                    )
+            since_ts = datetime.today() - timedelta(minutes=oppleoConfig.autoSessionMinutes)
+            if (oppleoConfig.energyDevice is not None and
+                oppleoConfig.energyDevice.energy_device_id == oppleoConfig.chargerID):
+                # In-memory usage window, no database round-trip on the evse reader thread
+                kwh_used = oppleoConfig.energyDevice.get_usage_since(since_ts)
+            else:
+                edmm = EnergyDeviceMeasureModel()
+                kwh_used = edmm.get_usage_since(oppleoConfig.chargerID, since_ts)
             if kwh_used > oppleoConfig.autoSessionEnergy:
                 self.__logger.debug('.handle_auto_session() - Keep the current session. More energy ({}kWh) used than {}kWh in {} minutes'
                            .format(
@@ -513,7 +533,7 @@ class ChargerHandlerThread(object):
                         )
                 with self.threadLock:
                     # Lock to prevent the session to be hijacked when someone simultaneously presents the rfid card
-                    charge_session = ChargeSessionModel.get_open_charge_session_for_device(self.device)
+                    charge_session = OpenChargeSessionRegistry().get(self.device)
                     if charge_session is None:
                         # No open charge session found
                         self.__logger.warning(".handle_auto_session() - was expecting an open charge session to close...")
@@ -540,24 +560,35 @@ class ChargerHandlerThread(object):
     # Callback from MeasureElectricityUsageThread with updated EnergyDeviceMeasureModel
     def energyUpdate(self, device_measurement):
         self.__logger.debug('.energyUpdate() callback...')
-        # Open charge session for this energy device?
+        # Open charge session for this energy device? From the registry, no database query
+        openChargeSessionRegistry = OpenChargeSessionRegistry()
         with self.threadLock:
-            open_charge_session_for_device = \
-                ChargeSessionModel.get_open_charge_session_for_device(
-                        device_measurement.energy_device_id
-                )
+            open_charge_session_for_device = openChargeSessionRegistry.get(device_measurement.energy_device_id)
             if open_charge_session_for_device != None:
-                self.__logger.debug('.energyUpdate() open charge session, updating usage. device_measurement {}, open_charge_session_for_device {}'.format(str(device_measurement.to_str()), str(open_charge_session_for_device.to_str())))
+                if self.__logger.isEnabledFor(logging.DEBUG):
+                    self.__logger.debug('.energyUpdate() open charge session, updating usage. device_measurement {}, open_charge_session_for_device {}'.format(str(device_measurement.to_str()), str(open_charge_session_for_device.to_str())))
                 # Update session usage
-                open_charge_session_for_device.end_value = device_measurement.kw_total
-                self.__logger.debug('.energyUpdate() end_value to %s...' % open_charge_session_for_device.end_value)
-                open_charge_session_for_device.total_energy = \
-                    round((open_charge_session_for_device.end_value - open_charge_session_for_device.start_value) *10) /10
-                self.__logger.debug('.energyUpdate() total_energy to %s...' % open_charge_session_for_device.total_energy)
-                open_charge_session_for_device.total_price = \
-                    round(open_charge_session_for_device.total_energy * open_charge_session_for_device.tariff * 100) /100 
-                self.__logger.debug('.energyUpdate() total_price to %s...' % open_charge_session_for_device.total_price)
-                open_charge_session_for_device.save() 
+                end_value = device_measurement.kw_total
+                total_energy = round((end_value - open_charge_session_for_device.start_value) *10) /10
+                timeOfUseTariff = TimeOfUseTariff()
+                if timeOfUseTariff.enabled():
+                    # Priced along the energy curve, incremental
+                    total_price = timeOfUseTariff.session_price(open_charge_session_for_device, device_measurement.created_at, end_value)
+                else:
+                    total_price = round(total_energy * open_charge_session_for_device.tariff * 100) /100
+                values = {
+                    "end_value"     : end_value,
+                    "total_energy"  : total_energy,
+                    "total_price"   : total_price
+                    }
+                self.__logger.debug('.energyUpdate() end_value to {}, total_energy to {}, total_price to {}...'.format(
+                    values['end_value'], values['total_energy'], values['total_price']))
+                # Single UPDATE of the changed columns only, spooled when the database is not available
+                WriteSpool().update_charge_session(open_charge_session_for_device.id, values)
+                open_charge_session_for_device = openChargeSessionRegistry.update(device_measurement.energy_device_id, values)
+                if open_charge_session_for_device is None:
+                    # Session ended in the meantime
+                    return
                 # Emit change events
 
                 self.counter += 1
@@ -579,7 +610,7 @@ class ChargerHandlerThread(object):
                                                              end_value=open_charge_session_for_device.end_value,
                                                             )
                 """
-                rfidObj = RfidModel.get_one(open_charge_session_for_device.rfid)
+                rfidObj = RfidCache().get(open_charge_session_for_device.rfid)
                 if rfidObj is not None:
                     self.__logger.debug('.energyUpdate() retrieved RFID (name={}, id={}'.format(rfidObj.name, rfidObj.rfid))
                 else:
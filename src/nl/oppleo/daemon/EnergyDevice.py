@@ -1,5 +1,6 @@
 import time
 import logging
+from datetime import datetime, timedelta
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.config.OppleoConfig import OppleoConfig
@@ -7,6 +8,9 @@ from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel
 from nl.oppleo.utils.OutboundEvent import OutboundEvent
 from nl.oppleo.utils.EnergyModbusReader import EnergyModbusReader
 from nl.oppleo.utils.EnergyModbusReaderSimulator import EnergyModbusReaderSimulator
+from nl.oppleo.utils.EnergyUsageWindow import EnergyUsageWindow
+from nl.oppleo.services.WriteSpool import WriteSpool
+from nl.oppleo.exceptions.Exceptions import DbException
 
 oppleoSystemConfig = OppleoSystemConfig()
 oppleoConfig = OppleoConfig()
@@ -25,6 +29,8 @@ class EnergyDevice():
     appSocketIO = None
     callbackList = []
     __last_read_not_stored_measurement = None
+    __last_saved_measurement = None
+    __usage_window = None
 
     def __init__(self, energy_device_id=None, modbusInterval:int=10, enabled:bool=False, appSocketIO=None, simulate:bool=False):
         global oppleoSystemConfig
@@ -35,6 +41,8 @@ class EnergyDevice():
         self.appSocketIO = appSocketIO
         self.enabled = enabled
         self.simulate = simulate
+        self.__usage_window = EnergyUsageWindow(retention=self.usageWindowRetention())
+        self.rebuildUsageWindow()
         self.createEnergyModbusReader()
 
 
@@ -103,7 +111,7 @@ class EnergyDevice():
                                                                   device_measurement.kw_total,
                                                                   device_measurement.created_at))
 
-        last_save_measurement = EnergyDeviceMeasureModel().get_last_saved(self.energy_device_id)
+        last_save_measurement = self.lastSavedMeasurement()
 
         if last_save_measurement is None:
             self.__logger.info('No saved measurement found, is this the first run for device %s?' % self.energy_device_id)
@@ -122,17 +130,17 @@ class EnergyDevice():
             if data_changed:
                 if self.__last_read_not_stored_measurement is not None:
                     self.__logger.debug('Also saving last not stored measurement to db before saving new changed measurement')
-                    self.__last_read_not_stored_measurement.save()
+                    self.storeMeasurement(self.__last_read_not_stored_measurement)
                     self.__logger.debug("value saved %s %s %s" %
                             (self.__last_read_not_stored_measurement.energy_device_id,
                              self.__last_read_not_stored_measurement.id,
                              self.__last_read_not_stored_measurement.created_at))
                     self.__last_read_not_stored_measurement = None
                 self.__logger.debug('Measurement has changed, saving it to db')
-                device_measurement.save()
+                self.storeMeasurement(device_measurement)
             else:
                 self.__logger.debug('Measurement has not changed, but 1 hour has expired, saving it to db')
-                device_measurement.save()
+                self.storeMeasurement(device_measurement)
                 # Clear last not stored measurement, as now stored
                 self.__last_read_not_stored_measurement = None
 
@@ -146,7 +154,9 @@ class EnergyDevice():
         if data_changed:
             # Emit event
             self.counter += 1
-            self.__logger.debug(f'Queue msg {self.counter} to be send ...{device_measurement.to_str()}')
+            # Formatting the payload for the log line costs more than building it, only when logged
+            if self.__logger.isEnabledFor(logging.DEBUG):
+                self.__logger.debug(f'Queue msg {self.counter} to be send ...{device_measurement.to_str()}')
             # Info has the current kWh meter data, no rfid tag info, therefor public
             OutboundEvent.triggerEvent(
                 event='status_update', 
@@ -240,9 +250,80 @@ class EnergyDevice():
     def storeLastNotStoredMeasurement(self):
         if self.__last_read_not_stored_measurement is not None:
             self.__logger.debug('Storing last not stored measurement to db')
-            self.__last_read_not_stored_measurement.save()
+            self.storeMeasurement(self.__last_read_not_stored_measurement)
             self.__logger.debug("value saved %s %s %s" %
                     (self.__last_read_not_stored_measurement.energy_device_id,
                      self.__last_read_not_stored_measurement.id,
                      self.__last_read_not_stored_measurement.created_at))
-            self.__last_read_not_stored_measurement = None
\ No newline at end of file
+            self.__last_read_not_stored_measurement = None
+
+
+    """
+        The last stored measurement is kept in memory, only the first measurement after start queries the database.
+        It is the last measurement handed to storeMeasurement(), also when the database was down and it was spooled.
+    """
+    def lastSavedMeasurement(self):
+        if self.__last_saved_measurement is None:
+            try:
+                self.__last_saved_measurement = EnergyDeviceMeasureModel().get_last_saved(self.energy_device_id)
+            except DbException as e:
+                self.__logger.warning('lastSavedMeasurement() - could not load for {} - {}'.format(self.energy_device_id, str(e)))
+        return self.__last_saved_measurement
+
+
+    """
+        Saves the measurement, or spools it when the database is not available (WriteSpool)
+    """
+    def storeMeasurement(self, device_measurement):
+        WriteSpool().save_measurement(device_measurement)
+        self.__last_saved_measurement = device_measurement
+        self.addToUsageWindow(device_measurement)
+
+
+    """
+        The usage window holds the stored kw_total values of the last autoSessionMinutes, so auto-session detection
+        does not have to query the database when the EVSE starts charging.
+    """
+    def usageWindowRetention(self) -> timedelta:
+        return timedelta(minutes=oppleoConfig.autoSessionMinutes)
+
+
+    def rebuildUsageWindow(self):
+        self.__logger.debug('rebuildUsageWindow() for {}'.format(self.energy_device_id))
+        retention = self.usageWindowRetention()
+        self.__usage_window.retention = retention
+        try:
+            self.__usage_window.load(
+                    EnergyDeviceMeasureModel.get_usage_window_samples(
+                        energy_device_id=self.energy_device_id,
+                        since_ts=datetime.now() - retention
+                        )
+                    )
+        except DbException as e:
+            self.__logger.warning('rebuildUsageWindow() - could not load usage window for {} - {}'.format(self.energy_device_id, str(e)))
+            self.__usage_window.clear()
+
+
+    def addToUsageWindow(self, device_measurement):
+        # Follow configuration changes
+        self.__usage_window.retention = self.usageWindowRetention()
+        self.__usage_window.add(device_measurement.created_at, device_measurement.kw_total)
+
+
+    """
+        kWh used since since_ts. Answered from the in-memory usage window, the database is only queried if the window
+        does not reach back far enough (for example after autoSessionMinutes was increased).
+    """
+    def get_usage_since(self, since_ts:datetime) -> float:
+        energy_used = self.__usage_window.usage_since(since_ts)
+        if energy_used is not None:
+            self.__logger.debug('get_usage_since() - since {} usage {}kWh (usage window)'.format(
+                        since_ts.strftime("%d/%m/%Y, %H:%M:%S"), energy_used)
+                        )
+            return energy_used
+        self.__logger.debug('get_usage_since() - usage window does not cover {}, querying database'.format(since_ts.strftime("%d/%m/%Y, %H:%M:%S")))
+        return EnergyDeviceMeasureModel().get_usage_since(self.energy_device_id, since_ts)
+
+
+    def usageWindowDiag(self) -> dict:
+        return self.__usage_window.diag()
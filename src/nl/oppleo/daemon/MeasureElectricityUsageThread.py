@@ -6,6 +6,7 @@ from nl.oppleo.config.OppleoConfig import OppleoConfig
 from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel
 from nl.oppleo.models.EnergyDeviceModel import EnergyDeviceModel
 from nl.oppleo.daemon.EnergyDevice import EnergyDevice
+from nl.oppleo.services.ChangeBus import ChangeBus
 
 oppleoSystemConfig = OppleoSystemConfig()
 oppleoConfig = OppleoConfig()
@@ -16,14 +17,23 @@ class MeasureElectricityUsageThread(object):
     appSocketIO = None
     threadLock = None
     stop_event = None
+    energy_device_changed_event = None
 
     def __init__(self, appSocketIO):
         self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
         self.appSocketIO = appSocketIO
         self.thread = None
         self.stop_event = threading.Event()
+        self.energy_device_changed_event = threading.Event()
         self.threadLock = threading.Lock()
         self.createEnergyDevice()
+        # React to energy device changes, instead of polling the database for a device
+        ChangeBus().subscribe(ChangeBus.TOPIC_ENERGY_DEVICE, self.__energyDeviceChanged)
+
+
+    # Publishing thread, handled in monitorEnergyDeviceLoop
+    def __energyDeviceChanged(self, topic, details):
+        self.energy_device_changed_event.set()
 
     def start(self):
         self.stop_event.clear()
@@ -67,7 +77,6 @@ class MeasureElectricityUsageThread(object):
     def monitorEnergyDeviceLoop(self):
         global oppleoConfig
         self.__logger.debug('monitorEnergyDeviceLoop()...')
-        timer = 0
         while not self.stop_event.is_set():
             if (oppleoConfig.energyDevice is not None and 
                 (oppleoConfig.energyDevice.enabled or oppleoConfig.energyDevice.simulate)
@@ -76,12 +85,10 @@ class MeasureElectricityUsageThread(object):
             # Sleep is interruptable by other threads, but sleeing 7 seconds before checking if 
             # stop is requested is a bit long, so sleep for 0.1 seconds, then check passed time
             self.appSocketIO.sleep(0.1)
-            # Once every 5 seconds (50x 0.1s) check if None device can be instantiated, and if device is (still) enabled
-            timer = timer +1 % 50
-            if timer == 0:
-                # Refresh
-                energy_device_data = EnergyDeviceModel.get()
-                if energy_device_data is not None and oppleoConfig.energyDevice is None:
+            # An energy device was saved, check if None device can be instantiated now
+            if self.energy_device_changed_event.is_set():
+                self.energy_device_changed_event.clear()
+                if oppleoConfig.energyDevice is None:
                     self.createEnergyDevice()
         if (oppleoConfig.energyDevice is not None and 
             (oppleoConfig.energyDevice.enabled or oppleoConfig.energyDevice.simulate)
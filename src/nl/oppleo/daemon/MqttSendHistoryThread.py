@@ -2,24 +2,40 @@ import logging
 import threading
 import time
 from enum import IntEnum
-import random
+from datetime import datetime
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.config.OppleoConfig import OppleoConfig
 
 from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel
+from nl.oppleo.services.KeyValueStoreCache import KeyValueStoreCache
+from nl.oppleo.services.OppleoMqttClient import OppleoMqttClient
 from nl.oppleo.utils.OutboundEvent import OutboundEvent
+from nl.oppleo.utils.TokenBucket import TokenBucket
 
 oppleoSystemConfig = OppleoSystemConfig()
 oppleoConfig = OppleoConfig()
 
-DEFAULT_DELAY_BETWEEN_MQTT_EVENTS = 0.05
-DEFAULT_PAGE_SIZE = 950
+DEFAULT_MAX_MESSAGES_PER_SEC = 20         # 0 is unlimited
+DEFAULT_MAX_BYTES_PER_SEC = 512 * 1024    # 0 is unlimited
+DEFAULT_PAGE_SIZE = 1000
 DEFAULT_TIME_BETWEEN_FRONT_END_UPDATES = 5 # number of seconds passed
 
+# Mode 2 sizes the batches to have the broker take one (wait_for_publish) within TARGET_PUBLISH_LATENCY seconds
+MIN_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 10000
+TARGET_PUBLISH_LATENCY = 0.25
+PUBLISH_TIMEOUT = 10        # seconds
+MAX_RETRY_DELAY = 30        # seconds
+PAUSE_POLL_INTERVAL = 0.1   # seconds
+
+# Checkpoint of mode 2, the (device, created_at, id) of the last row sent and the filters of the run
+CHECKPOINT_KVSTORE = 'mqtt'
+CHECKPOINT_SCOPE = 'history'
+
 class MqttSendHistoryThreadMode(IntEnum):
     MODE_ONE = 1    # Only batch, uses sqlalchemy ORM pagination
-    MODE_TWO = 2    # Only batch, uses sqlalchemy core fetchmany
+    MODE_TWO = 2    # Only batch, keyset pages on (device, created_at, id), resumable from the checkpoint
 
 
 """
@@ -46,7 +62,11 @@ class MqttSendHistoryThread(object):
     __pause_event = None
     __cancel_event = None
     __page_size = DEFAULT_PAGE_SIZE
-    __delay_between_mqtt_events = DEFAULT_DELAY_BETWEEN_MQTT_EVENTS
+    __max_messages_per_sec = DEFAULT_MAX_MESSAGES_PER_SEC
+    __max_bytes_per_sec = DEFAULT_MAX_BYTES_PER_SEC
+    __messageBucket = None
+    __byteBucket = None
+    __compact = False
     __time_between_front_end_updates = DEFAULT_TIME_BETWEEN_FRONT_END_UPDATES
     __status = Status.INITIAL
     __processingTime = 0
@@ -55,29 +75,54 @@ class MqttSendHistoryThread(object):
     __front_end_updates = 0
     __mqtt_events = 0
     __current_tps = 0
+    __bytes = 0
+    __current_bps = 0
     __mode = MqttSendHistoryThreadMode.MODE_TWO
+    # Filters of the run (mode 2)
+    __since_ts = None
+    __until_ts = None
+    __energy_device_ids = None
+    __resume = True
+    # Processed by an earlier run, not part of the processing time
+    __resumed = 0
 
 
     def __init__(self, 
                  page_size=DEFAULT_PAGE_SIZE, 
-                 delay_between_mqtt_events=DEFAULT_DELAY_BETWEEN_MQTT_EVENTS, 
+                 max_messages_per_sec=DEFAULT_MAX_MESSAGES_PER_SEC,
+                 max_bytes_per_sec=DEFAULT_MAX_BYTES_PER_SEC,
                  time_between_front_end_updates=DEFAULT_TIME_BETWEEN_FRONT_END_UPDATES,
                  mode=MqttSendHistoryThreadMode.MODE_TWO):
         self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))        
         self.__thread = None
         self.__status = Status.INITIAL
         self.__threadLock = threading.Lock()        
-        self.__page_size = page_size + random.randrange(101)
-        self.__delay_between_mqtt_events = delay_between_mqtt_events
+        self.__page_size = page_size
+        self.__max_messages_per_sec = max_messages_per_sec
+        self.__max_bytes_per_sec = max_bytes_per_sec
         self.__time_between_front_end_updates = time_between_front_end_updates
         self.__mode = mode
         self.__pause_event = threading.Event()
         self.__cancel_event = threading.Event()
 
 
-    def start(self):
+    """
+        since_ts, until_ts and energy_device_ids limit the history sent (mode 2). A run with the same filters continues
+        from the checkpoint of an earlier cancelled or interrupted run, unless resume is False.
+        compact sends the batches column oriented (EnergyDeviceMeasureModel.sto_columns) instead of a list of dicts.
+    """
+    def start(self, since_ts:datetime=None, until_ts:datetime=None, energy_device_ids:list=None, resume:bool=True,
+              compact:bool=False):
         with self.__threadLock:
             if (self.__status in [ Status.INITIAL, Status.CANCELLED, Status.COMPLETED ]):
+                self.__since_ts = since_ts
+                self.__until_ts = until_ts
+                self.__energy_device_ids = sorted(energy_device_ids) if energy_device_ids else None
+                self.__resume = resume
+                self.__resumed = 0
+                self.__compact = compact
+                self.__messageBucket = TokenBucket(rate=self.__max_messages_per_sec)
+                self.__byteBucket = TokenBucket(rate=self.__max_bytes_per_sec)
                 self.__pause_event.clear()
                 self.__cancel_event.clear()
                 self.__logger.debug('Launching background task...')
@@ -89,6 +134,8 @@ class MqttSendHistoryThread(object):
                 self.__processed = 0
                 self.__mqtt_events = 0
                 self.__total = 0
+                self.__bytes = 0
+                self.__current_bps = 0
                 #   appSocketIO.start_background_task launches a background_task
                 #   This really doesn't do parallelism well, basically runs the whole thread befor it yields...
                 #   Therefore use standard threads
@@ -129,10 +176,28 @@ class MqttSendHistoryThread(object):
         return { "batchProcessing"             : True,
                  "batchSize"                   : self.__page_size,
                  "timeBetweenFrontEndUpdates"  : self.__time_between_front_end_updates,
-                 "delayBetweenMqttMessages"    : self.__delay_between_mqtt_events
+                 "maxMessagesPerSec"           : self.__max_messages_per_sec,
+                 "maxBytesPerSec"              : self.__max_bytes_per_sec,
+                 "compact"                     : self.__compact,
+                 "since"                       : self.__since_ts.isoformat() if self.__since_ts is not None else None,
+                 "until"                       : self.__until_ts.isoformat() if self.__until_ts is not None else None,
+                 "energyDeviceIds"             : self.__energy_device_ids
                 }
         
 
+    def __tps(self) -> int:
+        return int((self.__processed - self.__resumed) / self.__processingTime) if self.__processingTime > 0 else 0
+
+
+    def __bps(self) -> int:
+        return int(self.__bytes / self.__processingTime) if self.__processingTime > 0 else 0
+
+
+    def __timeRemaining(self) -> float:
+        sent = self.__processed - self.__resumed
+        return ( self.__processingTime / sent ) * ( self.__total - self.__processed ) if sent > 0 else 0
+
+
     @property
     def status(self):
         #with self.__threadLock:
@@ -151,10 +216,14 @@ class MqttSendHistoryThread(object):
                              "mqttEvents"       : self.__mqtt_events,
                              "remaining"        : ( self.__total - self.__processed ),
                              "processingtime"   : float(round(self.__processingTime, 3)),
-                             "tps"              : int(self.__processed / self.__processingTime),
+                             "resumed"          : self.__resumed,
+                             "tps"              : self.__tps(),
                              "currentTps"       : self.__current_tps if (self.__status in [ Status.STARTED ]) else 0,
-                             "timeestimation"   : float(round((( self.__processingTime / self.__processed ) * self.__total ), 3)),
-                             "timeremaining"    : float(round((( self.__processingTime / self.__processed ) * ( self.__total - self.__processed )), 3))
+                             "bytes"            : self.__bytes,
+                             "bytesPerSec"      : self.__bps(),
+                             "currentBytesPerSec" : self.__current_bps if (self.__status in [ Status.STARTED ]) else 0,
+                             "timeestimation"   : float(round(self.__processingTime + self.__timeRemaining(), 3)),
+                             "timeremaining"    : float(round(self.__timeRemaining(), 3))
                     }
                 else:
                     return { "process"          : StatusStr[self.__status],
@@ -166,7 +235,10 @@ class MqttSendHistoryThread(object):
                              "remaining"        : ( self.__total - self.__processed ),
                              "processingtime"   : float(round(self.__processingTime, 3)),
                              "tps"              : 0,
-                             "currentTps"       : 0
+                             "currentTps"       : 0,
+                             "bytes"            : 0,
+                             "bytesPerSec"      : 0,
+                             "currentBytesPerSec" : 0
 
                     }
             if self.__status in [ Status.COMPLETED, Status.CANCELLED ]:
@@ -176,9 +248,13 @@ class MqttSendHistoryThread(object):
                          "processed"        : self.__processed,
                          "mqttEvents"       : self.__mqtt_events,
                          "frontEndUpdates"  : self.__front_end_updates,
+                         "resumed"          : self.__resumed,
                          "processingtime"   : float(round(self.__processingTime, 3)),
-                         "tps"              : int(self.__processed / self.__processingTime),
-                         "currentTps"       : 0
+                         "tps"              : self.__tps(),
+                         "currentTps"       : 0,
+                         "bytes"            : self.__bytes,
+                         "bytesPerSec"      : self.__bps(),
+                         "currentBytesPerSec" : 0
                 }
 
  
@@ -197,30 +273,79 @@ class MqttSendHistoryThread(object):
         with self.__threadLock:
             self.__mode = mode
 
-    def __sendMqttEventIfTime(self):
-        if len(self.__batch) > self.__page_size:
-            pass
-
-    # Runs on each entry
+    """
+        Waits for the message and byte budget of a message of size bytes
+    """
+    def __throttle(self, size:int=0):
+        wait = max(self.__messageBucket.reserve(1), self.__byteBucket.reserve(size))
+        if wait > 0:
+            self.__cancel_event.wait(wait)
+
+
+    """
+        Next page size from the time the broker took to take the last batch. Shrinks proportionally (at most by half)
+        when slower than TARGET_PUBLISH_LATENCY, grows by a quarter when faster than half of it. With a bytes per second
+        limit a batch is kept within one second of budget, a larger one would only stall the progress updates.
+    """
+    def __adapt(self, latency:float, bytesPerRow:float):
+        if latency > TARGET_PUBLISH_LATENCY:
+            pageSize = int(self.__page_size * max(0.5, TARGET_PUBLISH_LATENCY / latency))
+        elif latency < TARGET_PUBLISH_LATENCY / 2:
+            pageSize = int(self.__page_size * 1.25)
+        else:
+            pageSize = self.__page_size
+        if self.__max_bytes_per_sec and bytesPerRow > 0:
+            pageSize = min(pageSize, int(self.__max_bytes_per_sec / bytesPerRow))
+        self.__page_size = max(MIN_PAGE_SIZE, min(MAX_PAGE_SIZE, pageSize))
+
+
+    """
+        Publishes one page as one MQTT message and waits for the broker to take it. Retries until published or
+        cancelled, returns the size of the message in bytes or None when cancelled. A retry after a timeout may deliver
+        the batch twice, like a resume after a restart does.
+    """
+    def __publish(self, rows) -> int:
+        data = EnergyDeviceMeasureModel.sto_columns(rows) if self.__compact else \
+               [ EnergyDeviceMeasureModel.sto_str(row) for row in rows ]
+        topic, message = OutboundEvent.mqttMessage(event='status_update', data=data, namespace='/usage')
+        size = len(message.encode('utf-8'))
+        retries = 0
+        while not self.__cancel_event.is_set():
+            self.__throttle(size)
+            if self.__cancel_event.is_set():
+                break
+            publishStart = time.monotonic()
+            published = OppleoMqttClient().publish(topic=topic, message=message, waitForPublish=True,
+                                                   timeout=PUBLISH_TIMEOUT * 1000)
+            if published:
+                self.__adapt(time.monotonic() - publishStart, size / len(rows))
+                return size
+            retries += 1
+            self.__page_size = max(MIN_PAGE_SIZE, self.__page_size // 2)
+            delay = min(MAX_RETRY_DELAY, 2 ** (retries -1))
+            self.__logger.warning('History batch not published, retry in {}s'.format(delay))
+            self.__cancel_event.wait(delay)
+        return None
+
+
+    # Runs on each page
     def __mqttResultSetHandler(self, resultSet=None) -> bool:
-        # Build batch
-        for entryResult in resultSet:
-            self.__batch.append(EnergyDeviceMeasureModel.sto_str(entryResult))
-        # Time to send it out. Send MQTT event as batch (Array)
-        OutboundEvent.emitMQTTEvent( event='status_update',
-                                        data=self.__batch,
-                                        status=None,
-                                        id=None,
-                                        namespace='/usage')
-        # Now assign an new array. Don't empty with .clear() as the emitting function could still be working on the old one.
-        self.__batch = []
+        size = self.__publish(resultSet)
+        if size is None:
+            # Cancelled, not sent
+            return False
         self.__mqtt_events += 1
+        self.__bytes += size
 
         self.__processed += len(resultSet)
+        # Sent, a restart continues after the last row
+        self.__saveCheckpoint(resultSet[-1])
 
         intermediate_timestamp = time.time()
-        self.__processingTime += (intermediate_timestamp - self.__time_start)
-        self.__current_tps = int(len(resultSet) / (intermediate_timestamp - self.__time_start))
+        elapsed = intermediate_timestamp - self.__time_start
+        self.__processingTime += elapsed
+        self.__current_tps = int(len(resultSet) / elapsed) if elapsed > 0 else 0
+        self.__current_bps = int(size / elapsed) if elapsed > 0 else 0
         self.__time_start = intermediate_timestamp
 
         if (time.time() - self.__lastUpdate) > self.__time_between_front_end_updates:
@@ -234,12 +359,11 @@ class MqttSendHistoryThread(object):
             self.__front_end_updates += 1
             self.__lastUpdate = time.time()
 
-        time.sleep(self.__delay_between_mqtt_events)
-
         if self.__pause_event.is_set():
             # pause
             self.__status = Status.PAUSED
             self.__current_tps = 0
+            self.__current_bps = 0
             OutboundEvent.triggerEvent(
                 event='mqtt_send_history_paused',
                 id=oppleoConfig.chargerID,
@@ -249,7 +373,7 @@ class MqttSendHistoryThread(object):
             )
             while self.__pause_event.is_set() and not self.__cancel_event.is_set():
                 self.__time_start = time.time()
-                time.sleep(self.__delay_between_mqtt_events)
+                time.sleep(PAUSE_POLL_INTERVAL)
             if not self.__cancel_event.is_set():
                 self.__status = Status.STARTED
                 OutboundEvent.triggerEvent(
@@ -266,6 +390,47 @@ class MqttSendHistoryThread(object):
         return True
 
 
+    def __filters(self) -> dict:
+        return { "since"            : self.__since_ts.isoformat() if self.__since_ts is not None else None,
+                 "until"            : self.__until_ts.isoformat() if self.__until_ts is not None else None,
+                 "energyDeviceIds"  : self.__energy_device_ids
+               }
+
+
+    """
+        The checkpoint of an earlier run with the same filters, None if there is none
+    """
+    def __loadCheckpoint(self) -> dict:
+        try:
+            checkpoint = KeyValueStoreCache().get_scope(kvstore=CHECKPOINT_KVSTORE, scope=CHECKPOINT_SCOPE)
+        except Exception as e:
+            self.__logger.warning('Could not load the checkpoint, starting from the beginning ({})'.format(str(e)))
+            return None
+        if checkpoint.get('filters') != self.__filters() or checkpoint.get('energy_device_id') is None:
+            return None
+        return checkpoint
+
+
+    def __saveCheckpoint(self, row):
+        try:
+            KeyValueStoreCache().put_scope(kvstore=CHECKPOINT_KVSTORE, scope=CHECKPOINT_SCOPE, values={
+                    'filters'           : self.__filters(),
+                    'energy_device_id'  : row.energy_device_id,
+                    'created_at'        : row.created_at.isoformat(),
+                    'id'                : row.id
+                })
+        except Exception as e:
+            # Sending continues, a restart may send some rows again
+            self.__logger.warning('Could not save the checkpoint ({})'.format(str(e)))
+
+
+    def __clearCheckpoint(self):
+        try:
+            KeyValueStoreCache().put_scope(kvstore=CHECKPOINT_KVSTORE, scope=CHECKPOINT_SCOPE, values={})
+        except Exception as e:
+            self.__logger.warning('Could not clear the checkpoint ({})'.format(str(e)))
+
+
     # The main loop (2)
     def __mqttSendHistoryLoopMode2(self):
         self.__logger.debug('mqttSendHistoryLoop()...')
@@ -274,10 +439,22 @@ class MqttSendHistoryThread(object):
         self.__current_tps = 0
         self.__time_start = time.time()
 
-        edmm = EnergyDeviceMeasureModel()
-        edmm.energy_device_id = oppleoConfig.energyDevice
-
-        self.__total = edmm.get_count()
+        checkpoint = self.__loadCheckpoint() if self.__resume else None
+        devices = EnergyDeviceMeasureModel.get_device_ids(self.__energy_device_ids)
+
+        self.__total = EnergyDeviceMeasureModel.get_count_between(devices, self.__since_ts, self.__until_ts)
+        if checkpoint is not None:
+            # Already sent, the devices before the checkpoint device and its rows up to the checkpoint
+            checkpointTs = datetime.fromisoformat(checkpoint['created_at'])
+            self.__resumed = EnergyDeviceMeasureModel.get_count_between(
+                                    [ device for device in devices if device < checkpoint['energy_device_id'] ],
+                                    self.__since_ts, self.__until_ts) + \
+                             EnergyDeviceMeasureModel.get_count_between(
+                                    [ checkpoint['energy_device_id'] ], self.__since_ts,
+                                    checkpointTs if self.__until_ts is None else min(checkpointTs, self.__until_ts))
+            self.__processed = self.__resumed
+            self.__logger.info('Resuming after {} {} ({} of {} sent)'.format(
+                                    checkpoint['energy_device_id'], checkpoint['created_at'], self.__resumed, self.__total))
 
         OutboundEvent.triggerEvent(
                     event='mqtt_send_history_started', 
@@ -289,14 +466,31 @@ class MqttSendHistoryThread(object):
 
         self.__lastUpdate = self.__time_start
 
-        self.__batch = []
-        edmm = EnergyDeviceMeasureModel()
-
-        # Run them all
-        edmm.get_all_as_stream(self.__mqttResultSetHandler, self.__page_size)
+        for device in devices:
+            if self.__cancel_event.is_set():
+                break
+            afterTs, afterId = None, None
+            if checkpoint is not None:
+                if device < checkpoint['energy_device_id']:
+                    continue
+                if device == checkpoint['energy_device_id']:
+                    afterTs, afterId = datetime.fromisoformat(checkpoint['created_at']), checkpoint['id']
+            while True:
+                # The handler adapts the page size
+                limit = self.__page_size
+                page = EnergyDeviceMeasureModel.get_page_after(device, after_ts=afterTs, after_id=afterId,
+                                                               since_ts=self.__since_ts, until_ts=self.__until_ts,
+                                                               limit=limit)
+                if len(page) == 0:
+                    break
+                afterTs, afterId = page[-1].created_at, page[-1].id
+                if not self.__mqttResultSetHandler(page) or len(page) < limit:
+                    break
 
         # Finished or cancelled
         self.__status = Status.COMPLETED if not self.__cancel_event.is_set() else Status.CANCELLED
+        if self.__status == Status.COMPLETED:
+            self.__clearCheckpoint()
         self.__processingTime += (time.time() - self.__time_start)
         OutboundEvent.triggerEvent(
             event='mqtt_send_history_completed' if self.__status == Status.COMPLETED else 'mqtt_send_history_cancelled', 
@@ -321,9 +515,8 @@ class MqttSendHistoryThread(object):
         time_start = time.time()
 
         edmm = EnergyDeviceMeasureModel()
-        edmm.energy_device_id = oppleoConfig.energyDevice
 
-        self.__total = edmm.get_count()
+        self.__total = EnergyDeviceMeasureModel.get_count_between([ oppleoConfig.chargerID ])
 
         OutboundEvent.triggerEvent(
                     event='mqtt_send_history_started', 
@@ -346,17 +539,18 @@ class MqttSendHistoryThread(object):
                                     )
             batch = []
             for entryResult in pageResult:
-                # Build batch
-                batch.append(entryResult.to_str())
+                # Build batch, old measurements, not kept in the payload cache
+                batch.append(entryResult.payload(cache=False))
             # Send MQTT event as batch (Array)
             OutboundEvent.emitMQTTEvent( event='status_update',
                                             data=batch,
                                             status=None,
                                             id=None,
-                                            namespace='/usage')
+                                            namespace='/usage',
+                                            direct=True)
             self.__processed += pageResult.count()
             self.__mqtt_events += 1
-            time.sleep(self.__delay_between_mqtt_events)
+            self.__throttle()
 
             intermediate_timestamp = time.time()
             self.__processingTime += (intermediate_timestamp - time_start)
@@ -386,7 +580,7 @@ class MqttSendHistoryThread(object):
                 )
                 while self.__pause_event.is_set() and not self.__cancel_event.is_set():
                     time_start = time.time()
-                    time.sleep(self.__delay_between_mqtt_events)
+                    time.sleep(PAUSE_POLL_INTERVAL)
                 if not self.__cancel_event.is_set():
                     self.__status = Status.STARTED
                     OutboundEvent.triggerEvent(
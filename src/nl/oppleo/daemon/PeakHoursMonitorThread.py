@@ -1,11 +1,13 @@
 import threading
 import logging
 import time
+from datetime import datetime
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.config.OppleoConfig import OppleoConfig
-from nl.oppleo.models.OffPeakHoursModel import OffPeakHoursModel
-from nl.oppleo.models.ChargeSessionModel import ChargeSessionModel
+from nl.oppleo.services.OffPeakCalendar import OffPeakCalendar
+from nl.oppleo.services.ChangeBus import ChangeBus
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
 from nl.oppleo.services.EvseOutput import EvseOutput
 from nl.oppleo.utils.OutboundEvent import OutboundEvent
 
@@ -18,19 +20,31 @@ class PeakHoursMonitorThread(object):
     threadLock = None
     appSocketIO = None
     stop_event = None
+    wakeup_event = None
     # Check EVSE status change every 2 seconds [seconds]
     changeEvseStatusCheckInterval = 2
-    # Check Off Peak window every minute [seconds]
-    offPeakWindowCheckInterval = 60
+    # Check Off Peak window at least every hour [seconds], normally at the next transition
+    offPeakWindowCheckInterval = 3600
 
-    sleepInterval = 0.25
+    sleepInterval = 0.5
 
     def __init__(self, appSocketIO ):
         self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
         self.threadLock = threading.Lock()
         self.stop_event = threading.Event()
+        self.wakeup_event = threading.Event()
         self.appSocketIO = appSocketIO
-        self.sleepInterval = min(self.changeEvseStatusCheckInterval, self.offPeakWindowCheckInterval) / 4
+        changeBus = ChangeBus()
+        changeBus.subscribe(ChangeBus.TOPIC_OFF_PEAK_HOURS, self.__offPeakChanged)
+        changeBus.subscribe(ChangeBus.TOPIC_CHARGER_CONFIG, self.__offPeakChanged)
+
+
+    # Publishing thread. Off peak entries or settings changed, re-evaluate now
+    def __offPeakChanged(self, topic, details):
+        if topic == ChangeBus.TOPIC_CHARGER_CONFIG and \
+           not any(key.startswith('peakhours_') for key in details.get('keys', [])):
+            return
+        self.wakeup()
 
 
     def start(self):
@@ -48,33 +62,46 @@ class PeakHoursMonitorThread(object):
         Off peak hours
             If the EVSE is enabled during Peak hours, and the config is set to Off Peak, the EVSE is disabled untill the
             Off Peak hours start.
-            Detecting Off Peak is database intensive. Checking if EVSE status has changed not.
+            Off Peak is determined from the compiled OffPeakCalendar, which also tells when the next Off Peak
+            transition is. Sleep until that transition, or until the calendar or off peak settings change.
                 Quickly detect changed EVSE conditions - react when a session is started.
-                Take time to see if Off Peak time period is entered
 
         Working
-            Check for changed EVSE state every second, by quickly asking the EVSE Thread.
-            Check for Off Peak every 5 minutes. 
+            Check for changed EVSE state every 2 seconds, by quickly asking the EVSE Thread.
+            Check for Off Peak at the next transition, when the calendar changed, or when woken up (wakeup()).
             -   If a session is active, off peak, and the EVSE is disabled, (re-)enable the EVSE (and possibly wake 
                 car for charging), oh, and reset any 'over-ride off peak for once' authorizations
             -   If Peak and reader is enabled, disable the EVSE
             Allow overriding off-peak for one period.
-            Check only once per 1 or 5 minutes, to prevent database overload and bad rfid response 
         """
         changeEvseStatusCheckLastRun = 0
         offPeakWindowCheckLastRun = 0
-        ohm = OffPeakHoursModel()
+        offPeakCalendar = OffPeakCalendar()
+        offPeakCalendarVersion = None
+        nextTransition = None
         evseOutput = EvseOutput()
         while not self.stop_event.is_set():
 
             try:
+                wakeup = self.wakeup_event.is_set()
+                if wakeup:
+                    self.wakeup_event.clear()
+                    changeEvseStatusCheckLastRun = 0
                 """ 
                 Off Peak Window Change check
                 """
-                if (time.time() *1000.0) > (offPeakWindowCheckLastRun + (self.offPeakWindowCheckInterval *1000.0)):
+                if (wakeup or
+                    offPeakCalendarVersion != offPeakCalendar.version or
+                    (nextTransition is not None and datetime.now() >= nextTransition) or
+                    (time.time() *1000.0) > (offPeakWindowCheckLastRun + (self.offPeakWindowCheckInterval *1000.0))):
                     # Time to determine if it is Off Peak again
+                    offPeakCalendarVersion = offPeakCalendar.version
+                    now = datetime.now()
                     wasOffPeak = evseOutput.isOffPeak
-                    evseOutput.isOffPeak = ohm.is_off_peak_now()
+                    evseOutput.isOffPeak = offPeakCalendar.is_off_peak(now)
+                    nextTransition = offPeakCalendar.next_transition(now)
+                    # A transition means the EVSE state can change right away
+                    changeEvseStatusCheckLastRun = 0
                     if (wasOffPeak != evseOutput.isOffPeak):
                         # Send change notification
                         OutboundEvent.triggerEvent(
@@ -87,9 +114,10 @@ class PeakHoursMonitorThread(object):
                                 namespace='/charge_session',
                                 public=True
                             )
-                    self.__logger.debug('Off Peak Window Change check ... (wasOffPeak:{}, isOffPeak:{})'.format( 
+                    self.__logger.debug('Off Peak Window Change check ... (wasOffPeak:{}, isOffPeak:{}, nextTransition:{})'.format( 
                                     wasOffPeak, 
-                                    evseOutput.isOffPeak
+                                    evseOutput.isOffPeak,
+                                    nextTransition
                                     )
                                 )
                     offPeakWindowCheckLastRun = time.time() *1000.0
@@ -125,10 +153,8 @@ class PeakHoursMonitorThread(object):
                     if (not evseOutput.is_enabled() and \
                         ( evseOutput.isOffPeak or not oppleoConfig.offpeakEnabled or oppleoConfig.allowPeakOnePeriod) \
                     ):
-                        # Only see if charge session exists in the database if the EVSE is enabled Off Peak
-                        csm = ChargeSessionModel.get_open_charge_session_for_device(
-                                                    oppleoConfig.chargerID
-                                                    )
+                        # Only see if a charge session is open if the EVSE is enabled Off Peak
+                        csm = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
                         if csm is not None:
                             # Open charge session, enable the EVSE
                             self.__logger.debug('Off Peak hours, EVSE OFF and Active charge session. Switching EVSE ON')
@@ -142,8 +168,11 @@ class PeakHoursMonitorThread(object):
                     changeEvseStatusCheckLastRun = time.time() *1000.0
                     pass
 
-                # Sleep for quite a while, and yield for other threads
-                self.appSocketIO.sleep(self.sleepInterval)
+                # Sleep until the next EVSE check or Off Peak transition, or until woken up
+                sleepTime = self.changeEvseStatusCheckInterval - (time.time() - changeEvseStatusCheckLastRun /1000.0)
+                if nextTransition is not None:
+                    sleepTime = min(sleepTime, (nextTransition - datetime.now()).total_seconds())
+                self.wakeup_event.wait(timeout=max(sleepTime, self.sleepInterval))
             except Exception as e:
                 self.__logger.error("Exception tracking off peak hours", exc_info=True)
 
@@ -154,5 +183,11 @@ class PeakHoursMonitorThread(object):
     def stop(self, block=False):
         self.__logger.debug('Requested to stop')
         self.stop_event.set()
+        self.wakeup_event.set()
 
 
+    """
+        Re-evaluate Off Peak and the EVSE state now, for example after changing the off peak settings
+    """
+    def wakeup(self):
+        self.wakeup_event.set()
@@ -7,7 +7,7 @@ from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.config.OppleoConfig import OppleoConfig
 from nl.oppleo.utils.OutboundEvent import OutboundEvent
 from nl.oppleo.api.VehicleApi import VehicleApi
-from nl.oppleo.models.RfidModel import RfidModel
+from nl.oppleo.services.RfidCache import RfidCache
 
 HTTP_CODE_200_OK                    = 200
 HTTP_CODE_202_ACCEPTED              = 202  # Accepted, processing pending
@@ -87,7 +87,7 @@ class VehicleChargeStatusMonitorThread(object):
             self.__logger.error('monitor() Cannot run Thread for RFID None!')
             return False
 
-        rfidData = RfidModel.get_one(self.__rfidTag)
+        rfidData = RfidCache().get(self.__rfidTag)
         if rfidData is None:
             self.__logger.error('monitor() Cannot run Thread. Cannot get data for RFID {}'.format(self.__rfidTag))
 
@@ -105,13 +105,14 @@ class VehicleChargeStatusMonitorThread(object):
 
                     if rfidData is None:
                         # No token? Try once more
-                        rfidData = RfidModel.get_one(self.__rfidTag)
+                        rfidData = RfidCache().get(self.__rfidTag)
                         if rfidData is None:
                             # Still no token, next While iteration
                             self.__logger.debug("monitor() no token, continue to next While iteration")
                             continue
 
-                    vApi = VehicleApi(rfid_model=rfidData)
+                    # The cached rfid is shared, the VehicleApi can modify (cleanup) its own copy
+                    vApi = VehicleApi(rfid_model=rfidData.detached_copy())
                     if not vApi.isAuthorized():
                         # no token, next While iteration
                         self.__logger.debug("monitor() VehicleApi not authorized, continue to next While iteration")
@@ -4,6 +4,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session, make_transient_to_detached
 from nl.oppleo.exceptions.Exceptions import DbException
+from nl.oppleo.models.SqliteEngine import is_sqlite_url, create_sqlite_engine, create_sqlite_indexes, seed_sqlite_database
+from nl.oppleo.models.PoolMonitor import poolMonitor, InstrumentedQueuePool
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 
@@ -13,14 +15,26 @@ oppleoSystemConfig = OppleoSystemConfig()
     NOTE: Do not close sessions, they are lazily reused and reusing a closed session causes Exceptions.
 """
 
-engine = create_engine(
-            oppleoSystemConfig.DATABASE_URL,
-            pool_size=5,                # Default is 5 - min conns kept in the pool
-            max_overflow=10,            # Default is 10 - max conns handed out
-#            timeout=5,                  # Default 30 - time to give up connection
-            pool_pre_ping=True,         # validate connection before use
-            pool_recycle=3600           # recycle connections after one hour
-            )
+if is_sqlite_url(oppleoSystemConfig.DATABASE_URL):
+    # Standalone charger, see SqliteEngine
+    engine = create_sqlite_engine(
+                oppleoSystemConfig.DATABASE_URL,
+                poolclass=InstrumentedQueuePool,
+                pool_size=oppleoSystemConfig.SQLALCHEMY_POOL_SIZE,
+                max_overflow=oppleoSystemConfig.SQLALCHEMY_MAX_OVERFLOW
+                )
+else:
+    engine = create_engine(
+                oppleoSystemConfig.DATABASE_URL,
+                poolclass=InstrumentedQueuePool,    # QueuePool timing the checkout wait
+                pool_size=oppleoSystemConfig.SQLALCHEMY_POOL_SIZE,          # Default is 5 - min conns kept in the pool
+                max_overflow=oppleoSystemConfig.SQLALCHEMY_MAX_OVERFLOW,    # Default is 10 - max conns handed out
+#                timeout=5,                  # Default 30 - time to give up connection
+                pool_pre_ping=True,         # validate connection before use
+                pool_recycle=3600           # recycle connections after one hour
+                )
+# Checkout latency, hold time per thread, overflow and pre_ping cost
+poolMonitor.install(engine)
 
 session_factory = sessionmaker(bind=engine, expire_on_commit=False)
 DbSession = scoped_session(session_factory)
@@ -44,10 +58,19 @@ def init_db():
     import nl.oppleo.models.EnergyDeviceMeasureModel
     import nl.oppleo.models.EnergyDeviceModel
     import nl.oppleo.models.OffPeakHoursModel
+    import nl.oppleo.models.TariffScheduleModel
     import nl.oppleo.models.RfidModel
     import nl.oppleo.models.User
+    import nl.oppleo.models.KeyValueStoreModel
+    import nl.oppleo.models.AccesslogModel
+    import nl.oppleo.models.WebAuthNCredentialModel
     try:
         Base.metadata.create_all(bind=engine)
+        if engine.dialect.name == 'sqlite':
+            # No Liquibase on SQLite
+            create_sqlite_indexes(engine)
+            if seed_sqlite_database(engine, Base.metadata):
+                __logger.warning('New database, inserted the default configuration')
         oppleoSystemConfig.dbAvailable = True
     except:
         __logger.error('COULD NOT CONNECT TO DATABASE!!!')
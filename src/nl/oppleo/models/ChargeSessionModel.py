@@ -7,12 +7,13 @@ from marshmallow import fields, Schema
 from datetime import datetime
 import logging
 
-from sqlalchemy import orm, func, Column, Integer, String, Float, DateTime, desc, asc, update, func, extract, inspect
+from sqlalchemy import orm, func, Column, Integer, String, Float, DateTime, Numeric, desc, asc, update, select, cast, or_, extract, inspect
+from sqlalchemy.orm import make_transient_to_detached, aliased
 from sqlalchemy.exc import InvalidRequestError
 
-from nl.oppleo.models.Base import Base, DbSession
+from nl.oppleo.models.Base import Base, DbSession, engine
 from nl.oppleo.exceptions.Exceptions import DbException
-import json
+from nl.oppleo.utils.PayloadSerializer import Payload, timestamp_str
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 
@@ -43,6 +44,10 @@ class ChargeSessionModel(Base):
     km = Column(Integer)
     trigger = Column(String(12))
 
+    # The fields of the payload, in order
+    __payloadFields = [ 'id', 'energy_device_id', 'start_time', 'rfid', 'start_value', 'end_value', 'tariff',
+                        'total_energy', 'total_price', 'km', 'end_time', 'trigger' ]
+
     TRIGGER_RFID = 'RFID'   # Manually by offering an RFID tag
     TRIGGER_AUTO = 'AUTO'   # By auto-session detection
     TRIGGER_WEB = 'WEB'     # Through the WebApp
@@ -96,6 +101,149 @@ class ChargeSessionModel(Base):
             raise DbException("Could not update to {} table in database".format(self.__tablename__ ))
 
 
+    """
+        Single UPDATE of the given columns for session id, without loading the row first
+    """
+    @staticmethod
+    def update_columns(id:int=None, values:dict=None) -> None:
+        if id is None or values is None or len(values) == 0:
+            return
+        try:
+            with DbSession() as db_session:
+                db_session.execute(
+                    update(ChargeSessionModel)
+                        .where(ChargeSessionModel.id == id)
+                        .values(**values)
+                    )
+                db_session.commit()
+        except InvalidRequestError as e:
+            ChargeSessionModel.__logger.error("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ), exc_info=True)
+        except Exception as e:
+            ChargeSessionModel.__logger.error("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ))
+
+
+    """
+        update_columns() for a list of (id, values), in order and in one transaction. Raises DbException if not
+        updated, the WriteSpool keeps the updates spooled then.
+    """
+    @staticmethod
+    def update_columns_many(updates:list=None) -> None:
+        if updates is None or len(updates) == 0:
+            return
+        try:
+            with DbSession() as db_session:
+                for id, values in updates:
+                    db_session.execute(
+                        update(ChargeSessionModel)
+                            .where(ChargeSessionModel.id == id)
+                            .values(**values)
+                        )
+                db_session.commit()
+        except Exception as e:
+            ChargeSessionModel.__logger.error("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ))
+
+
+    """
+        Re-prices the closed sessions matching all given filters (id range [startId, toId), end_time range
+        [from_ts, to_ts), rfid, energy_device_id) at tariff, with a single UPDATE (on SQLite preceded by a SELECT of the old
+        values). Sessions already at tariff are skipped, open sessions are priced by the charger itself and are not touched.
+        audit is called with the updated rows (id, rfid, total_energy, old_tariff, old_price, new_price) before the
+        commit, an exception from audit rolls the update back.
+        With dry_run nothing is updated, the returned totals are what the update would do:
+            { 'sessions', 'energy', 'old_price', 'new_price' }
+    """
+    @staticmethod
+    def retariff(tariff:float, startId:int=None, toId:int=None, from_ts:datetime=None, to_ts:datetime=None,
+                 rfid:str=None, energy_device_id:str=None, dry_run:bool=False, audit=None) -> dict:
+        conditions = [ ChargeSessionModel.end_time != None,
+                       or_(ChargeSessionModel.tariff == None, ChargeSessionModel.tariff != tariff) ]
+        if startId is not None:
+            conditions.append(ChargeSessionModel.id >= startId)
+        if toId is not None:
+            conditions.append(ChargeSessionModel.id < toId)
+        if from_ts is not None:
+            conditions.append(ChargeSessionModel.end_time >= from_ts)
+        if to_ts is not None:
+            conditions.append(ChargeSessionModel.end_time < to_ts)
+        if rfid is not None:
+            conditions.append(ChargeSessionModel.rfid == str(rfid))
+        if energy_device_id is not None:
+            conditions.append(ChargeSessionModel.energy_device_id == energy_device_id)
+        newPrice = func.round(cast(ChargeSessionModel.total_energy * tariff, Numeric), 2)
+        try:
+            with DbSession() as db_session:
+                if dry_run:
+                    totals = db_session.execute(
+                                select(func.count(ChargeSessionModel.id),
+                                       func.coalesce(func.sum(ChargeSessionModel.total_energy), 0),
+                                       func.coalesce(func.sum(ChargeSessionModel.total_price), 0),
+                                       func.coalesce(func.sum(newPrice), 0))
+                                    .where(*conditions)
+                                ).one()
+                    db_session.rollback()
+                    return { 'sessions': totals[0], 'energy': float(totals[1]),
+                             'old_price': float(totals[2]), 'new_price': float(totals[3]) }
+                if engine.dialect.name != 'sqlite':
+                    # One UPDATE, the old tariff and price for the audit from a self-join, which reads the rows as they
+                    # were before the statement
+                    oldSession = aliased(ChargeSessionModel, name='old_session')
+                    rows = sorted(db_session.execute(
+                                update(ChargeSessionModel)
+                                    .where(oldSession.id == ChargeSessionModel.id, *conditions)
+                                    .values(tariff=tariff, total_price=newPrice)
+                                    .returning(ChargeSessionModel.id, ChargeSessionModel.rfid, ChargeSessionModel.total_energy,
+                                               oldSession.tariff, oldSession.total_price, ChargeSessionModel.total_price)
+                                    .execution_options(synchronize_session=False)
+                                ).all())
+                else:
+                    # SQLite cannot return the columns of a joined table nor the values from before the update, the old
+                    # values are selected first. Rows changed in between no longer match the conditions.
+                    old = { row.id: row for row in db_session.execute(
+                                select(ChargeSessionModel.id, ChargeSessionModel.tariff, ChargeSessionModel.total_price)
+                                    .where(*conditions)
+                                ).all() }
+                    rows = []
+                    if len(old) > 0:
+                        updated = db_session.execute(
+                                    update(ChargeSessionModel)
+                                        .where(ChargeSessionModel.id.in_(list(old.keys())), *conditions)
+                                        .values(tariff=tariff, total_price=newPrice)
+                                        .returning(ChargeSessionModel.id, ChargeSessionModel.rfid, ChargeSessionModel.total_energy,
+                                                   ChargeSessionModel.total_price)
+                                        .execution_options(synchronize_session=False)
+                                    ).all()
+                        rows = [ (id, rfid, total_energy, old[id].tariff, old[id].total_price, total_price)
+                                    for id, rfid, total_energy, total_price in sorted(updated) ]
+                if audit is not None:
+                    audit(rows)
+                db_session.commit()
+                return { 'sessions': len(rows), 'energy': sum(row[2] or 0 for row in rows),
+                         'old_price': sum(row[4] or 0 for row in rows), 'new_price': sum(row[5] or 0 for row in rows) }
+        except InvalidRequestError as e:
+            ChargeSessionModel.__logger.error("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ))
+        except Exception as e:
+            ChargeSessionModel.__logger.error("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not update to {} table in database".format(ChargeSessionModel.__tablename__ ))
+
+
+    """
+        Returns a detached copy of this session, optionally with changed values. Saving the copy updates the existing
+        row (only the columns changed after copying).
+    """
+    def detached_copy(self, values:dict=None) -> ChargeSessionModel:
+        copy = ChargeSessionModel()
+        for attr in inspect(ChargeSessionModel).mapper.column_attrs:
+            setattr(copy, attr.key, getattr(self, attr.key))
+        if values is not None:
+            for key, value in values.items():
+                setattr(copy, key, value)
+        make_transient_to_detached(copy)
+        return copy
+
+
     def delete(self) -> None:
         try:
             with DbSession() as db_session:
@@ -595,7 +743,7 @@ class ChargeSessionModel(Base):
         return datetime.strptime(date_time_str, '%d/%m/%Y, %H:%M:%S')
 
     def datetime_to_date_str(self, date_time:datetime=None) -> str | None:
-        return str(date_time.strftime("%d/%m/%Y, %H:%M:%S")) if date_time is not None else None
+        return timestamp_str(date_time)
 
     """
         Overview total energy and price amounts per month
@@ -660,62 +808,32 @@ class ChargeSessionModel(Base):
             raise DbException("Could not query from {} table in database".format(ChargeSessionModel.__tablename__ ))
 
 
+    """
+        The payload of this session (PayloadSerializer), shared by the websocket, MQTT and Home Assistant consumers of
+        one update. Sessions change, the payload is built on every call.
+    """
+    def payload(self) -> Payload:
+        values = { key: getattr(self, key) for key in ChargeSessionModel.__payloadFields }
+        strs = { key: str(value) for key, value in values.items() }
+        strs['start_time'] = timestamp_str(values['start_time'])
+        strs['rfid'] = values['rfid']
+        strs['end_time'] = timestamp_str(values['end_time'])
+        return Payload(strs, values=values)
+
+
     # convert into JSON:
     def to_json(self) -> str:
-        return (
-            json.dumps({
-                "id": str(self.id),
-                "energy_device_id": str(self.energy_device_id),
-                "start_time": self.datetime_to_date_str( self.start_time ),
-                "rfid": self.rfid,
-                "start_value": str(self.start_value),
-                "end_value": str(self.end_value),
-                "tariff": str(self.tariff),
-                "total_energy": str(self.total_energy),
-                "total_price": str(self.total_price),
-                "km": str(self.km),
-                "end_time": self.datetime_to_date_str( self.end_time ),
-                "trigger": str(self.trigger)
-            },
-            default=str
-            )
-        )
+        return self.payload().encode(separators=None)
 
 
     # convert into JSON:
     def to_str(self) -> dict:
-        return ({
-                "id": str(self.id),
-                "energy_device_id": str(self.energy_device_id),
-                "start_time": self.datetime_to_date_str( self.start_time ),
-                "rfid": self.rfid,
-                "start_value": str(self.start_value),
-                "end_value": str(self.end_value),
-                "tariff": str(self.tariff),
-                "total_energy": str(self.total_energy),
-                "total_price": str(self.total_price),
-                "km": str(self.km),
-                "end_time": self.datetime_to_date_str( self.end_time ),
-                "trigger": str(self.trigger)
-            })
+        return self.payload()
 
 
     # convert into dict:
     def to_dict(self) -> dict:
-        return ({
-            "id": str(self.id),
-            "energy_device_id": str(self.energy_device_id),
-            "start_time": self.datetime_to_date_str( self.start_time ),
-            "rfid": self.rfid,
-            "start_value": str(self.start_value),
-            "end_value": str(self.end_value),
-            "tariff": str(self.tariff),
-            "total_energy": str(self.total_energy),
-            "total_price": str(self.total_price),
-            "km": str(self.km),
-            "end_time": self.datetime_to_date_str( self.end_time ),
-            "trigger": str(self.trigger)
-        })
+        return self.payload()
 
 
 class ChargeSessionSchema(Schema):
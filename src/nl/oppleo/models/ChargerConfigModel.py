@@ -21,6 +21,7 @@ from sqlalchemy.orm import make_transient, make_transient_to_detached
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.models.Base import Base, DbSession
 from nl.oppleo.exceptions.Exceptions import DbException
+from nl.oppleo.services.ChangeBus import ChangeBus
 
 oppleoSystemConfig = OppleoSystemConfig()
 
@@ -122,22 +123,67 @@ class ChargerConfigModel(Base):
     """
     def setAndSave(self, key, value, allowed=None):
         self.__logger.debug('.setAndSave() key:{} value:{} range:{}'.format(key, value, allowed))
-        curVal = getattr(self, key)
-        self.__logger.debug('.setAndSave() curVal:{}'.format(curVal))
-        if not isinstance(value, type(curVal)):
-            self.__logger.debug(".setAndSave() {} TypeError: {} must be type {}".format(key, type(curVal)))
-            raise TypeError("{} must be type {}".format(key, type(curVal)))
-        self.__logger.debug('.setAndSave() no TypeError')
-        if allowed is not None and value not in allowed:
-            self.__logger.debug(".setAndSave() {} ValueError: value {} of key {} not within range {}".format(value, key, allowed))
-            raise ValueError("{} value {} of key {} not within range {}".format(value, key, allowed))
-        self.__logger.debug('.setAndSave() no ValueError')
-        setattr(self, key, value)
-        self.__logger.debug('.setAndSave() curVal:{} getattr(self, key)={}'.format(curVal, getattr(self, key)))
-        if curVal != getattr(self, key):
-            # Value changed
-            self.modified_at = datetime.datetime.now()
+        self.setAndSaveAll(values={ key: value }, allowed=None if allowed is None else { key: allowed })
+
+
+    """
+        Set multiple variables in one transaction. All values are validated before any is changed, a TypeError or
+        ValueError leaves the config untouched. If the commit fails the previous values are restored.
+        Returns the list of changed keys.
+    """
+    def setAndSaveAll(self, values:dict, allowed:dict=None) -> list:
+        self.__logger.debug('.setAndSaveAll() values:{} allowed:{}'.format(values, allowed))
+        allowed = allowed if allowed is not None else {}
+        columns = ChargerConfigModel.__table__.columns.keys()
+        for key, value in values.items():
+            if key not in columns:
+                raise KeyError("{} is not a {} column".format(key, self.__tablename__))
+            curVal = getattr(self, key)
+            if not isinstance(value, type(curVal)):
+                self.__logger.debug(".setAndSaveAll() {} TypeError: {} must be type {}".format(key, value, type(curVal)))
+                raise TypeError("{} must be type {}".format(key, type(curVal)))
+            if allowed.get(key) is not None and value not in allowed[key]:
+                self.__logger.debug(".setAndSaveAll() ValueError: value {} of key {} not within range {}".format(value, key, allowed[key]))
+                raise ValueError("value {} of key {} not within range {}".format(value, key, allowed[key]))
+
+        previous = { key: getattr(self, key) for key in values.keys() }
+        changed = [ key for key, value in values.items() if previous[key] != value ]
+        if len(changed) == 0:
+            return changed
+        previous['modified_at'] = self.modified_at
+        for key in changed:
+            setattr(self, key, values[key])
+        self.modified_at = datetime.datetime.now()
+        try:
             self.save()
+        except DbException:
+            # Nothing was committed, restore
+            for key, value in previous.items():
+                setattr(self, key, value)
+            raise
+        self.__logger.debug('.setAndSaveAll() changed:{}'.format(changed))
+        ChangeBus().publish(ChangeBus.TOPIC_CHARGER_CONFIG, keys=changed)
+        return changed
+
+
+    """
+        Convert a (string) value, as received from the web interface, to the python type of the column
+    """
+    @staticmethod
+    def coerceValue(key:str, value):
+        column = ChargerConfigModel.__table__.columns.get(key)
+        if column is None:
+            raise KeyError("{} is not a {} column".format(key, ChargerConfigModel.__tablename__))
+        if not isinstance(value, str):
+            return value
+        pythonType = column.type.python_type
+        if pythonType is bool:
+            return value.lower() in ['true', '1', 't', 'y', 'yes']
+        if pythonType is datetime.time:
+            return datetime.time.fromisoformat(value)
+        if pythonType is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        return pythonType(value)
 
     def save(self):
         self.__logger.debug(".save()")
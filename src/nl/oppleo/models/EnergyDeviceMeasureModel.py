@@ -4,7 +4,7 @@ import logging
 
 from marshmallow import fields, Schema
 
-from sqlalchemy import orm, Column, Integer, String, DateTime, Float, asc, desc, func, inspect
+from sqlalchemy import orm, event, Column, Integer, String, DateTime, Float, asc, desc, func, inspect, insert, or_
 from sqlalchemy import MetaData, Table, select    # For fetchmany
 from sqlalchemy.orm import Query
 
@@ -14,11 +14,13 @@ from nl.oppleo.models.Base import Base, DbSession
 from nl.oppleo.models.Base import engine    # For fetchmany
 
 from nl.oppleo.exceptions.Exceptions import DbException
-import json
+from nl.oppleo.utils.PayloadSerializer import Payload, PayloadCache, timestamp_str
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 
 oppleoSystemConfig = OppleoSystemConfig()
+# Payloads of the latest stored measurements, by id
+measurePayloads = PayloadCache()
 
 class EnergyDeviceMeasureModel(Base):
     """
@@ -47,6 +49,11 @@ class EnergyDeviceMeasureModel(Base):
     kw_total = Column(Float)
     hz = Column(Float)
 
+    # The fields of the payload, in order
+    __payloadFields = [ 'energy_device_id', 'created_at', 'kwh_l1', 'kwh_l2', 'kwh_l3', 'a_l1', 'a_l2', 'a_l3',
+                        'p_l1', 'p_l2', 'p_l3', 'v_l1', 'v_l2', 'v_l3', 'kw_total', 'hz' ]
+
+
     def __init__(self):
         self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))          
 
@@ -80,6 +87,31 @@ class EnergyDeviceMeasureModel(Base):
             raise DbException("Could not save to {} table in database".format(self.__tablename__ ))
 
 
+    """
+        Column values without the id, as passed to insert_values()
+    """
+    def to_values(self) -> dict:
+        return { attr.key: getattr(self, attr.key) for attr in inspect(EnergyDeviceMeasureModel).mapper.column_attrs
+                    if attr.key != 'id' }
+
+
+    """
+        Insert a list of to_values() dicts in one transaction (executemany). Raises DbException if not inserted, the
+        WriteSpool keeps the rows spooled then.
+    """
+    @staticmethod
+    def insert_values(rows:list=None) -> None:
+        if rows is None or len(rows) == 0:
+            return
+        try:
+            with DbSession() as db_session:
+                db_session.execute(insert(EnergyDeviceMeasureModel), rows)
+                db_session.commit()
+        except Exception as e:
+            EnergyDeviceMeasureModel.__logger.error("Could not save to {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not save to {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ))
+
+
     def get_last_saved(self, energy_device_id):
         self.__logger.debug("get_last_saved() energy_device_id {} ".format(energy_device_id))
         last_saved = self.get_last_n_saved(energy_device_id=energy_device_id, n=1)
@@ -206,6 +238,77 @@ class EnergyDeviceMeasureModel(Base):
             raise DbException("Could not query from {} table in database".format(self.__tablename__ ))
 
 
+    """
+        Device ids with measurements, ascending. Limited to energy_device_ids if given.
+    """
+    @staticmethod
+    def get_device_ids(energy_device_ids:list=None) -> list:
+        try:
+            with DbSession() as db_session:
+                ids = db_session.query(EnergyDeviceMeasureModel.energy_device_id).distinct()
+                if energy_device_ids is not None:
+                    ids = ids.filter(EnergyDeviceMeasureModel.energy_device_id.in_(energy_device_ids))
+                return sorted([ row.energy_device_id for row in ids.all() ])
+        except InvalidRequestError as e:
+            EnergyDeviceMeasureModel.__logger.error("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+            return []
+        except Exception as e:
+            # Nothing to roll back
+            EnergyDeviceMeasureModel.__logger.error("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ))
+
+
+    """
+        Number of measurements of the devices within [since_ts, until_ts], on the (energy_device_id, created_at) index
+    """
+    @staticmethod
+    def get_count_between(energy_device_ids:list=None, since_ts:datetime.datetime=None, until_ts:datetime.datetime=None) -> int:
+        try:
+            with DbSession() as db_session:
+                count = db_session.query(func.count(EnergyDeviceMeasureModel.id))
+                if energy_device_ids is not None:
+                    count = count.filter(EnergyDeviceMeasureModel.energy_device_id.in_(energy_device_ids))
+                if since_ts is not None:
+                    count = count.filter(EnergyDeviceMeasureModel.created_at >= since_ts)
+                if until_ts is not None:
+                    count = count.filter(EnergyDeviceMeasureModel.created_at <= until_ts)
+                return count.scalar()
+        except InvalidRequestError as e:
+            EnergyDeviceMeasureModel.__logger.error("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+        except Exception as e:
+            # Nothing to roll back
+            EnergyDeviceMeasureModel.__logger.error("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ))
+
+
+    """
+        Keyset page of one device, ascending on (created_at, id), the rows after (after_ts, after_id) within
+        [since_ts, until_ts]. Returns core rows (sto_str), the last row is the cursor of the next page.
+        created_at >= after_ts bounds the index scan, a page costs the same at the end of the table as at the start.
+    """
+    @staticmethod
+    def get_page_after(energy_device_id, after_ts:datetime.datetime=None, after_id:int=None,
+                       since_ts:datetime.datetime=None, until_ts:datetime.datetime=None, limit:int=1000) -> list:
+        try:
+            with DbSession() as db_session:
+                edmmt = EnergyDeviceMeasureModel.__table__
+                stmt = select(edmmt).where(edmmt.c.energy_device_id == energy_device_id)
+                if since_ts is not None:
+                    stmt = stmt.where(edmmt.c.created_at >= since_ts)
+                if until_ts is not None:
+                    stmt = stmt.where(edmmt.c.created_at <= until_ts)
+                if after_ts is not None:
+                    stmt = stmt.where(edmmt.c.created_at >= after_ts) \
+                               .where(or_(edmmt.c.created_at > after_ts, edmmt.c.id > after_id))
+                stmt = stmt.order_by(asc(edmmt.c.created_at), asc(edmmt.c.id)) \
+                           .limit(limit)
+                return db_session.execute(stmt).all()
+        except Exception as e:
+            # Nothing to roll back
+            EnergyDeviceMeasureModel.__logger.error("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ))
+
+
     def paginate(self, energy_device_id, offset:int=0, limit:int=0, orderColumn:Column|None=None, orderDir:str=None):
         try:
             with DbSession() as db_session:
@@ -348,6 +451,38 @@ class EnergyDeviceMeasureModel(Base):
         return energy_used
 
 
+    """
+        Returns (created_at, kw_total) tuples, ascending, for all measurements after since_ts (up to and including
+        until_ts) plus the last measurement at or before since_ts. Used to (re)build the in-memory EnergyUsageWindow, and
+        by TimeOfUseTariff.
+    """
+    @staticmethod
+    def get_usage_window_samples(energy_device_id, since_ts:datetime.datetime, until_ts:datetime.datetime=None) -> list:
+        try:
+            with DbSession() as db_session:
+                anchor = db_session.query(EnergyDeviceMeasureModel.created_at, EnergyDeviceMeasureModel.kw_total) \
+                                .filter(EnergyDeviceMeasureModel.energy_device_id == energy_device_id) \
+                                .filter(EnergyDeviceMeasureModel.created_at <= since_ts) \
+                                .order_by(desc(EnergyDeviceMeasureModel.created_at)) \
+                                .first()
+                samples = db_session.query(EnergyDeviceMeasureModel.created_at, EnergyDeviceMeasureModel.kw_total) \
+                                .filter(EnergyDeviceMeasureModel.energy_device_id == energy_device_id) \
+                                .filter(EnergyDeviceMeasureModel.created_at > since_ts)
+                if until_ts is not None:
+                    samples = samples.filter(EnergyDeviceMeasureModel.created_at <= until_ts)
+                samples = samples.order_by(asc(EnergyDeviceMeasureModel.created_at)) \
+                                 .all()
+                return ([] if anchor is None else [(anchor.created_at, anchor.kw_total)]) + \
+                       [(sample.created_at, sample.kw_total) for sample in samples]
+        except InvalidRequestError as e:
+            EnergyDeviceMeasureModel.__logger.error("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+            return []
+        except Exception as e:
+            # Nothing to roll back
+            EnergyDeviceMeasureModel.__logger.error("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not query from {} table in database".format(EnergyDeviceMeasureModel.__tablename__ ))
+
+
     # returns the created_at value at which the first time thi kwh value was measured
     @staticmethod
     def get_time_of_kwh(energy_device_id, kw_total):
@@ -375,7 +510,7 @@ class EnergyDeviceMeasureModel(Base):
 
 
     def get_created_at_str(self):
-        return str(self.created_at.strftime("%d/%m/%Y, %H:%M:%S"))
+        return timestamp_str(self.created_at)
 
 
     def date_str_to_datetime(self, date_time_str):
@@ -386,51 +521,47 @@ class EnergyDeviceMeasureModel(Base):
         return '<id {}>'.format(self.id)
 
 
+    """
+        The payload of this measurement, built once and shared by the websocket, MQTT, Home Assistant and HTTP
+        consumers (PayloadSerializer). The payload is read-only, assigning a field drops it. Stored measurements do
+        not change, their payloads are kept by id. Without cache the payload is built (or reused) but not kept by id,
+        for bulk reads of old measurements (history export) which would only flush the cache.
+    """
+    def payload(self, cache:bool=True) -> Payload:
+        payload = getattr(self, '_payload', None)
+        if payload is None and cache and self.id is not None:
+            payload = measurePayloads.get(self.id)
+        if payload is None:
+            # The loaded values from the instance dict, past the attribute instrumentation. Unloaded (expired) columns
+            # through the attribute.
+            state = self.__dict__
+            values = { key: state[key] if key in state else getattr(self, key) for key in EnergyDeviceMeasureModel.__payloadFields }
+            strs = { key: str(value) for key, value in values.items() }
+            strs['created_at'] = timestamp_str(values['created_at'])
+            payload = Payload(strs, values=values)
+        if cache and self.id is not None and getattr(self, '_payloadCachedId', None) != self.id:
+            measurePayloads.put(self.id, payload)
+            self._payloadCachedId = self.id
+        self._payload = payload
+        return payload
+
+
+    def dropPayload(self):
+        if getattr(self, '_payload', None) is None:
+            return
+        self._payload = None
+        if getattr(self, '_payloadCachedId', None) is not None:
+            measurePayloads.discard(self._payloadCachedId)
+            self._payloadCachedId = None
+
+
     # convert into JSON:
     def to_json(self):
-        return (
-            json.dumps({
-                "energy_device_id": str(self.energy_device_id),
-                "created_at": str(self.created_at.strftime("%d/%m/%Y, %H:%M:%S")),
-                "kwh_l1": str(self.kwh_l1),
-                "kwh_l2": str(self.kwh_l2),
-                "kwh_l3": str(self.kwh_l3),
-                "a_l1": str(self.a_l1),
-                "a_l2": str(self.a_l2),
-                "a_l3": str(self.a_l3),
-                "p_l1": str(self.p_l1),
-                "p_l2": str(self.p_l2),
-                "p_l3": str(self.p_l3),
-                "v_l1": str(self.v_l1),
-                "v_l2": str(self.v_l2),
-                "v_l3": str(self.v_l3),
-                "kw_total": str(self.kw_total),
-                "hz": str(self.hz)
-            },
-            default=str
-            )
-        )
+        return self.payload().encode(separators=None)
 
 
     def to_str(self):
-        return ({
-                "energy_device_id": str(self.energy_device_id),
-                "created_at": str(self.created_at.strftime("%d/%m/%Y, %H:%M:%S")),
-                "kwh_l1": str(self.kwh_l1),
-                "kwh_l2": str(self.kwh_l2),
-                "kwh_l3": str(self.kwh_l3),
-                "a_l1": str(self.a_l1),
-                "a_l2": str(self.a_l2),
-                "a_l3": str(self.a_l3),
-                "p_l1": str(self.p_l1),
-                "p_l2": str(self.p_l2),
-                "p_l3": str(self.p_l3),
-                "v_l1": str(self.v_l1),
-                "v_l2": str(self.v_l2),
-                "v_l3": str(self.v_l3),
-                "kw_total": str(self.kw_total),
-                "hz": str(self.hz)
-            })
+        return self.payload()
 
     @staticmethod
     def sto_str(obj):
@@ -438,30 +569,39 @@ class EnergyDeviceMeasureModel(Base):
         for index, fieldname in enumerate(obj._fields):
             if fieldname == 'id':   # hide the id field
                 continue
-            d[fieldname] = obj._data[index] if fieldname != "created_at" else obj._data[index].strftime("%d/%m/%Y, %H:%M:%S")
+            d[fieldname] = obj._data[index] if fieldname != "created_at" else timestamp_str(obj._data[index])
         return d
 
+    """
+        Column oriented form of core rows of one device, the field names once instead of in every row
+        { "energy_device_id": "...", "columns": [ "created_at", "kwh_l1", ... ], "rows": [ [ ... ], ... ] }
+    """
+    @staticmethod
+    def sto_columns(rows) -> dict:
+        if len(rows) == 0:
+            return { "energy_device_id": None, "columns": [], "rows": [] }
+        fields = [ fieldname for fieldname in rows[0]._fields if fieldname not in [ 'id', 'energy_device_id' ] ]
+        indexes = [ rows[0]._fields.index(fieldname) for fieldname in fields ]
+        createdAt = fields.index('created_at')
+        values = []
+        for row in rows:
+            value = [ row[index] for index in indexes ]
+            value[createdAt] = timestamp_str(value[createdAt])
+            values.append(value)
+        return { "energy_device_id": rows[0].energy_device_id, "columns": fields, "rows": values }
+
     # convert into dict:
     def to_dict(self):
-        return ({
-            "energy_device_id": str(self.energy_device_id),
-            "created_at": str(self.created_at.strftime("%d/%m/%Y, %H:%M:%S")),
-            "kwh_l1": str(self.kwh_l1),
-            "kwh_l2": str(self.kwh_l2),
-            "kwh_l3": str(self.kwh_l3),
-            "a_l1": str(self.a_l1),
-            "a_l2": str(self.a_l2),
-            "a_l3": str(self.a_l3),
-            "p_l1": str(self.p_l1),
-            "p_l2": str(self.p_l2),
-            "p_l3": str(self.p_l3),
-            "v_l1": str(self.v_l1),
-            "v_l2": str(self.v_l2),
-            "v_l3": str(self.v_l3),
-            "kw_total": str(self.kw_total),
-            "hz": str(self.hz)
-        })
+        return self.payload()
+
+
+
+# Assigning a column (not loading from the database) drops the payload built from the previous values
+def _drop_payload(target, value, oldvalue, initiator):
+    target.dropPayload()
 
+for attr in inspect(EnergyDeviceMeasureModel).mapper.column_attrs:
+    event.listen(getattr(EnergyDeviceMeasureModel, attr.key), 'set', _drop_payload)
 
 
 class EnergyDeviceMeasureSchema(Schema):
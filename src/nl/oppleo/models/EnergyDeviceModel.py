@@ -4,6 +4,7 @@ from marshmallow import fields, Schema
 
 from nl.oppleo.models.Base import Base, DbSession
 from nl.oppleo.exceptions.Exceptions import DbException
+from nl.oppleo.services.ChangeBus import ChangeBus
 
 from sqlalchemy import orm, func, Column, String, Integer, Boolean, Float, desc, inspect
 from sqlalchemy.exc import InvalidRequestError
@@ -60,6 +61,7 @@ class EnergyDeviceModel(Base):
         except Exception as e:
             self.__logger.error("Could not save to {} table in database".format(self.__tablename__ ), exc_info=True)
             raise DbException("Could not save to {} table in database".format(self.__tablename__ ))
+        ChangeBus().publish(ChangeBus.TOPIC_ENERGY_DEVICE, energy_device_id=self.energy_device_id)
 
     """
     @staticmethod
@@ -86,6 +88,8 @@ class EnergyDeviceModel(Base):
                 db_session.commit()
         except Exception as e:
             self.__logger.error("Could not delete from {} table in database".format(self.__tablename__ ), exc_info=True)
+            return
+        ChangeBus().publish(ChangeBus.TOPIC_ENERGY_DEVICE, energy_device_id=self.energy_device_id)
 
 
     """
@@ -151,7 +155,8 @@ class EnergyDeviceModel(Base):
                 db_session.commit()
 
                 db_session.expunge(clone)
-                return clone
+            ChangeBus().publish(ChangeBus.TOPIC_ENERGY_DEVICE, energy_device_id=newEnergyDeviceId)
+            return clone
 
         except InvalidRequestError as e:
             EnergyDeviceModel.__logger.error("Could not duplicate energy device {} to {} in table {} in database ({})".format(self.energy_device_id, newEnergyDeviceId, self.__tablename__, str(e)), exc_info=True)
@@ -5,11 +5,12 @@ import json
 
 from marshmallow import fields, Schema
 
-from nl.oppleo.models.Base import Base, DbSession
+from nl.oppleo.models.Base import Base, DbSession, engine
 from nl.oppleo.exceptions.Exceptions import DbException
 
-from sqlalchemy import orm, Column, Integer, String, DateTime, UniqueConstraint, PrimaryKeyConstraint, inspect
+from sqlalchemy import orm, Column, Integer, String, DateTime, UniqueConstraint, PrimaryKeyConstraint, inspect, delete, JSON
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects import postgresql, sqlite
 
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy_json import mutable_json_type
@@ -34,7 +35,7 @@ class KeyValueStoreModel(Base):
     kvstore = Column(String(256))
     scope = Column(String(256))
     key = Column(String(256))
-    value = Column(mutable_json_type(dbtype=JSONB, nested=True))
+    value = Column(mutable_json_type(dbtype=JSONB().with_variant(JSON(), 'sqlite'), nested=True))
     created_at = Column(DateTime)
     modified_at = Column(DateTime)
 
@@ -212,6 +213,67 @@ class KeyValueStoreModel(Base):
             raise DbException("Could not save to {} table in database".format(KeyValueStoreModel.__tablename__ ))
 
 
+    """
+        Insert or update all key/ values in the dict in one transaction (INSERT ... ON CONFLICT DO UPDATE). With
+        delete_missing the keys in the scope that are not in the dict are deleted in the same transaction, making the
+        scope in the database equal to the dict.
+    """
+    @staticmethod
+    def upsert_scope(kvstore:str=None, scope:str=None, values:dict=None, delete_missing:bool=False):
+        values = values if values is not None else {}
+        now = datetime.now()
+        try:
+            with DbSession() as db_session:
+                if len(values) > 0:
+                    # Both dialects support INSERT ... ON CONFLICT DO UPDATE
+                    insert = sqlite.insert if engine.dialect.name == 'sqlite' else postgresql.insert
+                    stmt = insert(KeyValueStoreModel).values([
+                            { 'kvstore': kvstore, 'scope': scope, 'key': key, 'value': value, 'created_at': now, 'modified_at': now }
+                                for key, value in values.items()
+                        ])
+                    stmt = stmt.on_conflict_do_update(
+                            index_elements=[ 'kvstore', 'scope', 'key' ],
+                            set_={ 'value': stmt.excluded.value, 'modified_at': stmt.excluded.modified_at }
+                        )
+                    db_session.execute(stmt)
+                if delete_missing:
+                    stmt = delete(KeyValueStoreModel) \
+                                .where(KeyValueStoreModel.kvstore == kvstore) \
+                                .where(KeyValueStoreModel.scope == scope)
+                    if len(values) > 0:
+                        stmt = stmt.where(KeyValueStoreModel.key.notin_(list(values.keys())))
+                    db_session.execute(stmt)
+                db_session.commit()
+        except InvalidRequestError as e:
+            KeyValueStoreModel.__logger.error("Could not upsert to {} table in database".format(KeyValueStoreModel.__tablename__ ), exc_info=True)
+        except Exception as e:
+            KeyValueStoreModel.__logger.error("Could not upsert to {} table in database".format(KeyValueStoreModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not upsert to {} table in database".format(KeyValueStoreModel.__tablename__ ))
+
+
+    """
+        Delete the keys from the scope in one statement
+    """
+    @staticmethod
+    def delete_keys(kvstore:str=None, scope:str=None, keys:list=None):
+        if keys is None or len(keys) == 0:
+            return
+        try:
+            with DbSession() as db_session:
+                db_session.execute(
+                    delete(KeyValueStoreModel)
+                        .where(KeyValueStoreModel.kvstore == kvstore)
+                        .where(KeyValueStoreModel.scope == scope)
+                        .where(KeyValueStoreModel.key.in_(keys))
+                    )
+                db_session.commit()
+        except InvalidRequestError as e:
+            KeyValueStoreModel.__logger.error("Could not delete from {} table in database".format(KeyValueStoreModel.__tablename__ ), exc_info=True)
+        except Exception as e:
+            KeyValueStoreModel.__logger.error("Could not delete from {} table in database".format(KeyValueStoreModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not delete from {} table in database".format(KeyValueStoreModel.__tablename__ ))
+
+
     def __repr(self):
         return '<id {}>'.format(self.rfid)
 
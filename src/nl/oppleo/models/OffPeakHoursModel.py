@@ -7,11 +7,12 @@ from collections import OrderedDict
 from marshmallow import fields, Schema
 from marshmallow.fields import Boolean
 
-from sqlalchemy import Column, Integer, Boolean, String, Time, orm, and_, or_, cast, Time, func, inspect
+from sqlalchemy import Column, Integer, Boolean, String, Time, orm, and_, or_, literal, func, inspect
 from sqlalchemy.exc import InvalidRequestError
 
 from nl.oppleo.models.Base import Base, DbSession
 from nl.oppleo.exceptions.Exceptions import DbException
+from nl.oppleo.services.ChangeBus import ChangeBus
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 
@@ -85,6 +86,7 @@ class OffPeakHoursModel(Base):
         except Exception as e:
             self.__logger.error("Could not save to {} table in database".format(self.__tablename__ ), exc_info=True)
             raise DbException("Could not save to {} table in database".format(self.__tablename__ ))
+        ChangeBus().publish(ChangeBus.TOPIC_OFF_PEAK_HOURS, id=self.id)
 
 
     def delete(self):
@@ -97,6 +99,7 @@ class OffPeakHoursModel(Base):
         except Exception as e:
             self.__logger.error("Could not delete from {} table in database".format(self.__tablename__ ), exc_info=True)
             raise DbException("Could not delete from {} table in database".format(self.__tablename__ ))
+        ChangeBus().publish(ChangeBus.TOPIC_OFF_PEAK_HOURS, id=self.id)
 
     @staticmethod
     def deleteId(id):
@@ -111,6 +114,7 @@ class OffPeakHoursModel(Base):
         except Exception as e:
             OffPeakHoursModel.__logger.error("Could not delete {} from {} table in database".format(id, OffPeakHoursModel.__tablename__ ), exc_info=True)
             raise DbException("Could not delete {} from {} table in database".format(id, OffPeakHoursModel.__tablename__ ))
+        ChangeBus().publish(ChangeBus.TOPIC_OFF_PEAK_HOURS, id=id)
 
     @staticmethod
     def weekdayToEnStr(weekday) -> str:
@@ -142,14 +146,18 @@ class OffPeakHoursModel(Base):
             self.__logger.debug('is_off_peak() - timestamp is not of type datetime')
             return False
             
+        # Bound as a time value. CAST(.. AS TIME) is an integer on SQLite (NUMERIC affinity), compared to the stored
+        # time strings it never matches.
+        timeOfDay = literal(timestamp.time(), Time)
+
         # Weekday?
         is_off_peak_on_weekday = False
         try:
             with DbSession() as db_session:
                 is_off_peak_on_weekday = db_session.query(OffPeakHoursModel) \
                                                    .filter(OffPeakHoursModel.weekday == OffPeakHoursModel.weekdayToEnStr(timestamp.weekday())) \
-                                                   .filter(OffPeakHoursModel.off_peak_start <= cast(timestamp, Time)) \
-                                                   .filter(OffPeakHoursModel.off_peak_end >= cast(timestamp, Time)) \
+                                                   .filter(OffPeakHoursModel.off_peak_start <= timeOfDay) \
+                                                   .filter(OffPeakHoursModel.off_peak_end >= timeOfDay) \
                                                    .first() != None
                                 
         except InvalidRequestError as e:
@@ -182,8 +190,8 @@ class OffPeakHoursModel(Base):
                                                             )
                                                         )
                                                         ) \
-                                                   .filter(OffPeakHoursModel.off_peak_start <= cast(timestamp, Time)) \
-                                                   .filter(OffPeakHoursModel.off_peak_end >= cast(timestamp, Time)) \
+                                                   .filter(OffPeakHoursModel.off_peak_start <= timeOfDay) \
+                                                   .filter(OffPeakHoursModel.off_peak_end >= timeOfDay) \
                                                    .first() != None
         except InvalidRequestError as e:
             self.__logger.error("Could not query from {} table in database".format(self.__tablename__ ), exc_info=True)
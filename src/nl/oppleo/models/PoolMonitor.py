@@ -0,0 +1,204 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+"""
+ Connection pool instrumentation.
+
+ The scoped DbSession is shared by the long-lived daemon threads and the Flask workers. A session keeps its connection
+ from the first query until commit, rollback or close, a thread that only reads and never ends its transaction keeps
+ the connection checked out. This monitor records per checkout
+ - the checkout latency, waiting for a free connection in the pool
+ - the pre_ping cost, validating the connection after the checkout
+ - the hold time, per thread name
+ - overflow checkouts (beyond pool_size) and checkout timeouts
+ and the number of connections in use at every checkout, from which a pool size is recommended.
+
+ The pool cannot be resized while running. The recommendation is shown on the settings page and logged, the pool size
+ is set with SQLALCHEMY_POOL_SIZE and SQLALCHEMY_MAX_OVERFLOW in the ini file (restart required).
+"""
+
+CONCURRENCY_SAMPLES = 1000
+# Log when a checkout waits this long (seconds)
+CHECKOUT_WAIT_WARNING = 1
+# Log connections held longer than this (seconds) on checkin
+HOLD_TIME_WARNING = 60
+
+# Keys in the pool's connection record info
+CHECKOUT_AT = 'oppleo_checkout_at'
+CHECKOUT_THREAD = 'oppleo_checkout_thread'
+
+
+class TimingStat(object):
+    count = 0
+    total = 0
+    max = 0
+
+    def add(self, value:float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+    def diag(self) -> dict:
+        return {
+            "count"     : self.count,
+            "avg"       : 0 if self.count == 0 else round(self.total / self.count, 4),
+            "max"       : round(self.max, 4)
+            }
+
+
+class PoolMonitor(object):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    __engine = None
+    checkoutWait = None
+    prePing = None
+    holdTime = None
+    overflowCheckouts = 0
+    checkoutTimeouts = 0
+    peakCheckedOut = 0
+    __concurrency = None
+    # id(connection record) -> (thread name, checkout at)
+    __checkedOut = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.__lock:
+            self.checkoutWait = TimingStat()
+            self.prePing = TimingStat()
+            # thread name -> TimingStat
+            self.holdTime = {}
+            self.overflowCheckouts = 0
+            self.checkoutTimeouts = 0
+            self.peakCheckedOut = 0
+            self.__concurrency = deque(maxlen=CONCURRENCY_SAMPLES)
+            self.__checkedOut = {}
+
+
+    """
+        Add the event hooks to the engine. Checkout latency requires the engine's pool to be an InstrumentedQueuePool.
+    """
+    def install(self, engine):
+        self.__engine = engine
+        event.listen(engine, 'checkout', self.__onCheckout)
+        event.listen(engine, 'checkin', self.__onCheckin)
+        # Only called with pool_pre_ping
+        do_ping = engine.dialect.do_ping
+        def timed_do_ping(dbapi_connection):
+            start = time.perf_counter()
+            try:
+                return do_ping(dbapi_connection)
+            finally:
+                self.prePing.add(time.perf_counter() - start)
+        engine.dialect.do_ping = timed_do_ping
+
+
+    def recordCheckoutWait(self, wait:float, timeout:bool=False):
+        with self.__lock:
+            self.checkoutWait.add(wait)
+            if timeout:
+                self.checkoutTimeouts += 1
+        if wait > CHECKOUT_WAIT_WARNING:
+            self.__logger.warning('Waited {:.2f}s for a database connection (thread {}, timeout={}) - {}'.format(
+                    wait, threading.current_thread().name, timeout, '-' if self.__engine is None else self.__engine.pool.status()))
+
+
+    def __onCheckout(self, dbapi_connection, connection_record, connection_proxy):
+        threadName = threading.current_thread().name
+        connection_record.info[CHECKOUT_AT] = time.monotonic()
+        connection_record.info[CHECKOUT_THREAD] = threadName
+        with self.__lock:
+            self.__checkedOut[id(connection_record)] = (threadName, connection_record.info[CHECKOUT_AT])
+            inUse = len(self.__checkedOut)
+            self.__concurrency.append(inUse)
+            newPeak = inUse > self.peakCheckedOut
+            self.peakCheckedOut = max(self.peakCheckedOut, inUse)
+            if self.__engine is not None and isinstance(self.__engine.pool, QueuePool) and inUse > self.__engine.pool.size():
+                self.overflowCheckouts += 1
+        if newPeak:
+            self.__logger.info('Peak of {} database connections in use (thread {}), recommended pool {}'.format(
+                    inUse, threadName, self.recommendation()))
+
+
+    def __onCheckin(self, dbapi_connection, connection_record):
+        if connection_record is None:
+            return
+        checkoutAt = connection_record.info.pop(CHECKOUT_AT, None)
+        threadName = connection_record.info.pop(CHECKOUT_THREAD, None)
+        with self.__lock:
+            self.__checkedOut.pop(id(connection_record), None)
+            if checkoutAt is None:
+                return
+            held = time.monotonic() - checkoutAt
+            self.holdTime.setdefault(threadName, TimingStat()).add(held)
+        if held > HOLD_TIME_WARNING:
+            self.__logger.warning('Database connection held for {:.0f}s by thread {}'.format(held, threadName))
+
+
+    """
+        Pool size covering 95% of the observed checkouts, the overflow covering the observed peak
+    """
+    def recommendation(self) -> dict:
+        with self.__lock:
+            samples = sorted(self.__concurrency)
+        if len(samples) == 0:
+            return {}
+        p95 = samples[min(len(samples) -1, int(math.ceil(0.95 * len(samples))) -1)]
+        poolSize = max(2, p95)
+        maxOverflow = max(2, self.peakCheckedOut - poolSize + 2)
+        if self.checkoutTimeouts > 0:
+            # Exhausted, the observed peak is capped by the pool itself
+            maxOverflow += poolSize
+        return {
+            "pool_size"     : poolSize,
+            "max_overflow"  : maxOverflow
+            }
+
+
+    def diag(self) -> dict:
+        now = time.monotonic()
+        with self.__lock:
+            checkedOut = [ { "thread": threadName, "held": round(now - checkoutAt, 1) }
+                                for threadName, checkoutAt in self.__checkedOut.values() ]
+            holdTime = { threadName: stat.diag() for threadName, stat in self.holdTime.items() }
+        return {
+            "checkoutWait"      : self.checkoutWait.diag(),
+            "checkoutTimeouts"  : self.checkoutTimeouts,
+            "prePing"           : self.prePing.diag(),
+            "overflowCheckouts" : self.overflowCheckouts,
+            "peakCheckedOut"    : self.peakCheckedOut,
+            "checkedOut"        : checkedOut,
+            "holdTime"          : holdTime,
+            "recommendation"    : self.recommendation()
+            }
+
+
+poolMonitor = PoolMonitor()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+        QueuePool timing the wait for a connection (_do_get is the pool's get-a-connection implementation)
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timeout = False
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            timeout = True
+            raise
+        finally:
+            poolMonitor.recordCheckoutWait(time.perf_counter() - start, timeout=timeout)
@@ -10,6 +10,7 @@ from nl.oppleo.exceptions.Exceptions import DbException
 
 from sqlalchemy import orm, Column, String, Boolean, DateTime, inspect
 from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import make_transient_to_detached
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 
@@ -125,6 +126,17 @@ class RfidModel(Base):
             raise DbException("Could not delete from {} table in database".format(self.__tablename__ ))
 
 
+    """
+        Detached copy of this rfid, can be modified and saved (UPDATE) without touching the original
+    """
+    def detached_copy(self):
+        rfid_model = RfidModel()
+        for attr in inspect(RfidModel).mapper.column_attrs:
+            setattr(rfid_model, attr.key, getattr(self, attr.key))
+        make_transient_to_detached(rfid_model)
+        return rfid_model
+
+
     def hasValidToken(self):
         self.__logger.debug("hasValidToken()")
         from nl.oppleo.api.VehicleApi import VehicleApi
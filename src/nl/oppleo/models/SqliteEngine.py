@@ -0,0 +1,278 @@
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import create_engine, event, func, select, text
+from sqlalchemy.engine import make_url
+
+"""
+ SQLite backend for standalone (single board) chargers, selected with a DATABASE_URL like
+    sqlite:////home/pi/Oppleo/db/oppleo.sqlite3
+
+ - WAL journaling, readers do not block the writer and the writer does not block readers
+ - synchronous=NORMAL, in WAL mode a power loss can lose the last transactions but never corrupts the database
+ - a memory mapped database and a larger page cache, the measurement queries are mostly range scans
+ - one writer at a time. SQLite allows a single write transaction, concurrent writers would spin in the busy
+   handler. Writing threads queue on an in-process lock instead, from their first write statement until the commit
+   or rollback of the transaction.
+ - the indexes Liquibase creates on Postgres (db/sql/schema-03.sql), create_all() does not know those
+ - the default rows Liquibase inserts on Postgres (db/sql/schema-01.sql): admin user, charger configuration, energy
+   device, test RFID and off peak hours. Inserted once, in an empty database.
+
+ Postgres is set up by Liquibase and the sqlalchemy models, this module is not used there.
+"""
+
+SQLITE_BACKEND = 'sqlite'
+
+BUSY_TIMEOUT_MS     = 30000                 # Wait for locks held by other processes (backup, sqlite3 cli)
+MMAP_SIZE           = 64 * 1024 * 1024      # 64MB, address space, not memory
+CACHE_SIZE_KIB      = 16 * 1024             # 16MB page cache per connection
+WRITER_WAIT_WARNING = 5                     # Log writers waiting longer than this (seconds)
+
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size={}'.format(MMAP_SIZE),
+    'PRAGMA cache_size=-{}'.format(CACHE_SIZE_KIB),
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout={}'.format(BUSY_TIMEOUT_MS)
+    ]
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_edm_device_created_at_desc ON energy_device_measures (energy_device_id, created_at DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_charge_rfid_start_time_desc ON charge_session (rfid, start_time DESC)'
+    ]
+
+# The default rows of db/sql/schema-01.sql, keep in sync
+DEFAULT_CHARGER_ID = 'laadpaal_noord'
+SEED_ROWS = {
+    'users': [
+        { 'username': 'admin',
+          'password': 'pbkdf2:sha256:260000$XU6Oya4sFygvmTMg$c997b03bd810cbdb5521c2494b5e4f76bcd6d4db6eff996f5fd4c0ce7d1a127c',
+          'authenticated': True, 'shared_secret': '', 'enabled_2fa': False, 'enforce_local_2fa': True,
+          'avatar': 'unknown.png', 'web_auth_user_id': '' }
+        ],
+    'energy_device': [
+        { 'energy_device_id': DEFAULT_CHARGER_ID, 'port_name': 'dev/ttyUSB0', 'slave_address': 1, 'baudrate': 38400,
+          'bytesize': 8, 'parity': 'N', 'stopbits': 1, 'serial_timeout': 0.05, 'simulate': False, 'mode': 'rtu',
+          'close_port_after_each_call': False, 'modbus_config': 'SDM630v2', 'device_enabled': False }
+        ],
+    'rfid': [
+        { 'rfid': '000000000000', 'enabled': False }
+        ],
+    'charger_config': [
+        { 'charger_id': DEFAULT_CHARGER_ID, 'charger_name_text': DEFAULT_CHARGER_ID, 'charger_tariff': 0.41,
+          'secret_key': 'abcdefghijklmnopqrstuvwxyz1234567890',
+          'wtf_csrf_secret_key': 'abcdefghijklmnopqrstuvwxyz1234567890', 'use_reloader': False, 'factor_whkm': 162,
+          'autosession_enabled': True, 'autosession_minutes': 90, 'autosession_energy': 0.1,
+          'autosession_condense_same_odometer': True, 'pulseled_min': 3, 'pulseled_max': 98, 'gpio_mode': 'BCM',
+          'pin_led_red': 13, 'pin_led_green': 12, 'pin_led_blue': 16, 'pin_buzzer': 23,
+          'peakhours_offpeak_enabled': True, 'peakhours_allow_peak_one_period': False, 'pin_evse_switch': 5,
+          'pin_evse_led': 6, 'modbus_interval': 10, 'webcharge_on_dashboard': False, 'auth_webcharge': True,
+          'restrict_dashboard_access': False, 'restrict_menu': False, 'allow_local_dashboard_access': False,
+          'router_ip_address': '10.0.0.1', 'receipt_prefix': '00000', 'backup_enabled': False, 'backup_interval': 'd',
+          'backup_time_of_day': datetime.time(8, 0), 'backup_local_history': 5, 'os_backup_enabled': False,
+          'os_backup_type': '', 'smb_backup_username': '', 'smb_backup_password': '',
+          'smb_backup_servername_or_ip_address': '', 'smb_backup_service_name': '', 'smb_backup_remote_path': '',
+          'backup_interval_weekday': '[{}]'.format(', '.join(['false'] * 7)),
+          'backup_interval_calday': '[{}]'.format(', '.join(['false'] * 31)), 'os_backup_history': 5,
+          'backup_success_timestamp': datetime.datetime(1970, 1, 1), 'vehicle_data_on_dashboard': False,
+          'wakeup_vehicle_on_data_request': False, 'webauthn_expected_origin': '', 'behind_ssl_proxy': False }
+        ],
+    'off_peak_hours':
+        [ { 'weekday': weekday, 'description': description, 'off_peak_start': start, 'off_peak_end': end }
+            for weekday, description in [ ('Monday', 'Maandag'), ('Tuesday', 'Dinsdag'), ('Wednesday', 'Woensdag'),
+                                          ('Thursday', 'Donderdag'), ('Friday', 'Vrijdag') ]
+                for start, end in [ (datetime.time(0, 0), datetime.time(7, 0)), (datetime.time(23, 0), datetime.time(23, 59)) ]
+        ] +
+        [ { 'weekday': weekday, 'description': description, 'off_peak_start': datetime.time(0, 0),
+            'off_peak_end': datetime.time(23, 59) }
+            for weekday, description in [ ('Saturday', 'Zaterdag'), ('Sunday', 'Zondag') ]
+        ] +
+        [ { 'holiday_day': day, 'holiday_month': month, 'holiday_year': 2026, 'recurring': recurring,
+            'description': description, 'off_peak_start': datetime.time(0, 0), 'off_peak_end': datetime.time(23, 59) }
+            for day, month, description, recurring in [
+                (1, 1, 'Nieuwjaarsdag', True),
+                (6, 4, 'Tweede Paasdag 2026', False),
+                (27, 4, 'Koningsdag', True),
+                (14, 5, 'Hemelvaartsdag 2026', False),
+                (25, 5, 'Tweede Pinksterdag 2026', False),
+                (25, 12, 'Eerste Kerstdag', True),
+                (26, 12, 'Tweede Kerstdag', True) ]
+        ]
+    }
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+
+
+def is_sqlite_url(url:str=None) -> bool:
+    try:
+        return url is not None and make_url(url).get_backend_name() == SQLITE_BACKEND
+    except Exception:
+        return False
+
+
+def sqlite_database_path(url:str=None) -> str | None:
+    if not is_sqlite_url(url):
+        return None
+    return make_url(url).database
+
+
+class SqliteWriterQueue(object):
+    """
+        Serializes the write transactions of all threads in this process
+    """
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    writes = 0
+    waited = 0
+    maxWaitTime = 0
+    totalWaitTime = 0
+    maxHoldTime = 0
+    __acquiredAt = 0
+    __owner = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+
+
+    """
+        Returns False if the lock was not taken, because this thread already writes through another connection.
+        Waiting would deadlock, that writer goes through SQLite's busy handler instead.
+    """
+    def acquire(self) -> bool:
+        if self.__owner == threading.get_ident():
+            self.__logger.debug('acquire() - thread already holds the writer lock')
+            return False
+        start = time.monotonic()
+        if not self.__lock.acquire(blocking=False):
+            self.waited += 1
+            if not self.__lock.acquire(timeout=WRITER_WAIT_WARNING):
+                self.__logger.warning('acquire() - writer waiting for more than {}s'.format(WRITER_WAIT_WARNING))
+                self.__lock.acquire()
+        self.__owner = threading.get_ident()
+        wait = time.monotonic() - start
+        self.__acquiredAt = time.monotonic()
+        self.writes += 1
+        self.totalWaitTime += wait
+        self.maxWaitTime = max(self.maxWaitTime, wait)
+        return True
+
+
+    def release(self):
+        self.maxHoldTime = max(self.maxHoldTime, time.monotonic() - self.__acquiredAt)
+        self.__owner = None
+        self.__lock.release()
+
+
+    def diag(self) -> dict:
+        return {
+            "writes"            : self.writes,
+            "waited"            : self.waited,
+            "totalWaitTime"     : round(self.totalWaitTime, 3),
+            "maxWaitTime"       : round(self.maxWaitTime, 3),
+            "maxHoldTime"       : round(self.maxHoldTime, 3),
+            "locked"            : self.__lock.locked()
+            }
+
+
+writerQueue = SqliteWriterQueue()
+
+
+class WriterQueueConnection(sqlite3.Connection):
+    """
+        DBAPI connection releasing the writer lock after the transaction has been committed or rolled back. The lock is
+        taken on the first write statement of a transaction (before_cursor_execute).
+    """
+    holdsWriterLock = False
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self.releaseWriterLock()
+
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self.releaseWriterLock()
+
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.releaseWriterLock()
+
+
+    def acquireWriterLock(self):
+        if not self.holdsWriterLock:
+            self.holdsWriterLock = writerQueue.acquire()
+
+
+    def releaseWriterLock(self):
+        if self.holdsWriterLock:
+            self.holdsWriterLock = False
+            writerQueue.release()
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if isinstance(cursor.connection, WriterQueueConnection) and \
+       statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+        cursor.connection.acquireWriterLock()
+
+
+def create_sqlite_engine(url:str=None, pool_size:int=5, max_overflow:int=10, **kwargs):
+    engine = create_engine(
+                url,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=False,    # Local file, no connection to lose
+                **kwargs,
+                connect_args={
+                    'check_same_thread': False,
+                    'timeout': BUSY_TIMEOUT_MS / 1000,
+                    'factory': WriterQueueConnection
+                    }
+                )
+    event.listen(engine, 'connect', _set_pragmas)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    return engine
+
+
+def create_sqlite_indexes(engine):
+    with engine.begin() as connection:
+        for index in INDEXES:
+            connection.execute(text(index))
+
+
+"""
+    Insert the default rows (SEED_ROWS) if the database has no charger configuration yet, a new database file.
+    Returns True if seeded.
+"""
+def seed_sqlite_database(engine, metadata) -> bool:
+    chargerConfig = metadata.tables['charger_config']
+    with engine.begin() as connection:
+        if connection.execute(select(func.count()).select_from(chargerConfig)).scalar() > 0:
+            return False
+        now = datetime.datetime.now()
+        for tableName, rows in SEED_ROWS.items():
+            table = metadata.tables[tableName]
+            for row in rows:
+                row = dict(row)
+                for column in ('created_at', 'modified_at'):
+                    if column in table.columns and column not in row:
+                        row[column] = now
+                connection.execute(table.insert(), row)
+    return True
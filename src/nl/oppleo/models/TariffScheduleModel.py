@@ -0,0 +1,102 @@
+from typing import ClassVar
+import logging
+
+from sqlalchemy import Column, Integer, Boolean, String, Float, DateTime, orm, inspect
+from sqlalchemy.exc import InvalidRequestError
+
+from nl.oppleo.models.Base import Base, DbSession
+from nl.oppleo.exceptions.Exceptions import DbException
+from nl.oppleo.services.ChangeBus import ChangeBus
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+    Time-of-use tariffs (db/sql/schema-04.sql)
+        off_peak    True for the off peak windows of off_peak_hours, False for the other hours
+        tariff      €/kWh
+        valid_from  the row with the latest valid_from at or before a moment applies, NULL applies from the beginning
+    Without rows the sessions are priced at their flat tariff.
+"""
+
+class TariffScheduleModel(Base):
+    __logger: ClassVar[logging.Logger] = logging.getLogger(f"{__name__}.{__qualname__}")
+    __tablename__ = 'tariff_schedule'
+
+    id = Column(Integer, primary_key=True)
+    off_peak = Column(Boolean, nullable=False)
+    tariff = Column(Float, nullable=False)      # €/kWh
+    valid_from = Column(DateTime)
+    description = Column(String(100))
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+
+    # sqlalchemy calls __new__ not __init__ on reconstructing from database. Decorator to call this method
+    @orm.reconstructor
+    def init_on_load(self):
+        self.__init__()
+
+    def set(self, data):
+        for key in data:
+            setattr(self, key, data.get(key))
+
+    def save(self):
+        try:
+            with DbSession() as db_session:
+                db_session.add(self)
+                db_session.commit()
+
+                for attr in inspect(self).mapper.column_attrs:
+                    getattr(self, attr.key)
+                db_session.expunge(self)
+        except InvalidRequestError as e:
+            self.__logger.error("Could not save to {} table in database".format(self.__tablename__ ), exc_info=True)
+        except Exception as e:
+            self.__logger.error("Could not save to {} table in database".format(self.__tablename__ ), exc_info=True)
+            raise DbException("Could not save to {} table in database".format(self.__tablename__ ))
+        ChangeBus().publish(ChangeBus.TOPIC_TARIFF_SCHEDULE, id=self.id)
+
+
+    def delete(self):
+        try:
+            with DbSession() as db_session:
+                db_session.delete(self)
+                db_session.commit()
+        except InvalidRequestError as e:
+            self.__logger.error("Could not delete from {} table in database".format(self.__tablename__ ), exc_info=True)
+        except Exception as e:
+            self.__logger.error("Could not delete from {} table in database".format(self.__tablename__ ), exc_info=True)
+            raise DbException("Could not delete from {} table in database".format(self.__tablename__ ))
+        ChangeBus().publish(ChangeBus.TOPIC_TARIFF_SCHEDULE, id=self.id)
+
+
+    @staticmethod
+    def get_all():
+        try:
+            with DbSession() as db_session:
+                all_rows = db_session.query(TariffScheduleModel) \
+                                     .all()
+                for row in all_rows:
+                    if row is not None:
+                        for attr in inspect(TariffScheduleModel).mapper.column_attrs:
+                            getattr(row, attr.key)
+                        db_session.expunge(row)
+                return all_rows
+        except InvalidRequestError as e:
+            TariffScheduleModel.__logger.error("Could not query from {} table in database".format(TariffScheduleModel.__tablename__ ), exc_info=True)
+        except Exception as e:
+            # Nothing to roll back
+            TariffScheduleModel.__logger.error("Could not query from {} table in database".format(TariffScheduleModel.__tablename__ ), exc_info=True)
+            raise DbException("Could not query from {} table in database".format(TariffScheduleModel.__tablename__ ))
+
+
+    def to_dict(self) -> dict:
+        return {
+            "id"            : self.id,
+            "off_peak"      : self.off_peak,
+            "tariff"        : self.tariff,
+            "valid_from"    : None if self.valid_from is None else self.valid_from.strftime("%d/%m/%Y, %H:%M:%S"),
+            "description"   : self.description
+            }
@@ -1,6 +1,7 @@
 from typing import ClassVar, Union
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import orm, Column, String, Boolean, inspect
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.exc import InvalidRequestError
 
 import logging
@@ -79,6 +80,13 @@ class User(Base):
             self.__logger.error("Could not commit to {} table in database".format(self.__tablename__ ), exc_info=True)
             raise DbException("Could not commit to {} table in database".format(self.__tablename__ ))
 
+    def detached_copy(self):
+        user = User()
+        for attr in inspect(User).mapper.column_attrs:
+            setattr(user, attr.key, getattr(self, attr.key))
+        make_transient_to_detached(user)
+        return user
+
     @property
     def is_active(self):
         """True, as all users are active."""
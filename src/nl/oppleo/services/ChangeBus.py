@@ -0,0 +1,83 @@
+import logging
+import threading
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ In-process publish/ subscribe bus for config and model changes.
+
+ The model save paths publish a topic after a change has been committed, threads subscribe to the topics they
+ depend on instead of polling the database for changes. The settings routes change the config through OppleoConfig,
+ which saves through ChargerConfigModel, and therefore reach the bus as TOPIC_CHARGER_CONFIG.
+
+ Callbacks run synchronously in the publishing thread (often a web request), keep them short: set a flag or an
+ event and handle the change in the subscriber's own thread. An exception in a callback is logged and does not
+ reach the publisher or the other subscribers.
+
+ Topics
+    TOPIC_CHARGER_CONFIG    charger_config columns changed, details { 'keys': [column, ...] }
+    TOPIC_ENERGY_DEVICE     energy_device row saved, duplicated or deleted, details { 'energy_device_id': id }
+    TOPIC_OFF_PEAK_HOURS    off_peak_hours entry added, changed or deleted, details { 'id': id }
+    TOPIC_TARIFF_SCHEDULE   tariff_schedule entry added, changed or deleted, details { 'id': id }
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class ChangeBus(object, metaclass=Singleton):
+    TOPIC_CHARGER_CONFIG    = 'charger_config'
+    TOPIC_ENERGY_DEVICE     = 'energy_device'
+    TOPIC_OFF_PEAK_HOURS    = 'off_peak_hours'
+    TOPIC_TARIFF_SCHEDULE   = 'tariff_schedule'
+
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    # topic -> [callback(topic:str, details:dict), ...]
+    __subscribers = None
+    __published = 0
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__subscribers = {}
+
+
+    def subscribe(self, topic:str=None, callback=None):
+        if topic is None or callback is None:
+            return
+        with self.__lock:
+            callbacks = self.__subscribers.get(topic, [])
+            if callback not in callbacks:
+                # Copy on write, publish() iterates without lock
+                self.__subscribers[topic] = callbacks + [ callback ]
+        self.__logger.debug('subscribe() - topic {}'.format(topic))
+
+
+    def unsubscribe(self, topic:str=None, callback=None):
+        with self.__lock:
+            self.__subscribers[topic] = [ cb for cb in self.__subscribers.get(topic, []) if cb != callback ]
+
+
+    def publish(self, topic:str=None, **details):
+        self.__published += 1
+        callbacks = self.__subscribers.get(topic, [])
+        self.__logger.debug('publish() - topic {} to {} subscriber(s) details {}'.format(topic, len(callbacks), details))
+        for callback in callbacks:
+            try:
+                callback(topic, details)
+            except Exception as e:
+                self.__logger.error('publish() - subscriber of topic {} failed'.format(topic), exc_info=True)
+
+
+    def diag(self) -> dict:
+        return {
+            "published"     : self.__published,
+            "subscribers"   : { topic: len(callbacks) for topic, callbacks in dict(self.__subscribers).items() }
+            }
@@ -7,7 +7,7 @@ from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.config.OppleoConfig import OppleoConfig
 from nl.oppleo.services.EvseState import EvseState, EvseStateName
 from nl.oppleo.utils.ModulePresence import modulePresence
-from nl.oppleo.models.ChargeSessionModel import ChargeSessionModel
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
 
 oppleoSystemConfig = OppleoSystemConfig()
 oppleoConfig = OppleoConfig()
@@ -54,7 +54,7 @@ class EvseReaderSimulate(object):
         self.__logger.warning('Simulated Evse Read loop!')
         while not cb_until():
 
-            self.__openSession = ChargeSessionModel.getOpenChargeSession(oppleoConfig.chargerID)
+            self.__openSession = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
 
             if self.__openSession is None and self.__current_state != EvseState.EVSE_STATE_INACTIVE:
                 self.__logger.warning('SIMULATE EVSE state change to INACTIVE!')
@@ -5,7 +5,7 @@ import json
 from enum import Enum
 import threading
 import time
-from queue import Queue
+from collections import deque
 
 from nl.oppleo.config.ChangeLog import changeLog
 from nl.oppleo.models.Raspberry import Raspberry
@@ -17,14 +17,16 @@ from paho.mqtt import client as mqtt_client #, MQTTMessageInfo
 from paho.mqtt.client import MQTTMessageInfo, MQTTv311, MQTTv5
 
 from nl.oppleo.utils.OutboundEvent import OutboundEvent
+from nl.oppleo.utils.PayloadSerializer import Payload
 
 from nl.oppleo.models.RfidModel import RfidModel
-from nl.oppleo.models.ChargeSessionModel import ChargeSessionModel
 from nl.oppleo.models.EnergyDeviceModel import EnergyDeviceModel
 from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel
 
 from nl.oppleo.services.EvseState import EvseState, EvseStateName
 from nl.oppleo.services.EvseOutput import EvseOutput
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
+from nl.oppleo.services.RfidCache import RfidCache
 
 
 """
@@ -46,6 +48,24 @@ class Singleton(type):
 
 class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
     __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    # Measurement fields and their Home Assistant names
+    __MEASUREMENT_NAMES = { "energy_device_id": "EnergyDeviceID",
+                            "created_at": "Timestamp",
+                            "kwh_l1": "E1",
+                            "kwh_l2": "E2",
+                            "kwh_l3": "E3",
+                            "a_l1": "A1",
+                            "a_l2": "A2",
+                            "a_l3": "A3",
+                            "p_l1": "P1",
+                            "p_l2": "P2",
+                            "p_l3": "P3",
+                            "v_l1": "V1",
+                            "v_l2": "V2",
+                            "v_l3": "V3",
+                            "kw_total": "TotalEnergy",
+                            "hz": "Frequency"
+                    }
     # functional syntax
     STATES = Enum('Status', ['CONNECTED', 'DISCONNECTED', 'CONNECT_FAILED', 'UNREACHABLE', 'NOT_AUTHORIZED', 'OTHER'])
     state = Enum('Status', ['OTHER']).OTHER
@@ -64,8 +84,25 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
     __threadLock = None
     __reconnectRequested = False
     __stateTopic = None
-    # Create an emit queue, for other Threads to communicate to th ews emit background task
-    __mqttMsgQueue = None
+    # Values changed since the last publish, and when the oldest of them came in (time.monotonic())
+    __pending = None
+    __pendingSince = None
+    # Values as last published, only what differs is published again
+    __published = None
+    __stateLock = None
+    # Set on new state, wakes the loop
+    __wake = None
+    # Entities on topics of their own, as announced by the last auto discover
+    __perEntityTopics = False
+    # Seconds to let a burst of updates (session start, status, energy) coalesce into one publish
+    __COALESCE_DELAY = 0.05
+    # Seconds between the connection checks while connected and idle
+    __IDLE_INTERVAL = 5
+    __updates = 0
+    __coalesced = 0
+    __unchanged = 0
+    __publishes = 0
+    __latencies = None
     __triggerAutoDiscover = False
     __haItems = []
     __selectedToken = None
@@ -86,7 +123,11 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
         self.__stop_event = threading.Event()
 
         self.__most_recent_state = dict()
-        self.__mqttMsgQueue = Queue()
+        self.__pending = dict()
+        self.__published = dict()
+        self.__stateLock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__latencies = deque(maxlen=100)
         self.state = self.STATES.OTHER
 
 
@@ -176,8 +217,8 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
                         with self.__threadLock:
                             self.__triggerMostRecent = False
                         self.__sync_open_session()
-                        # json.dumps(s, default=str) -- overcomes "TypeError: Object of type 'datetime' is not JSON serializable"
-                        self.__publish__(topic=self.__stateTopic, message=json.dumps(self.__most_recent_state, default=str), notify=False)
+                        # Home Assistant (re)started or (re)connected, all values
+                        self.__flush(full=True)
                         # TODO
                         # Re-trigger last Modbus Read
                         energyDeviceMeasureModel = EnergyDeviceMeasureModel()
@@ -194,11 +235,7 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
                         else:
                             self.sessionUpdate(evse_state=EvseState.EVSE_STATE_INACTIVE)
 
-                    if not self.__mqttMsgQueue.empty():
-                        # Blocking call, make sure there is a message to obtain
-                        msg = self.__mqttMsgQueue.get()
-                        # json.dumps(s, default=str) -- overcomes "TypeError: Object of type 'datetime' is not JSON serializable"
-                        self.__publish__(topic=self.__stateTopic, message=json.dumps(msg, default=str), notify=False)
+                    self.__flush()
 
             else:
                 self.__logger.debug("HomeAssistant MQTT Broker connection not enabled.")
@@ -227,8 +264,10 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
 
 
 
-            # Sleep to allow other threads
-            time.sleep(0.75)
+            # Sleep until there is new state to publish
+            if self.__wake.wait(timeout=self.__IDLE_INTERVAL if self.isConnected else 0.75):
+                time.sleep(self.__COALESCE_DELAY)
+            self.__wake.clear()
         self.__logger.warning("HomeAssistant MQTT Broker connect Thread stopping...")
 
 
@@ -237,11 +276,13 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
         #if self.__thread is not None:
         #    self.__thread.stop()
         self.__stop_event.set()
+        self.__wake.set()
 
     # Call reconnect if configuration is changed
     def reconnect(self):
         with self.__threadLock:
             self.__reconnectRequested = True
+        self.__wake.set()
 
 
     # https://stackoverflow.com/questions/36093078/mqtt-is-there-a-way-to-check-if-the-client-is-still-connected
@@ -412,11 +453,12 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
                 homeAssistantMqttHandlerThread.__logger.debug("HomeAssistant MQTT Broker - Request to switch token to {rToken}...".format(rToken=message.payload.decode("utf-8")))
 
                 # Check if there was a charge session active when Oppleo was stopped.
-                openChargeSession = ChargeSessionModel.getOpenChargeSession(device=oppleoConfig.chargerID)
+                openChargeSession = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
                 if openChargeSession is not None:
                     # A session is active, the token cannot be switched - switch back
                     homeAssistantMqttHandlerThread.__logger.warning("HomeAssistant MQTT Broker - cannot switch to token {rToken} during active charge session.".format(rToken=message.payload.decode("utf-8")))
-                    homeAssistantMqttHandlerThread.publish({'Token': (openChargeSession.rfid.name if openChargeSession.rfid.name != None and openChargeSession.rfid.name != "" else openChargeSession.rfid.rfid)})
+                    rfid = RfidCache().get(openChargeSession.rfid)
+                    homeAssistantMqttHandlerThread.publish({'Token': openChargeSession.rfid if rfid is None else (rfid.name if rfid.name != None and rfid.name != "" else rfid.rfid)})
                     return
                 
                 # No active charge session - Find the selected Token
@@ -494,11 +536,13 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
     def triggerAutoDiscover(self) -> None:
         with self.__threadLock:
             self.__triggerAutoDiscover = True
+        self.__wake.set()
 
 
     def triggerMostRecent(self) -> None:
         with self.__threadLock:
             self.__triggerMostRecent = True
+        self.__wake.set()
 
 
     def __sendAutoDiscover(self) -> bool:
@@ -514,6 +558,7 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
 
         # (Re)define the items for AutoDiscovery
         self.__defineHomeAssistanceItems__()
+        self.__perEntityTopics = oppleoSystemConfig.homeAssistantMqttPerEntityTopics
 
         for item in self.__haItems:
             uniqueId = self.object_id + "_" + item["name"]
@@ -524,11 +569,13 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
             msg['name'] = item["name"]
             # States
             if item['component'] in ["sensor"]:
-                msg['state_topic'] = self.discovery_prefix + '/' + item['component'] + '/' + self.object_id + '/state'
+                msg['state_topic'] = self.discovery_prefix + '/' + item['component'] + '/' + self.object_id + '/state' \
+                                        if not self.__perEntityTopics else self.__entityStateTopic(item["name"])
             # Commands
             if item['component'] in ["select"]:
                 msg['command_topic'] = self.discovery_prefix + '/' + item['component'] + '/' + uniqueId + '/select'
-                msg['state_topic'] = self.discovery_prefix + '/' + 'sensor' + '/' + self.object_id + '/state'
+                msg['state_topic'] = self.discovery_prefix + '/' + 'sensor' + '/' + self.object_id + '/state' \
+                                        if not self.__perEntityTopics else self.__entityStateTopic(item["name"])
             
             msg['unique_id'] = uniqueId
             if "icon" in item:
@@ -540,7 +587,7 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
             if "state_class" in item:
                 msg['state_class'] = item["state_class"]
 
-            msg['value_template'] = "{{ value_json."+item["name"]+" }}"
+            msg['value_template'] = "{{ value_json."+item["name"]+" }}" if not self.__perEntityTopics else "{{ value }}"
             if "options" in item:
                 msg['options'] = item["options"]
 
@@ -585,24 +632,82 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
     
 
   
+    """
+        Merges the values into the state and wakes the loop to publish the values that changed. Updates arriving before
+        the loop publishes are coalesced, a value set back to what was published last is not published at all.
+    """
     def publish(self, values:dict=None) -> None:
         self.__logger.debug("Sending status update messages to HomeAssistant MQTT Broker...")
 
-        # Maintain the most recent values
-        # Python 3.10
-        # self.__most_recent_state = self.__most_recent_state | values
-        # Python < 3.10
-        self.__most_recent_state = {k: v for d in [self.__most_recent_state, values] for k, v in d.items()}
+        with self.__stateLock:
+            # Maintain the most recent values
+            # Python 3.10
+            # self.__most_recent_state = self.__most_recent_state | values
+            # Python < 3.10
+            self.__most_recent_state = {k: v for d in [self.__most_recent_state, values] for k, v in d.items()}
+            self.__updates += 1
+            wasPending = len(self.__pending) > 0
+            changed = False
+            for key, value in values.items():
+                if key in self.__published and self.__published[key] == value:
+                    self.__pending.pop(key, None)
+                else:
+                    self.__pending[key] = value
+                    changed = True
+            if not changed:
+                self.__unchanged += 1
+            if len(self.__pending) == 0:
+                self.__pendingSince = None
+                return
+            if wasPending:
+                self.__coalesced += 1
+            else:
+                self.__pendingSince = time.monotonic()
+        self.__wake.set()
+
+
+    def __entityStateTopic(self, name:str) -> str:
+        return self.discovery_prefix + '/sensor/' + self.object_id + '_' + name + '/state'
+
+
+    """
+        Publishes the pending values, or all values when full. On one state topic every publish carries all values (the
+        sensors share the topic), per entity only the changed entities are published, retained.
+    """
+    def __flush(self, full:bool=False) -> None:
+        if not self.isConnected:
+            # Stays pending
+            return
+        with self.__stateLock:
+            values = dict(self.__most_recent_state) if full else self.__pending
+            pendingSince = self.__pendingSince
+            self.__pending = dict()
+            self.__pendingSince = None
+            state = dict(self.__most_recent_state)
+        if len(values) == 0:
+            return
+
+        if self.__perEntityTopics:
+            sensors = [ item["name"] for item in self.__haItems if item['component'] in ["sensor"] ]
+            for name, value in values.items():
+                if name in sensors:
+                    self.__publish__(topic=self.__entityStateTopic(name), message=str(value), retain=True, notify=False)
+        else:
+            # json.dumps(s, default=str) -- overcomes "TypeError: Object of type 'datetime' is not JSON serializable"
+            self.__publish__(topic=self.__stateTopic, message=json.dumps(state, default=str), notify=False)
 
-        if self.__mqttMsgQueue is not None:
-            self.__mqttMsgQueue.put( self.__most_recent_state )
+        with self.__stateLock:
+            self.__published.update(values)
+            self.__publishes += 1
+        if pendingSince is not None:
+            self.__latencies.append(time.monotonic() - pendingSince)
 
 
 
     """
         timeout in ms
     """
-    def __publish__(self, topic:str='homeassistant', message:str=None, waitForPublish:bool=False, timeout:int=1000, notify:bool=True) -> bool:
+    def __publish__(self, topic:str='homeassistant', message:str=None, waitForPublish:bool=False, timeout:int=1000, notify:bool=True, retain:bool=False) -> bool:
         global oppleoConfig
 
         self.__logger.debug(f'Publish msg {message} to HomeAssistant topic {topic} ... ')
@@ -624,7 +729,7 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
         data['message'] = message
         is_published = False
         try:
-            homeAssistantMqttMessageInfo = self.mqttClient.publish(topic=topic, payload=message)
+            homeAssistantMqttMessageInfo = self.mqttClient.publish(topic=topic, payload=message, retain=retain)
             if notify:
                 OutboundEvent.triggerEvent(
                     event='ha_mqtt_message_send', 
@@ -641,42 +746,22 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
         return is_published
 
 
-    # Callback from MeasureElectricityUsageThread with updated EnergyDeviceMeasureModel
-    def energyUpdate(self, device_measurement:EnergyDeviceMeasureModel=None):
+    # From the HomeAssistantSink with the measurement dict (status_update), or with an EnergyDeviceMeasureModel
+    def energyUpdate(self, device_measurement:EnergyDeviceMeasureModel|dict=None):
         self.__logger.debug('.energyUpdate() callback...')
 
-        # convert into JSON:
-        measurement = device_measurement.to_dict()
-        translation = { "energy_device_id": "EnergyDeviceID",
-                        "created_at": "Timestamp",
-                        "kwh_l1": "E1",
-                        "kwh_l2": "E2",
-                        "kwh_l3": "E3",
-                        "a_l1": "A1",
-                        "a_l2": "A2",
-                        "a_l3": "A3",
-                        "p_l1": "P1",
-                        "p_l2": "P2",
-                        "p_l3": "P3",
-                        "v_l1": "V1",
-                        "v_l2": "V2",
-                        "v_l3": "V3",
-                        "kw_total": "TotalEnergy",
-                        "hz": "Frequency"
-                }
+        # The payload shared with the other consumers, with the raw values
+        measurement = device_measurement if isinstance(device_measurement, dict) else device_measurement.payload()
         translated_measurement = {}
-        for item, value in translation.items():
+        for item, value in HomeAssistantMqttHandlerThread.__MEASUREMENT_NAMES.items():
             translated_measurement[value] = measurement[item]
 
+        if isinstance(measurement, Payload) and measurement.values is not None:
+            power = sum(measurement.values.get(phase) or 0.0 for phase in ('p_l1', 'p_l2', 'p_l3'))
+        else:
+            power = sum(float(measurement[phase]) for phase in ('p_l1', 'p_l2', 'p_l3') if phase in measurement)
         translated_measurement['ChargeSpeed'] = str(round( 
-                    (
-                        (
-                            (float(measurement['p_l1']) if 'p_l1' in measurement else 0.0) +
-                            (float(measurement['p_l2']) if 'p_l2' in measurement else 0.0) +
-                            (float(measurement['p_l3']) if 'p_l3' in measurement else 0.0)
-                        )
-                        / oppleoConfig.factorWhkm
-                    ),
+                    power / oppleoConfig.factorWhkm,
                     1   # 1 decimal
                 ))
 
@@ -725,49 +810,53 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
     def __sync_open_session(self):
         self.__logger.debug('.__sync_open_session()')
 
+        sessionState = {}
         # Get session info or reset
-        openSession = ChargeSessionModel.getOpenChargeSession(oppleoConfig.chargerID)
+        openSession = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
         if openSession is not None:
             self.__logger.debug('Open session: {}'.format(openSession.to_str()))
-            rfid = RfidModel.get_one(rfid=openSession.rfid)
+            rfid = RfidCache().get(openSession.rfid)
             # Open session
-            self.__most_recent_state['Status'] = 'Waiting'
-            self.__most_recent_state['StartTime'] = openSession.start_time
-            self.__most_recent_state['StartValue'] = openSession.start_value
-            self.__most_recent_state['EndValue'] = openSession.end_value
-            self.__most_recent_state['EnergyDeviceID'] = openSession.energy_device_id
-            self.__most_recent_state['km'] = openSession.km
-            self.__most_recent_state['Energy'] = openSession.total_energy
-            self.__most_recent_state['Cost'] = openSession.total_price
-            self.__most_recent_state['Trigger'] = openSession.trigger
-            self.__most_recent_state['Tariff'] = openSession.tariff
-            self.__most_recent_state['Token'] = rfid.name if rfid.name != None and rfid.name != "" else rfid.rfid
-            self.__most_recent_state['Charging'] = False
-            self.__most_recent_state['EVSE'] = "TBD"
-            self.__most_recent_state['SessionId'] = openSession.id
+            sessionState['Status'] = 'Waiting'
+            sessionState['StartTime'] = openSession.start_time
+            sessionState['StartValue'] = openSession.start_value
+            sessionState['EndValue'] = openSession.end_value
+            sessionState['EnergyDeviceID'] = openSession.energy_device_id
+            sessionState['km'] = openSession.km
+            sessionState['Energy'] = openSession.total_energy
+            sessionState['Cost'] = openSession.total_price
+            sessionState['Trigger'] = openSession.trigger
+            sessionState['Tariff'] = openSession.tariff
+            sessionState['Token'] = openSession.rfid if rfid is None else (rfid.name if rfid.name != None and rfid.name != "" else rfid.rfid)
+            sessionState['Charging'] = False
+            sessionState['EVSE'] = "TBD"
+            sessionState['SessionId'] = openSession.id
 
         else:
             self.__logger.debug('No open session')
             # No charge session
-            self.__most_recent_state['Status'] = 'No active session'
-            self.__most_recent_state['StartTime'] = ''
-            self.__most_recent_state['StartValue'] = 0
-            self.__most_recent_state['EndValue'] = 0
-            self.__most_recent_state['EnergyDeviceID'] = oppleoConfig.chargerID
-            self.__most_recent_state['km'] = 0
-            self.__most_recent_state['Energy'] = 0
-            self.__most_recent_state['Cost'] = 0
-            self.__most_recent_state['Trigger'] = '-'
-            self.__most_recent_state['Tariff'] = 0
-            self.__most_recent_state['Token'] = ''
-            self.__most_recent_state['Charging'] = False
-            self.__most_recent_state['EVSE'] = ''
-            self.__most_recent_state['SessionId'] = None
-
-        self.__most_recent_state['OffPeak'] = oppleoConfig.offpeakEnabled
+            sessionState['Status'] = 'No active session'
+            sessionState['StartTime'] = ''
+            sessionState['StartValue'] = 0
+            sessionState['EndValue'] = 0
+            sessionState['EnergyDeviceID'] = oppleoConfig.chargerID
+            sessionState['km'] = 0
+            sessionState['Energy'] = 0
+            sessionState['Cost'] = 0
+            sessionState['Trigger'] = '-'
+            sessionState['Tariff'] = 0
+            sessionState['Token'] = ''
+            sessionState['Charging'] = False
+            sessionState['EVSE'] = ''
+            sessionState['SessionId'] = None
+
+        sessionState['OffPeak'] = oppleoConfig.offpeakEnabled
+
+        self.publish(values=sessionState)
 
 
     def diag(self):
+        latencies = list(self.__latencies)
         return json.dumps({
             "state": "-" if self.state is None else self.state.name,
             "discovery_prefix": "-" if self.discovery_prefix is None else self.discovery_prefix,
@@ -784,7 +873,19 @@ class HomeAssistantMqttHandlerThread(object, metaclass=Singleton):
             "__triggerAutoDiscover": self.__triggerAutoDiscover,
             "__stateTopic": "-" if self.__stateTopic is None else self.__stateTopic,
             "__reconnectRequested": self.__reconnectRequested,
-            "__most_recent_state": self.__most_recent_state
+            "__most_recent_state": self.__most_recent_state,
+            "perEntityTopics": self.__perEntityTopics,
+            "queueDepth": len(self.__pending),
+            "pendingForMs": 0 if self.__pendingSince is None else round((time.monotonic() - self.__pendingSince) * 1000, 1),
+            "updates": self.__updates,
+            "coalesced": self.__coalesced,
+            "unchanged": self.__unchanged,
+            "publishes": self.__publishes,
+            "publishLatencyMs": {
+                "last": round(latencies[-1] * 1000, 1) if len(latencies) > 0 else None,
+                "avg": round(sum(latencies) / len(latencies) * 1000, 1) if len(latencies) > 0 else None,
+                "max": round(max(latencies) * 1000, 1) if len(latencies) > 0 else None
+                }
             }, 
             default=str     # Overcome "TypeError: Object of type datetime is not JSON serializable"
         )
@@ -0,0 +1,71 @@
+import copy
+import logging
+import threading
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.KeyValueStoreModel import KeyValueStoreModel
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Read-through cache of key value store scopes, as { key: value } dicts.
+
+ Used by the vehicle api wrappers (teslapy, pypolestar) that load their token cache from a scope on every token
+ access. A scope is read from the database once, writes go through put_scope() which upserts the scope in one
+ transaction and only when it actually changed.
+
+ get_scope() returns a (deep) copy, the caller can modify it freely.
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class KeyValueStoreCache(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    # (kvstore, scope) -> { key: value }
+    __scopes = None
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__scopes = {}
+
+
+    def get_scope(self, kvstore:str=None, scope:str=None) -> dict:
+        with self.__lock:
+            values = self.__scopes.get((kvstore, scope))
+            if values is None:
+                kvsm = KeyValueStoreModel.get_scope(kvstore=kvstore, scope=scope)
+                values = { kvobj.key: kvobj.value for kvobj in (kvsm if kvsm is not None else []) }
+                self.__scopes[(kvstore, scope)] = values
+                self.__logger.debug('get_scope() - loaded kvstore={} scope={} ({} keys)'.format(kvstore, scope, len(values)))
+            return copy.deepcopy(values)
+
+
+    """
+        Make the stored scope equal to values. No database access if nothing changed.
+    """
+    def put_scope(self, kvstore:str=None, scope:str=None, values:dict=None):
+        values = values if values is not None else {}
+        with self.__lock:
+            if self.__scopes.get((kvstore, scope)) == values:
+                return
+            try:
+                KeyValueStoreModel.upsert_scope(kvstore=kvstore, scope=scope, values=values, delete_missing=True)
+            except Exception:
+                # State in the database unknown, load again on next use
+                self.__scopes.pop((kvstore, scope), None)
+                raise
+            self.__scopes[(kvstore, scope)] = copy.deepcopy(values)
+            self.__logger.debug('put_scope() - stored kvstore={} scope={} ({} keys)'.format(kvstore, scope, len(values)))
+
+
+    def invalidate(self, kvstore:str=None, scope:str=None):
+        with self.__lock:
+            self.__scopes.pop((kvstore, scope), None)
@@ -0,0 +1,158 @@
+import logging
+import threading
+from datetime import datetime
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.config.OppleoConfig import OppleoConfig
+from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel
+from nl.oppleo.services.EvseOutput import EvseOutput
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
+from nl.oppleo.services.RfidCache import RfidCache
+from nl.oppleo.utils.PayloadSerializer import timestamp_str
+
+oppleoSystemConfig = OppleoSystemConfig()
+oppleoConfig = OppleoConfig()
+
+HTTP_CODE_200_OK                    = 200
+HTTP_CODE_404_NOT_FOUND             = 404
+
+"""
+ In-memory live state of the charger, pushed as one snapshot (live_state on /usage) to every websocket client on
+ connect. A dashboard connecting (or all of them reconnecting after a router reboot) renders from the snapshot instead
+ of asking /usage_data and /active_charge_session, no database query per client.
+
+ The LiveStateSink of the OutboundEventDispatcher folds the events carrying state that is not held in memory elsewhere
+ into the store:
+    status_update (/usage)                              latest measurement per energy device
+    vehicle_charge_status_update, _stopped              vehicle state
+ Until the first status_update the measurement is seeded from the database, on the first snapshot (retried on the next
+ snapshot if the query failed).
+ The flags are read when the snapshot is taken, as /active_charge_session does, not every change of those raises an
+ event: EVSE enabled, off peak (EvseOutput), EVSE state and charging (ChargerHandlerThread), off peak enabled and
+ allowed once (OppleoConfig). The open charge session is read from the OpenChargeSessionRegistry.
+
+ The snapshot has the fields of the /active_charge_session response, plus measurement and vehicle. Session, token and
+ vehicle details are only in the snapshot of authenticated clients, as with the events carrying them.
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class LiveStateStore(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    # The namespace and event of the snapshot
+    NAMESPACE = '/usage'
+    EVENT = 'live_state'
+    __lock = None
+    __seedLock = None
+    # energy_device_id -> measurement payload (PayloadSerializer.Payload)
+    __measurements = None
+    __vehicle = None
+    __seeded = False
+    __updatedAt = None
+    __updates = 0
+    __snapshots = 0
+    __seeds = 0
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__seedLock = threading.Lock()
+        self.__measurements = {}
+
+
+    """
+        Fold a dispatched event (the msg dict of the OutboundEventDispatcher) into the state
+    """
+    def update(self, msg:dict):
+        namespace = msg.get('namespace')
+        event = msg.get('event')
+        data = msg.get('data')
+        with self.__lock:
+            if namespace == '/usage' and event == 'status_update' and isinstance(data, dict):
+                self.__measurements[data.get('energy_device_id')] = data
+            elif namespace == '/charge_session' and event == 'vehicle_charge_status_update':
+                self.__vehicle = data
+            elif namespace == '/charge_session' and event == 'vehicle_charge_status_stopped':
+                self.__vehicle = None
+            else:
+                return
+            self.__updatedAt = datetime.now()
+            self.__updates += 1
+
+
+    """
+        The latest measurement from the database, if no status_update came in yet. The query runs outside the state
+        lock, the sink keeps delivering. Seeded once it succeeded.
+    """
+    def __seed(self):
+        with self.__seedLock:
+            if self.__seeded:
+                return
+            self.__seeds += 1
+            chargerID = oppleoConfig.chargerID
+            with self.__lock:
+                measured = chargerID in self.__measurements
+            if not measured:
+                try:
+                    lastSaved = EnergyDeviceMeasureModel().get_last_saved(energy_device_id=chargerID)
+                except Exception as e:
+                    self.__logger.warning('Could not seed the latest measurement, retrying on the next snapshot: {}'.format(str(e)))
+                    return
+                if lastSaved is not None:
+                    with self.__lock:
+                        # Unless a status_update came in meanwhile
+                        self.__measurements.setdefault(chargerID, lastSaved.payload())
+            self.__seeded = True
+
+
+    """
+        The snapshot of the state for a client, session, token and vehicle only if authenticated
+    """
+    def snapshot(self, auth:bool=False) -> dict:
+        if not self.__seeded:
+            self.__seed()
+        openChargeSession = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
+        rfid = None
+        if auth and openChargeSession is not None:
+            rfidModel = RfidCache().get(openChargeSession.rfid)
+            rfid = rfidModel.to_str() if rfidModel is not None else None
+        evseOutput = EvseOutput()
+        chThread = oppleoConfig.chThread
+        with self.__lock:
+            self.__snapshots += 1
+            return {
+                'status'            : HTTP_CODE_200_OK if openChargeSession is not None else HTTP_CODE_404_NOT_FOUND,
+                'id'                : oppleoConfig.chargerID,
+                'chargeSession'     : openChargeSession is not None,
+                'evseEnabled'       : True if evseOutput.is_enabled() else False,
+                'evseState'         : chThread.getEvseState() if chThread is not None else None,
+                'charging'          : True if chThread is not None and chThread.is_status_charging else False,
+                'offPeakEnabled'    : oppleoConfig.offpeakEnabled,
+                'offPeakAllowedOnce': oppleoConfig.allowPeakOnePeriod,
+                'offPeak'           : True if evseOutput.isOffPeak else False,
+                'auth'              : auth,
+                'data'              : openChargeSession.to_str() if auth and openChargeSession is not None else None,
+                'rfid'              : rfid,
+                'measurement'       : self.__measurements.get(oppleoConfig.chargerID),
+                'vehicle'           : self.__vehicle if auth and oppleoConfig.vehicleDataOnDashboard else None,
+                'updatedAt'         : timestamp_str(self.__updatedAt)
+                }
+
+
+    def diag(self) -> dict:
+        with self.__lock:
+            return {
+                "seeded"        : self.__seeded,
+                "seeds"         : self.__seeds,
+                "updates"       : self.__updates,
+                "snapshots"     : self.__snapshots,
+                "devices"       : list(self.__measurements.keys()),
+                "vehicle"       : self.__vehicle is not None,
+                "updatedAt"     : timestamp_str(self.__updatedAt)
+                }
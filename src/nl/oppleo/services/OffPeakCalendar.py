@@ -0,0 +1,187 @@
+import logging
+import threading
+from bisect import bisect_right
+from datetime import datetime, date, time, timedelta
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.OffPeakHoursModel import OffPeakHoursModel
+from nl.oppleo.services.ChangeBus import ChangeBus
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ The off_peak_hours table compiled into per-day interval lists.
+
+ Answers is_off_peak(ts) and next_transition(ts) from memory, without the weekday and holiday queries of
+ OffPeakHoursModel.is_off_peak(). The table is read once, and again after invalidate(). The calendar invalidates
+ itself when an off peak entry is added, changed or deleted (ChangeBus).
+
+ A day is a sorted list of merged, half-open [start, end) intervals in seconds since midnight. The off_peak_end
+ column is inclusive (to the second). An end at or after 23:59 closes the day, that is how the web interface
+ expresses 'until midnight'.
+"""
+
+SECONDS_PER_DAY = 24 * 60 * 60
+END_OF_DAY = time(hour=23, minute=59)
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class OffPeakCalendar(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    __compiled = False
+    # weekday (0 = Monday) -> [(start, end), ...]
+    __weekdays = None
+    # (year, month, day) -> [(start, end), ...]
+    __holidays = None
+    # (month, day) -> [(start, end), ...]
+    __recurring = None
+    # Look ahead for next_transition(), covers the recurring (yearly) holidays
+    horizonDays = 400
+    # Increments on every invalidate(), allows threads to detect a changed calendar
+    version = 0
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        ChangeBus().subscribe(ChangeBus.TOPIC_OFF_PEAK_HOURS, self.__offPeakHoursChanged)
+
+
+    def __offPeakHoursChanged(self, topic, details):
+        self.invalidate()
+
+
+    """
+        The off peak table changed, compile again on next use
+    """
+    def invalidate(self):
+        with self.__lock:
+            self.__compiled = False
+            self.version += 1
+        self.__logger.debug('invalidate() - version {}'.format(self.version))
+
+
+    def __compile(self):
+        with self.__lock:
+            if self.__compiled:
+                return
+            weekdays = {}
+            holidays = {}
+            recurring = {}
+            for entry in OffPeakHoursModel.get_all() or []:
+                interval = self.__toInterval(entry.off_peak_start, entry.off_peak_end)
+                if interval is None:
+                    continue
+                if entry.is_weekday():
+                    for weekday in range(7):
+                        if entry.is_day(weekday):
+                            weekdays.setdefault(weekday, []).append(interval)
+                elif entry.holiday_day is not None and entry.holiday_month is not None:
+                    if entry.recurring:
+                        recurring.setdefault((int(entry.holiday_month), int(entry.holiday_day)), []).append(interval)
+                    elif entry.holiday_year is not None:
+                        holidays.setdefault((int(entry.holiday_year), int(entry.holiday_month), int(entry.holiday_day)), []).append(interval)
+            self.__weekdays = { key: self.__merge(value) for key, value in weekdays.items() }
+            self.__holidays = { key: self.__merge(value) for key, value in holidays.items() }
+            self.__recurring = { key: self.__merge(value) for key, value in recurring.items() }
+            self.__compiled = True
+        self.__logger.debug('compile() - {} weekdays, {} holidays, {} recurring holidays'.format(
+                len(self.__weekdays), len(self.__holidays), len(self.__recurring)))
+
+
+    @staticmethod
+    def __toSeconds(t:time) -> int:
+        return t.hour * 3600 + t.minute * 60 + t.second
+
+
+    def __toInterval(self, start:time, end:time) -> tuple | None:
+        if isinstance(start, str):
+            start = time.fromisoformat(start)
+        if isinstance(end, str):
+            end = time.fromisoformat(end)
+        if start is None or end is None or start > end:
+            # Not matched by OffPeakHoursModel.is_off_peak() either
+            return None
+        return (self.__toSeconds(start), SECONDS_PER_DAY if end >= END_OF_DAY else self.__toSeconds(end) + 1)
+
+
+    @staticmethod
+    def __merge(intervals:list) -> list:
+        merged = []
+        for start, end in sorted(intervals):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+
+    """
+        Merged intervals for the date (weekday plus holiday entries)
+    """
+    def __intervals(self, day:date) -> list:
+        intervals = self.__weekdays.get(day.weekday(), [])
+        holiday = self.__holidays.get((day.year, day.month, day.day), []) + \
+                  self.__recurring.get((day.month, day.day), [])
+        if len(holiday) == 0:
+            return intervals
+        return self.__merge(intervals + holiday)
+
+
+    @staticmethod
+    def __inIntervals(intervals:list, seconds:int) -> bool:
+        index = bisect_right(intervals, (seconds, SECONDS_PER_DAY + 1)) -1
+        return index >= 0 and intervals[index][0] <= seconds < intervals[index][1]
+
+
+    def is_off_peak_now(self) -> bool:
+        return self.is_off_peak(datetime.now())
+
+
+    def is_off_peak(self, timestamp:datetime) -> bool:
+        if not isinstance(timestamp, datetime):
+            self.__logger.debug('is_off_peak() - timestamp is not of type datetime')
+            return False
+        self.__compile()
+        return self.__inIntervals(self.__intervals(timestamp.date()), self.__toSeconds(timestamp.time()))
+
+
+    """
+        Returns the first moment after timestamp where is_off_peak() changes, or None if that does not happen within
+        the horizon (no off peak hours configured)
+    """
+    def next_transition(self, timestamp:datetime) -> datetime | None:
+        if not isinstance(timestamp, datetime):
+            return None
+        self.__compile()
+        if len(self.__weekdays) == 0 and len(self.__holidays) == 0 and len(self.__recurring) == 0:
+            return None
+        day = timestamp.date()
+        seconds = self.__toSeconds(timestamp.time())
+        intervals = self.__intervals(day)
+        state = self.__inIntervals(intervals, seconds)
+        for _ in range(self.horizonDays):
+            # Within a day the state only changes at an interval boundary, between days at midnight
+            candidates = sorted({ 0 } | { boundary for interval in intervals for boundary in interval if boundary < SECONDS_PER_DAY })
+            for candidate in candidates:
+                if candidate > seconds and self.__inIntervals(intervals, candidate) != state:
+                    return datetime.combine(day, time()) + timedelta(seconds=candidate)
+            day = day + timedelta(days=1)
+            seconds = -1
+            intervals = self.__intervals(day)
+        return None
+
+
+    def diag(self) -> dict:
+        now = datetime.now()
+        return {
+            "version"           : self.version,
+            "isOffPeak"         : self.is_off_peak(now),
+            "nextTransition"    : self.next_transition(now)
+            }
@@ -0,0 +1,127 @@
+import logging
+import threading
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.ChargeSessionModel import ChargeSessionModel
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ In-memory registry of the open charge session per energy device.
+
+ The registry is authoritative for the open session once loaded. The start, end, condense, edit and delete paths
+ report their changes here, so the threads that only need to know the open session (energy updates, peak hours
+ monitor, Home Assistant) do not have to query the database for it.
+
+ Reading is lock-free. The registry never modifies a published session object, changes are published as a new
+ (detached) copy, replacing the previous one in a single dict assignment. Readers therefore always see a consistent
+ session, and should not modify the returned object themselves. Use update() or track() instead.
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class OpenChargeSessionRegistry(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    # energy_device_id -> ChargeSessionModel | None (None: loaded, no open session)
+    __sessions = None
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__sessions = {}
+
+
+    """
+        Returns the open charge session for the device, or None. Loads from the database only the first time a
+        device is requested (or after clear/refresh).
+    """
+    def get(self, device=None) -> ChargeSessionModel | None:
+        if device is None:
+            return None
+        try:
+            return self.__sessions[device]
+        except KeyError:
+            return self.refresh(device)
+
+
+    def has_open_session(self, device=None) -> bool:
+        return self.get(device) is not None
+
+
+    """
+        (Re)load the open charge session for the device from the database
+    """
+    def refresh(self, device=None) -> ChargeSessionModel | None:
+        if device is None:
+            return None
+        with self.__lock:
+            charge_session = ChargeSessionModel.get_open_charge_session_for_device(device)
+            self.__sessions[device] = charge_session
+        self.__logger.debug('refresh() - device {} open session {}'.format(device, None if charge_session is None else charge_session.id))
+        return charge_session
+
+
+    """
+        Report a saved charge session. Open sessions are published for their device, a closed session (or a session
+        moved to another device) is removed from where it was registered.
+    """
+    def track(self, charge_session:ChargeSessionModel=None):
+        if charge_session is None:
+            return
+        with self.__lock:
+            for device, registered in list(self.__sessions.items()):
+                if registered is not None and registered.id == charge_session.id and \
+                   (device != charge_session.energy_device_id or charge_session.end_time is not None):
+                    self.__sessions[device] = None
+            if charge_session.end_time is None:
+                self.__sessions[charge_session.energy_device_id] = charge_session.detached_copy()
+        self.__logger.debug('track() - charge session {} (open={})'.format(charge_session.id, charge_session.end_time is None))
+
+
+    """
+        Apply changed column values to the registered open session for the device (copy-on-write). Does not write to
+        the database, see ChargeSessionModel.update_columns()
+    """
+    def update(self, device=None, values:dict=None) -> ChargeSessionModel | None:
+        if device is None or values is None:
+            return None
+        with self.__lock:
+            registered = self.__sessions.get(device)
+            if registered is None:
+                return None
+            charge_session = registered.detached_copy(values=values)
+            self.__sessions[device] = charge_session if charge_session.end_time is None else None
+        return charge_session
+
+
+    """
+        A charge session was deleted
+    """
+    def forget(self, charge_session_id:int=None):
+        with self.__lock:
+            for device, registered in list(self.__sessions.items()):
+                if registered is not None and registered.id == charge_session_id:
+                    self.__sessions[device] = None
+
+
+    """
+        Drop everything, the next get() reloads from the database (for example after migrating sessions to a new
+        energy device id)
+    """
+    def clear(self):
+        with self.__lock:
+            self.__sessions = {}
+
+
+    def diag(self) -> dict:
+        return {
+            device: None if charge_session is None else charge_session.to_str()
+                for device, charge_session in dict(self.__sessions).items()
+            }
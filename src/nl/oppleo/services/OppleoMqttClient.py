@@ -1,4 +1,10 @@
+import json
 import logging
+import os
+import threading
+import time
+from collections import deque
+
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 
 from paho.mqtt import client as mqtt_client #, MQTTMessageInfo
@@ -6,6 +12,22 @@ from paho.mqtt.client import MQTTMessageInfo, MQTTv311, MQTTv5
 
 oppleoSystemConfig = OppleoSystemConfig()
 
+"""
+ MQTT client for the outbound events (OutboundEvent, MQTT sink) and push messages.
+
+ publish() never blocks on the broker. The connection is made with connect_async(), the paho network thread
+ (loop_start) connects and reconnects in the background with an exponential backoff (RECONNECT_MIN_DELAY up to
+ RECONNECT_MAX_DELAY seconds).
+
+ While not connected the messages are appended to a spool file next to the log file (one json line per message). On
+ (re)connect a replay thread publishes the spool in order, new messages are spooled behind it until it caught up. The
+ spool is bounded to mqttSpoolMaxBytes, the oldest messages are discarded when it grows beyond that.
+
+ The QoS of the messages is mqttQos (ini mqtt_qos). The time from publish() to the broker acknowledgement
+ (on_publish, for QoS 0 when handed to the socket) is tracked for diag().
+"""
+
+SPOOL_FILENAME = 'oppleo_mqtt_spool.jsonl'
 
 class Singleton(type):
     _instances = {}
@@ -15,68 +37,362 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class MqttSpool(object):
+    """
+        Size bounded json lines file, replayed from the offset in <spool>.offset. Truncating rewrites the file and
+        starts a new generation, offsets read before that do not apply to the new file.
+    """
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    spooled = 0
+    discarded = 0
+    generation = 0
+
+    def __init__(self, path:str, maxBytes:int):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.path = path
+        self.offsetPath = path + '.offset'
+        self.maxBytes = maxBytes
+        self.pending = self.__countPending()
+
+
+    def append(self, topic:str, payload:str, qos:int):
+        line = json.dumps({ 'topic': topic, 'payload': payload, 'qos': qos, 'ts': time.time() }) + '\n'
+        with self.__lock:
+            with open(self.path, 'a') as spoolFile:
+                spoolFile.write(line)
+            self.pending += 1
+            self.spooled += 1
+            if self.maxBytes > 0 and os.path.getsize(self.path) > self.maxBytes:
+                self.__truncate()
+
+
+    """
+        Keeps the newest messages, up to three quarters of maxBytes, so it does not truncate on every append
+    """
+    def __truncate(self):
+        offset = self.__readOffset()
+        with open(self.path, 'rb') as spoolFile:
+            spoolFile.seek(offset)
+            lines = spoolFile.readlines()
+        kept = deque()
+        size = 0
+        for line in reversed(lines):
+            if size + len(line) > self.maxBytes * 3 // 4:
+                break
+            kept.appendleft(line)
+            size += len(line)
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'wb') as spoolFile:
+            spoolFile.writelines(kept)
+        os.replace(tmpPath, self.path)
+        self.__writeOffset(0)
+        self.generation += 1
+        self.discarded += len(lines) - len(kept)
+        self.pending = len(kept)
+        self.__logger.warning('MQTT spool exceeded {} bytes, discarded the {} oldest messages'.format(
+                                self.maxBytes, len(lines) - len(kept)))
+
+
+    """
+        Returns up to count (record, offset after the record, generation) tuples from the replay offset
+    """
+    def read(self, count:int) -> list:
+        records = []
+        with self.__lock:
+            if not os.path.exists(self.path):
+                return records
+            offset = self.__readOffset()
+            with open(self.path, 'rb') as spoolFile:
+                spoolFile.seek(offset)
+                while len(records) < count:
+                    line = spoolFile.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        records.append((json.loads(line), offset, self.generation))
+                    except ValueError:
+                        self.__logger.error('Skipping unreadable MQTT spool record')
+        return records
+
+
+    """
+        Marks the records up to offset as replayed. Returns False if the spool was truncated since they were read, the
+        offset is not written then and the replay continues from the start of the truncated spool.
+    """
+    def committed(self, offset:int, count:int, generation:int) -> bool:
+        with self.__lock:
+            if generation != self.generation:
+                return False
+            self.pending = max(0, self.pending - count)
+            if os.path.exists(self.path) and offset >= os.path.getsize(self.path):
+                # Caught up, start with an empty spool
+                os.remove(self.path)
+                if os.path.exists(self.offsetPath):
+                    os.remove(self.offsetPath)
+                self.pending = 0
+                return True
+            self.__writeOffset(offset)
+            return True
+
+
+    def __readOffset(self) -> int:
+        try:
+            with open(self.offsetPath, 'r') as offsetFile:
+                return int(offsetFile.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+
+    def __writeOffset(self, offset:int):
+        tmpPath = self.offsetPath + '.tmp'
+        with open(tmpPath, 'w') as offsetFile:
+            offsetFile.write(str(offset))
+        os.replace(tmpPath, self.offsetPath)
+
+
+    def __countPending(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as spoolFile:
+            spoolFile.seek(self.__readOffset())
+            return sum(1 for line in spoolFile if line.endswith(b'\n'))
+
+
 class OppleoMqttClient(object, metaclass=Singleton):
     __logger = logging.getLogger(f"{__name__}.{__qualname__}")
 
     mqttClient = None
+    # Seconds
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 120
+    REPLAY_BATCH = 100
+    REPLAY_ACK_TIMEOUT = 5
+
+    __connecting = False
+    __replayThread = None
+    # mid -> publish() time, for the ack latency
+    __inflight = None
+    # mid -> ack time, acknowledged before the mid was registered
+    __early = None
+    published = 0
+    acked = 0
+    failed = 0
+    replayed = 0
+    connects = 0
+    disconnects = 0
+    lastLatency = 0
+    maxLatency = 0
+    __latencies = None
 
     def __init__(self) -> None:
         super().__init__()
 
-        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))       
-         
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__inflightLock = threading.Lock()
+        self.__inflight = {}
+        self.__early = {}
+        self.__latencies = deque(maxlen=1000)
+        self.spool = MqttSpool(path=os.path.join(os.path.dirname(oppleoSystemConfig.logFile), SPOOL_FILENAME),
+                               maxBytes=oppleoSystemConfig.mqttSpoolMaxBytes)
+
         # Set Connecting Client ID
-        self.mqttClient = mqtt_client.Client(client_id='Oppleo_'+oppleoSystemConfig.chargerID, 
+        self.mqttClient = mqtt_client.Client(client_id='Oppleo_'+oppleoSystemConfig.chargerID,
                                              clean_session=True,
                                              protocol=MQTTv311,
                                              transport="tcp",
                                              reconnect_on_failure=True
                                              )
+        self.mqttClient.reconnect_delay_set(min_delay=self.RECONNECT_MIN_DELAY, max_delay=self.RECONNECT_MAX_DELAY)
+        self.mqttClient.on_connect = self.__on_connect
+        self.mqttClient.on_disconnect = self.__on_disconnect
+        self.mqttClient.on_publish = self.__on_publish
         self.setUser()
 
 
+    """
+        Non blocking, the network thread connects (and reconnects) in the background
+    """
     def connect(self) -> None:
-        OppleoMqttClient.__logger.debug("Cconnecting to MQTT Broker...")
-        self.mqttClient.connect(host=oppleoSystemConfig.mqttHost, port=oppleoSystemConfig.mqttPort)
-        self.mqttClient.loop_start()
+        if oppleoSystemConfig.mqttHost is None or oppleoSystemConfig.mqttHost == "":
+            OppleoMqttClient.__logger.debug("No MQTT Broker configured")
+            return
+        with self.__lock:
+            if self.__connecting:
+                return
+            self.__connecting = True
+        OppleoMqttClient.__logger.debug("Connecting to MQTT Broker...")
+        try:
+            self.mqttClient.connect_async(host=oppleoSystemConfig.mqttHost, port=oppleoSystemConfig.mqttPort)
+            self.mqttClient.loop_start()
+        except Exception as e:
+            OppleoMqttClient.__logger.warning('Could not start connecting to MQTT Broker {}:{} - {}'.format(
+                                                oppleoSystemConfig.mqttHost, oppleoSystemConfig.mqttPort, str(e)))
+            with self.__lock:
+                self.__connecting = False
 
     def is_connected(self) -> bool:
         return self.mqttClient.is_connected()
 
     def disconnect(self) -> None:
         OppleoMqttClient.__logger.debug("Requesting disconnect from MQTT Broker...")
-        if self.is_connected():
+        with self.__lock:
+            connecting = self.__connecting
+            self.__connecting = False
+        if connecting or self.is_connected():
             OppleoMqttClient.__logger.debug("Disconnecting from MQTT Broker...")
             self.mqttClient.disconnect()
+            self.mqttClient.loop_stop()
 
     def setUser(self) -> None:
-        if oppleoSystemConfig.mqttUsername is not None and oppleoSystemConfig.mqttUsername != "": 
+        if oppleoSystemConfig.mqttUsername is not None and oppleoSystemConfig.mqttUsername != "":
             OppleoMqttClient.__logger.debug("Setting user for MQTT Broker to {}...".format(oppleoSystemConfig.mqttUsername))
-            self.mqttClient.username_pw_set( oppleoSystemConfig.mqttUsername, 
+            self.mqttClient.username_pw_set( oppleoSystemConfig.mqttUsername,
                                              oppleoSystemConfig.mqttPassword if oppleoSystemConfig.mqttPassword is not None and oppleoSystemConfig.mqttPassword != "" else None
                                            )
+
+
+    def __on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            OppleoMqttClient.__logger.warning('MQTT Broker refused the connection ({})'.format(rc))
+            return
+        self.connects += 1
+        OppleoMqttClient.__logger.debug('Connected to MQTT Broker, {} spooled messages'.format(self.spool.pending))
+        if self.spool.pending > 0:
+            self.__startReplay()
+
+
+    def __on_disconnect(self, client, userdata, rc):
+        self.disconnects += 1
+        with self.__inflightLock:
+            # Not acknowledged anymore (clean session)
+            self.__inflight.clear()
+            self.__early.clear()
+        OppleoMqttClient.__logger.debug('Disconnected from MQTT Broker ({})'.format(rc))
+
+
+    def __on_publish(self, client, userdata, mid):
+        now = time.monotonic()
+        with self.__inflightLock:
+            start = self.__inflight.pop(mid, None)
+            if start is None:
+                # Acknowledged before __send() registered the mid
+                self.__early[mid] = now
+        self.acked += 1
+        if start is not None:
+            self.__latency(now - start)
+
+
+    def __latency(self, latency:float):
+        self.lastLatency = latency
+        self.maxLatency = max(self.maxLatency, latency)
+        self.__latencies.append(latency)
+
+
+    def __send(self, topic:str, message:str, qos:int) -> MQTTMessageInfo:
+        start = time.monotonic()
+        # Not holding the lock, paho calls on_publish holding its own message lock
+        mqttMessageInfo = self.mqttClient.publish(topic=topic, payload=message, qos=qos)
+        if mqttMessageInfo.rc == mqtt_client.MQTT_ERR_SUCCESS:
+            self.published += 1
+            with self.__inflightLock:
+                acked = self.__early.pop(mqttMessageInfo.mid, None)
+                if acked is None:
+                    self.__inflight[mqttMessageInfo.mid] = start
+            if acked is not None:
+                self.__latency(acked - start)
+        return mqttMessageInfo
+
+
     """
-        timeout in ms
+        Never blocks on the broker, unless waitForPublish (timeout in ms). Not connected the message is spooled, and
+        False returned. With waitForPublish the message is not spooled, the caller gets False and handles it.
     """
-    def publish(self, topic:str='oppleo', message:str=None, waitForPublish:bool=False, timeout:int=1000) -> bool:
+    def publish(self, topic:str='oppleo', message:str=None, waitForPublish:bool=False, timeout:int=1000, qos:int=None) -> bool:
         OppleoMqttClient.__logger.debug(f'Publish msg {message} to topic {topic} ... ')
+        qos = oppleoSystemConfig.mqttQos if qos is None else qos
+        if message is not None and not isinstance(message, (str, bytes, bytearray, int, float)):
+            message = json.dumps(message, default=str)
 
         if not self.mqttClient.is_connected():
-            OppleoMqttClient.__logger.debug("Not connected to MQTT Broker, trying to connect")
             self.connect()
 
-        # Can be async connected, with self.mqttClient.is_connected() returning false...
+        if not self.mqttClient.is_connected() or (self.spool.pending > 0 and not waitForPublish):
+            if waitForPublish:
+                OppleoMqttClient.__logger.debug(f'Not connected, msg to topic {topic} not published')
+                return False
+            # Behind the spooled messages, to keep the order
+            self.spool.append(topic=topic, payload=message if not isinstance(message, (bytes, bytearray)) else message.decode(), qos=qos)
+            if self.mqttClient.is_connected():
+                self.__startReplay()
+            return False
 
-        #        if not self.mqttClient.is_connected():
-        #            OppleoMqttClient.__logger.warning(f'Failed to publish msg {message} to topic {topic}, not connected')
-        #            return False
-            
         OppleoMqttClient.__logger.debug(f'Publishing MQTT msg {message} to topic {topic}')
-        
         try:
-            mqttMessageInfo = self.mqttClient.publish(topic=topic, payload=message)
+            mqttMessageInfo = self.__send(topic=topic, message=message, qos=qos)
             if waitForPublish:
                 mqttMessageInfo.wait_for_publish(timeout=(timeout/1000))
         except (ValueError, TypeError, RuntimeError) as e:
+            self.failed += 1
             return False
         return mqttMessageInfo.is_published()
+
+
+    def __startReplay(self):
+        with self.__lock:
+            if self.__replayThread is None or not self.__replayThread.is_alive():
+                self.__replayThread = threading.Thread(target=self.__replay, name='MqttSpoolReplayThread', daemon=True)
+                self.__replayThread.start()
+
+
+    """
+        Publishes the spool in order, every message waits for its acknowledgement (QoS > 0) so a dropped connection
+        does not skip messages. Stops when disconnected, the next connect continues.
+    """
+    def __replay(self):
+        while self.mqttClient.is_connected():
+            records = self.spool.read(self.REPLAY_BATCH)
+            if len(records) == 0:
+                return
+            for index, (record, offset, generation) in enumerate(records):
+                try:
+                    mqttMessageInfo = self.__send(topic=record['topic'], message=record['payload'], qos=record.get('qos', 0))
+                    if mqttMessageInfo.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                        # Not connected (anymore)
+                        return
+                    if record.get('qos', 0) > 0:
+                        mqttMessageInfo.wait_for_publish(timeout=self.REPLAY_ACK_TIMEOUT)
+                        if not mqttMessageInfo.is_published():
+                            return
+                except (ValueError, TypeError, RuntimeError) as e:
+                    OppleoMqttClient.__logger.warning('Replay of spooled MQTT msg failed - {}'.format(str(e)))
+                    if not self.mqttClient.is_connected():
+                        return
+                self.replayed += 1
+                if not self.spool.committed(offset, 1, generation):
+                    # Truncated while publishing, read the new spool
+                    break
+
+
+    def diag(self) -> dict:
+        latencies = sorted(self.__latencies)
+        return {
+            "connected"         : self.is_connected(),
+            "qos"               : oppleoSystemConfig.mqttQos,
+            "connects"          : self.connects,
+            "disconnects"       : self.disconnects,
+            "published"         : self.published,
+            "acked"             : self.acked,
+            "inflight"          : len(self.__inflight),
+            "failed"            : self.failed,
+            "spoolPending"      : self.spool.pending,
+            "spooled"           : self.spool.spooled,
+            "spoolDiscarded"    : self.spool.discarded,
+            "replayed"          : self.replayed,
+            "ackLatencyLastMs"  : round(self.lastLatency * 1000, 1),
+            "ackLatencyAvgMs"   : round(sum(latencies) / len(latencies) * 1000, 1) if len(latencies) > 0 else 0,
+            "ackLatencyP95Ms"   : round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if len(latencies) > 0 else 0,
+            "ackLatencyMaxMs"   : round(self.maxLatency * 1000, 1)
+            }
@@ -0,0 +1,94 @@
+import logging
+import threading
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.RfidModel import RfidModel
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Process-wide cache of the rfid table, keyed by rfid.
+
+ Filled on first use of a token, kept current by the RfidModel after_insert, after_update and after_delete mapper
+ events (registered in Oppleo.py). Presenting a tag or processing a measurement does not query the database for a
+ token that did not change.
+
+ Reading is lock-free. Cached objects are shared between threads and should not be modified, use detached_copy()
+ before changing and saving an rfid.
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class RfidCache(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    # rfid -> RfidModel | None (None: not in the database)
+    __rfids = None
+    __hits = 0
+    __misses = 0
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__rfids = {}
+
+
+    """
+        Returns the (shared) RfidModel for the token, or None if unknown. Only queries the database on a miss.
+    """
+    def get(self, rfid=None) -> RfidModel | None:
+        if rfid is None:
+            return None
+        rfid = str(rfid)
+        try:
+            rfid_model = self.__rfids[rfid]
+            self.__hits += 1
+            return rfid_model
+        except KeyError:
+            pass
+        self.__misses += 1
+        rfid_model = RfidModel.get_one(rfid)
+        with self.__lock:
+            # An insert or update event may have been processed while querying, that one is more recent
+            if rfid not in self.__rfids:
+                self.__rfids[rfid] = rfid_model
+            return self.__rfids[rfid]
+
+
+    """
+        Called from the mapper events with the inserted or updated target
+    """
+    def put(self, rfid_model:RfidModel=None):
+        if rfid_model is None or rfid_model.rfid is None:
+            return
+        rfid_copy = rfid_model.detached_copy()
+        with self.__lock:
+            self.__rfids[str(rfid_copy.rfid)] = rfid_copy
+        self.__logger.debug('put() - rfid {}'.format(rfid_copy.rfid))
+
+
+    def invalidate(self, rfid=None):
+        if rfid is None:
+            return
+        with self.__lock:
+            self.__rfids.pop(str(rfid), None)
+        self.__logger.debug('invalidate() - rfid {}'.format(rfid))
+
+
+    def clear(self):
+        with self.__lock:
+            self.__rfids = {}
+
+
+    def diag(self) -> dict:
+        return {
+            "size"      : len(self.__rfids),
+            "hits"      : self.__hits,
+            "misses"    : self.__misses
+            }
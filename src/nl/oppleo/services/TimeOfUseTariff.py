@@ -0,0 +1,222 @@
+import logging
+import threading
+from bisect import bisect_right
+from datetime import datetime
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel
+from nl.oppleo.models.TariffScheduleModel import TariffScheduleModel
+from nl.oppleo.services.ChangeBus import ChangeBus
+from nl.oppleo.services.OffPeakCalendar import OffPeakCalendar
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Session cost from the energy curve, priced by the tariff_schedule (TariffScheduleModel) and the off peak windows
+ (OffPeakCalendar).
+
+ The energy between two measurements is spread evenly over the time between them. The timeline is cut into segments
+ with a constant tariff, a segment ends at the next off peak transition or the next valid_from of the schedule. A
+ series of n measurements crossing m segment boundaries costs n + m steps, the tariff and the end of the current
+ segment are only looked up again when a boundary is crossed.
+
+ During a session the cost is accumulated per measurement (session_price(), from energyUpdate), the accumulator of a
+ session is built from the stored measurements when it does not exist yet (restart, changed schedule). recompute()
+ prices a closed session from its measurements, for the end of a session and for recalculating history.
+
+ Without schedule rows the engine is disabled and sessions keep their flat tariff (total_energy * tariff).
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class CostAccumulator(object):
+    """
+        Cost of one cumulative kWh series, fed in ascending time order
+    """
+    price = 0
+    energy = 0
+    lastTs = None
+    lastKwh = None
+    __tariff = None
+    __segmentStart = None
+    __segmentEnd = None
+
+    def __init__(self, schedule, flatTariff:float, version:int=0):
+        self.__schedule = schedule
+        self.flatTariff = flatTariff
+        self.version = version
+
+
+    def __segment(self, ts:datetime):
+        if self.__segmentStart is not None and self.__segmentStart <= ts and \
+           (self.__segmentEnd is None or ts < self.__segmentEnd):
+            return
+        self.__tariff, self.__segmentEnd = self.__schedule.segment(ts, self.flatTariff)
+        self.__segmentStart = ts
+
+
+    def add(self, ts:datetime, kwh:float):
+        if ts is None or kwh is None:
+            return
+        if self.lastTs is None:
+            self.lastTs, self.lastKwh = ts, kwh
+            return
+        delta = kwh - self.lastKwh
+        if delta > 0 and ts > self.lastTs:
+            span = (ts - self.lastTs).total_seconds()
+            cursor = self.lastTs
+            while cursor < ts:
+                self.__segment(cursor)
+                until = ts if self.__segmentEnd is None else min(ts, self.__segmentEnd)
+                self.price += delta * (until - cursor).total_seconds() / span * self.__tariff
+                cursor = until
+            self.energy += delta
+        elif delta > 0:
+            # Same moment, no time to spread over
+            self.__segment(ts)
+            self.price += delta * self.__tariff
+            self.energy += delta
+        # delta < 0 is a replaced or reset meter, that energy is not known
+        if ts >= self.lastTs:
+            self.lastTs, self.lastKwh = ts, kwh
+
+
+class TimeOfUseTariff(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    __compiled = False
+    # off_peak -> ([valid_from, ...], [tariff, ...]), ascending, datetime.min for a NULL valid_from
+    __schedule = None
+    # session id -> CostAccumulator
+    __sessions = None
+    # Increments on every invalidate(), accumulators of an older version are rebuilt
+    version = 0
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__sessions = {}
+        ChangeBus().subscribe(ChangeBus.TOPIC_TARIFF_SCHEDULE, self.__changed)
+        ChangeBus().subscribe(ChangeBus.TOPIC_OFF_PEAK_HOURS, self.__changed)
+
+
+    def __changed(self, topic, details):
+        self.invalidate()
+
+
+    def invalidate(self):
+        with self.__lock:
+            self.__compiled = False
+            self.version += 1
+        self.__logger.debug('invalidate() - version {}'.format(self.version))
+
+
+    def __compile(self):
+        with self.__lock:
+            if self.__compiled:
+                return
+            rows = {True: [], False: []}
+            for entry in TariffScheduleModel.get_all() or []:
+                if entry.tariff is not None and entry.off_peak is not None:
+                    rows[bool(entry.off_peak)].append((entry.valid_from or datetime.min, float(entry.tariff)))
+            self.__schedule = { offPeak: ([ validFrom for validFrom, _ in sorted(entries) ],
+                                          [ tariff for _, tariff in sorted(entries) ])
+                                    for offPeak, entries in rows.items() }
+            self.__compiled = True
+        self.__logger.debug('compile() - {} off peak, {} peak tariffs'.format(
+                len(self.__schedule[True][0]), len(self.__schedule[False][0])))
+
+
+    def enabled(self) -> bool:
+        self.__compile()
+        return len(self.__schedule[True][0]) > 0 or len(self.__schedule[False][0]) > 0
+
+
+    """
+        Tariff at ts, falls back to flatTariff when the schedule has no tariff for that moment
+    """
+    def tariff(self, ts:datetime, flatTariff:float=None) -> float:
+        return self.segment(ts, flatTariff)[0]
+
+
+    """
+        Returns (tariff at ts, end of the segment with that tariff or None)
+    """
+    def segment(self, ts:datetime, flatTariff:float=None) -> tuple:
+        self.__compile()
+        calendar = OffPeakCalendar()
+        offPeak = calendar.is_off_peak(ts)
+        validFroms, tariffs = self.__schedule[offPeak]
+        index = bisect_right(validFroms, ts) -1
+        tariff = tariffs[index] if index >= 0 else (flatTariff or 0)
+        # Next change, an off peak transition or a tariff becoming valid
+        ends = []
+        transition = calendar.next_transition(ts)
+        if transition is not None:
+            ends.append(transition)
+        for scheduled in [ self.__schedule[True][0], self.__schedule[False][0] ]:
+            nextFrom = bisect_right(scheduled, ts)
+            if nextFrom < len(scheduled):
+                ends.append(scheduled[nextFrom])
+        return tariff, (min(ends) if len(ends) > 0 else None)
+
+
+    """
+        Cost of a list of (timestamp, cumulative kWh) tuples, ascending
+    """
+    def cost(self, samples:list, flatTariff:float=None) -> float:
+        accumulator = CostAccumulator(self, flatTariff, self.version)
+        for ts, kwh in samples:
+            accumulator.add(ts, kwh)
+        return accumulator.price
+
+
+    def __accumulate(self, charge_session, until_ts:datetime=None) -> CostAccumulator:
+        accumulator = CostAccumulator(self, charge_session.tariff, self.version)
+        accumulator.add(charge_session.start_time, charge_session.start_value)
+        samples = EnergyDeviceMeasureModel.get_usage_window_samples(charge_session.energy_device_id,
+                                                                    charge_session.start_time, until_ts)
+        for ts, kwh in samples:
+            if ts > charge_session.start_time:
+                accumulator.add(ts, kwh)
+        return accumulator
+
+
+    """
+        Price of the open session after the measurement (ts, kwh), rounded to cents
+    """
+    def session_price(self, charge_session, ts:datetime, kwh:float) -> float:
+        accumulator = self.__sessions.get(charge_session.id)
+        if accumulator is None or accumulator.version != self.version:
+            accumulator = self.__accumulate(charge_session, until_ts=ts)
+            self.__sessions[charge_session.id] = accumulator
+        accumulator.add(ts, kwh)
+        return round(accumulator.price * 100) /100
+
+
+    """
+        Price of the (closed) session from its stored measurements, rounded to cents
+    """
+    def recompute(self, charge_session) -> float:
+        accumulator = self.__accumulate(charge_session, until_ts=charge_session.end_time)
+        accumulator.add(charge_session.end_time, charge_session.end_value)
+        return round(accumulator.price * 100) /100
+
+
+    def forget(self, sessionId:int):
+        self.__sessions.pop(sessionId, None)
+
+
+    def diag(self) -> dict:
+        return {
+            "enabled"           : self.enabled(),
+            "version"           : self.version,
+            "openSessions"      : len(self.__sessions),
+            "tariffNow"         : self.tariff(datetime.now())
+            }
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.User import User
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Cache for the Flask-Login user_loader (load_user in Oppleo.py), keyed by username.
+
+ Every authenticated request and socket connect resolves the session's username to a User. The cache holds that
+ outcome for ttl seconds: the user, or None for a username that is not (or no longer) in the database. The User
+ after_insert and after_update mapper events (registered in Oppleo.py) replace the entry, a changed password, 2FA
+ setting or avatar is effective on the next request. Changes from outside the web process (createuser.py,
+ remove2FAforUser.py) and the bulk deletes in User.delete() do not fire these events, the ttl bounds those.
+
+ get() returns a detached copy, the request may change and save it.
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class UserCache(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    # username -> (User | None, loaded at)
+    __users = None
+    ttl = 60
+    __hits = 0
+    __misses = 0
+    __stale = 0
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__users = {}
+
+
+    def get(self, username:str=None) -> User | None:
+        if username is None:
+            return None
+        entry = self.__users.get(username)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self.__hits += 1
+            return None if entry[0] is None else entry[0].detached_copy()
+        self.__misses += 1
+        try:
+            user = User.get(username)
+        except Exception as e:
+            if entry is None:
+                raise
+            # Database unavailable, the last known user is better than logging everybody out
+            self.__stale += 1
+            self.__logger.warning('get() - serving cached user {} - {}'.format(username, str(e)))
+            return None if entry[0] is None else entry[0].detached_copy()
+        with self.__lock:
+            self.__users[username] = (None if user is None else user.detached_copy(), time.monotonic())
+        return user
+
+
+    """
+        Called from the mapper events with the inserted or updated target
+    """
+    def put(self, user:User=None):
+        if user is None or user.username is None:
+            return
+        userCopy = user.detached_copy()
+        with self.__lock:
+            self.__users[userCopy.username] = (userCopy, time.monotonic())
+        self.__logger.debug('put() - user {}'.format(userCopy.username))
+
+
+    def invalidate(self, username:str=None):
+        if username is None:
+            return
+        with self.__lock:
+            self.__users.pop(username, None)
+        self.__logger.debug('invalidate() - user {}'.format(username))
+
+
+    def clear(self):
+        with self.__lock:
+            self.__users = {}
+
+
+    def diag(self) -> dict:
+        return {
+            "size"      : len(self.__users),
+            "ttl"       : self.ttl,
+            "hits"      : self.__hits,
+            "misses"    : self.__misses,
+            "stale"     : self.__stale
+            }
@@ -0,0 +1,273 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.ChargeSessionModel import ChargeSessionModel
+from nl.oppleo.models.EnergyDeviceMeasureModel import EnergyDeviceMeasureModel
+from nl.oppleo.exceptions.Exceptions import DbException
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Durable local spool for the measurement and charge session writes.
+
+ A write that fails with a DbException is appended to a local file (one json line per write, fsynced) instead of
+ being lost. While the spool holds writes, new writes go to the spool as well, so the database receives them in the
+ original order. A replay thread writes the spool to the database in batches, retrying with a backoff while the
+ database is unavailable, and empties the file when it has caught up.
+
+ The replayed position is kept in <spool>.offset after every committed batch. A crash between a commit and the offset
+ update replays that batch again (at least once).
+
+ Records
+    { "type": "measurement", "values": { column: value, ... } }
+    { "type": "charge_session", "id": id, "values": { column: value, ... } }
+"""
+
+SPOOL_FILENAME = 'oppleo_write_spool.jsonl'
+
+TYPE_MEASUREMENT = 'measurement'
+TYPE_CHARGE_SESSION = 'charge_session'
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return { '__datetime__': value.isoformat() }
+    raise TypeError('Cannot spool {}'.format(type(value)))
+
+
+def _decode(obj:dict):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+class WriteSpool(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    __replayLock = None
+    __path = None
+    __offsetPath = None
+    __replayThread = None
+    __stop_event = None
+    __wakeup_event = None
+    # Writes in the spool, not yet replayed
+    pending = 0
+    spooled = 0
+    replayed = 0
+    replayErrors = 0
+    batchSize = 500
+    retryMinInterval = 5
+    retryMaxInterval = 300
+
+    def __init__(self, directory:str=None):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__replayLock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__wakeup_event = threading.Event()
+        if directory is None:
+            # Next to the log file, the one location that is writable on every installation
+            directory = os.path.dirname(oppleoSystemConfig.logFile)
+        self.__path = os.path.join(directory, SPOOL_FILENAME)
+        self.__offsetPath = self.__path + '.offset'
+        self.pending = self.__countPending()
+        if self.pending > 0:
+            self.__logger.warning('{} spooled writes from a previous run, replaying'.format(self.pending))
+            self.__startReplay()
+
+
+    def save_measurement(self, measurement:EnergyDeviceMeasureModel):
+        self.__write(TYPE_MEASUREMENT, { 'type': TYPE_MEASUREMENT, 'values': measurement.to_values() },
+                     lambda: measurement.save())
+
+
+    def update_charge_session(self, id:int, values:dict):
+        self.__write(TYPE_CHARGE_SESSION, { 'type': TYPE_CHARGE_SESSION, 'id': id, 'values': values },
+                     lambda: ChargeSessionModel.update_columns(id=id, values=values))
+
+
+    def __write(self, type:str, record:dict, dbWrite):
+        if self.pending == 0:
+            try:
+                dbWrite()
+                return
+            except DbException as e:
+                self.__logger.warning('Database write ({}) failed, spooling - {}'.format(type, str(e)))
+        self.__append(record)
+
+
+    def __append(self, record:dict):
+        line = json.dumps(record, default=_encode) + '\n'
+        with self.__lock:
+            with open(self.__path, 'a') as spoolFile:
+                spoolFile.write(line)
+                spoolFile.flush()
+                os.fsync(spoolFile.fileno())
+            self.pending += 1
+            self.spooled += 1
+        self.__startReplay()
+        self.__wakeup_event.set()
+
+
+    def __startReplay(self):
+        with self.__lock:
+            if self.__replayThread is None or not self.__replayThread.is_alive():
+                self.__stop_event.clear()
+                self.__replayThread = threading.Thread(target=self.__replayLoop, name='WriteSpoolReplayThread', daemon=True)
+                self.__replayThread.start()
+
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__wakeup_event.set()
+
+
+    def __replayLoop(self):
+        retryInterval = self.retryMinInterval
+        while not self.__stop_event.is_set():
+            if self.pending == 0:
+                # Idle until the next spooled write
+                self.__wakeup_event.wait()
+                self.__wakeup_event.clear()
+                continue
+            try:
+                self.__replayBatch()
+                retryInterval = self.retryMinInterval
+            except DbException as e:
+                self.replayErrors += 1
+                self.__logger.debug('Replay failed, retry in {}s - {}'.format(retryInterval, str(e)))
+                self.__stop_event.wait(timeout=retryInterval)
+                retryInterval = min(retryInterval * 2, self.retryMaxInterval)
+            except Exception as e:
+                self.replayErrors += 1
+                self.__logger.error('Replay failed', exc_info=True)
+                self.__stop_event.wait(timeout=self.retryMaxInterval)
+
+
+    """
+        Replay everything now, in the calling thread. Returns True if the spool is empty.
+    """
+    def drain(self) -> bool:
+        try:
+            while self.pending > 0:
+                self.__replayBatch()
+        except DbException as e:
+            self.__logger.warning('drain() - {} writes still spooled - {}'.format(self.pending, str(e)))
+        return self.pending == 0
+
+
+    """
+        Replays up to batchSize records. Consecutive records of the same type are written in one transaction.
+    """
+    def __replayBatch(self):
+        with self.__replayLock:
+            self.__replaySpooled()
+
+
+    def __replaySpooled(self):
+        if self.pending == 0:
+            # Drained by another thread
+            return
+        offset = self.__readOffset()
+        records = []
+        with open(self.__path, 'rb') as spoolFile:
+            spoolFile.seek(offset)
+            while len(records) < self.batchSize:
+                line = spoolFile.readline()
+                if not line.endswith(b'\n'):
+                    # End of file, or a line still being written
+                    break
+                try:
+                    record = json.loads(line, object_hook=_decode)
+                except ValueError:
+                    self.__logger.error('Skipping unreadable spool record at offset {}'.format(offset))
+                    record = { 'type': None }
+                offset += len(line)
+                records.append((record, offset))
+
+        if len(records) == 0:
+            # Nothing (complete) left to replay, the pending count was off
+            with self.__lock:
+                self.pending = 0
+            return
+
+        index = 0
+        while index < len(records):
+            type = records[index][0].get('type')
+            end = index
+            while end < len(records) and records[end][0].get('type') == type:
+                end += 1
+            segment = [ record for record, _ in records[index:end] ]
+            if type == TYPE_MEASUREMENT:
+                EnergyDeviceMeasureModel.insert_values([ record['values'] for record in segment ])
+            elif type == TYPE_CHARGE_SESSION:
+                ChargeSessionModel.update_columns_many([ (record['id'], record['values']) for record in segment ])
+            else:
+                self.__logger.error('Skipping {} spool record(s) of type {}'.format(len(segment), type))
+            self.__committed(records[end -1][1], end - index)
+            index = end
+
+
+    def __committed(self, offset:int, count:int):
+        with self.__lock:
+            self.pending = max(0, self.pending - count)
+            self.replayed += count
+            if self.pending == 0 and offset >= os.path.getsize(self.__path):
+                # Caught up, start with an empty spool
+                os.remove(self.__path)
+                if os.path.exists(self.__offsetPath):
+                    os.remove(self.__offsetPath)
+                self.__logger.info('Spool replayed, {} writes in total'.format(self.replayed))
+                return
+            self.__writeOffset(offset)
+
+
+    def __readOffset(self) -> int:
+        try:
+            with open(self.__offsetPath, 'r') as offsetFile:
+                return int(offsetFile.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+
+    def __writeOffset(self, offset:int):
+        tmpPath = self.__offsetPath + '.tmp'
+        with open(tmpPath, 'w') as offsetFile:
+            offsetFile.write(str(offset))
+            offsetFile.flush()
+            os.fsync(offsetFile.fileno())
+        os.replace(tmpPath, self.__offsetPath)
+
+
+    def __countPending(self) -> int:
+        if not os.path.exists(self.__path):
+            return 0
+        count = 0
+        with open(self.__path, 'rb') as spoolFile:
+            spoolFile.seek(self.__readOffset())
+            for line in spoolFile:
+                if line.endswith(b'\n'):
+                    count += 1
+        return count
+
+
+    def diag(self) -> dict:
+        return {
+            "path"          : self.__path,
+            "pending"       : self.pending,
+            "spooled"       : self.spooled,
+            "replayed"      : self.replayed,
+            "replayErrors"  : self.replayErrors,
+            "replaying"     : self.__replayThread is not None and self.__replayThread.is_alive()
+            }
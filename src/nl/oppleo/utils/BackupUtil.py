@@ -8,10 +8,12 @@ from time import sleep
 import logging
 import re
 import json
+import sqlite3
 from shutil import which
 
 from nl.oppleo.config.OppleoConfig import OppleoConfig
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.models.SqliteEngine import is_sqlite_url, sqlite_database_path
 
 from nl.oppleo.utils.formatFilesize import formatFilesize
 from nl.oppleo.utils.SMBClient import SMBClient
@@ -68,6 +70,7 @@ class BackupUtil(object, metaclass=Singleton):
     __CHECK_INTERVAL = 60
 
     __DBTYPE_POSTGRESS__ = 0
+    __DBTYPE_SQLITE__ = 1
 
     __SYSTEMSINIPATH__ = 'src/nl/oppleo/config/'
     __SYSTEMSINIFILENAME__ = 'oppleo'
@@ -94,6 +97,8 @@ class BackupUtil(object, metaclass=Singleton):
         self.singleBackupThread = None
         self.stop_event = threading.Event()
         self.lock = threading.Lock()
+        if is_sqlite_url(oppleoSystemConfig.DATABASE_URL):
+            self.__dbtype__ = self.__DBTYPE_SQLITE__
 
 
     """
@@ -487,6 +492,8 @@ class BackupUtil(object, metaclass=Singleton):
 
         if self.__dbtype__ == self.__DBTYPE_POSTGRESS__:
             return self.backupDatabase_Postgres(now, dir_name)
+        if self.__dbtype__ == self.__DBTYPE_SQLITE__:
+            return self.backupDatabase_Sqlite(now, dir_name)
         # default
         return { 'type': 'none', 'filename': None, 'success': False, 'reason': 'No supported database type' }
 
@@ -515,6 +522,40 @@ class BackupUtil(object, metaclass=Singleton):
         return { 'type': 'postgres', 'filename': filename, 'success': True }
 
 
+    """
+        Online backup API, a consistent copy of the live database. Copied in a single step, in WAL mode that is one
+        read snapshot and the charger keeps writing measurements meanwhile. Copying in smaller steps would restart
+        the backup on every write by another connection.
+    """
+    def backupDatabase_Sqlite(self, now, dir_name) -> dict:
+        global oppleoSystemConfig
+
+        filename = 'sqlite_' + now.strftime('%Y-%m-%d_%H.%M.%S') + '.sqlite3'
+
+        db_path = sqlite_database_path(oppleoSystemConfig.DATABASE_URL)
+        if db_path is None or db_path == '' or db_path == ':memory:' or not os.path.exists(db_path):
+            return { 'type': 'sqlite', 'filename': None, 'success': False, 'reason': 'No sqlite database file' }
+
+        if not dir_name.endswith(os.path.sep):
+            dir_name += os.path.sep
+
+        source = None
+        target = None
+        try:
+            source = sqlite3.connect(db_path)
+            target = sqlite3.connect(dir_name + filename)
+            source.backup(target, pages=-1)
+        except Exception as e:
+            return { 'type': 'sqlite', 'filename': filename, 'success': False, 'reason': str(e) }
+        finally:
+            if target is not None:
+                target.close()
+            if source is not None:
+                source.close()
+
+        return { 'type': 'sqlite', 'filename': filename, 'success': True }
+
+
     """
         Capture stdout (returns byte literal): 
             x = subprocess.check_output(['whoami'])
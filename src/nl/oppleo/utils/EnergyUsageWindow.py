@@ -0,0 +1,111 @@
+import logging
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Sliding window of (created_at, kw_total) samples for a single energy device.
+
+ Answers 'how much energy was used since T' from memory, the same way EnergyDeviceMeasureModel.get_usage_since()
+ does from the database: the latest sample minus the last sample at or before T. Samples are kept ordered by
+ timestamp, a lookup is a binary search (O(log n)).
+
+ Samples older than the retention period are pruned, except for the last one before the retention horizon. That
+ sample is the anchor, the kw_total value at the start of the window. Measurements are only stored on change, so
+ the anchor can be considerably older than the horizon.
+
+ usage_since() returns None when the window cannot answer the question (empty, or T before the first sample), the
+ caller can then fall back to the database.
+"""
+
+class EnergyUsageWindow:
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    __lock = None
+    __timestamps = None
+    __kw_totals = None
+    retention:timedelta = None
+
+
+    def __init__(self, retention:timedelta=timedelta(minutes=90)):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__lock = threading.Lock()
+        self.__timestamps = []
+        self.__kw_totals = []
+        self.retention = retention
+
+
+    def __len__(self) -> int:
+        return len(self.__timestamps)
+
+
+    """
+        Replace the window contents. samples is a list of (created_at, kw_total) tuples, in any order.
+    """
+    def load(self, samples:list=None):
+        samples = sorted(samples if samples is not None else [], key=lambda sample: sample[0])
+        with self.__lock:
+            self.__timestamps = [sample[0] for sample in samples]
+            self.__kw_totals = [sample[1] for sample in samples]
+            self.__prune()
+        self.__logger.debug('load() - {} samples in window'.format(len(self.__timestamps)))
+
+
+    def add(self, created_at:datetime=None, kw_total:float=None):
+        if created_at is None or kw_total is None:
+            return
+        with self.__lock:
+            if len(self.__timestamps) == 0 or created_at >= self.__timestamps[-1]:
+                # Regular case, measurements arrive in order
+                self.__timestamps.append(created_at)
+                self.__kw_totals.append(kw_total)
+            else:
+                # A previously not stored measurement, insert at its place
+                index = bisect_right(self.__timestamps, created_at)
+                self.__timestamps.insert(index, created_at)
+                self.__kw_totals.insert(index, kw_total)
+            self.__prune()
+
+
+    def clear(self):
+        with self.__lock:
+            self.__timestamps = []
+            self.__kw_totals = []
+
+
+    """
+        Returns the kWh used since since_ts, rounded to one decimal, or None if the window does not cover since_ts
+    """
+    def usage_since(self, since_ts:datetime) -> float | None:
+        with self.__lock:
+            # Index of the last sample at or before since_ts
+            index = bisect_right(self.__timestamps, since_ts) -1
+            if index < 0:
+                return None
+            return round((self.__kw_totals[-1] - self.__kw_totals[index]) *10) /10
+
+
+    """
+        Drop samples before the retention horizon, keep the last one before the horizon as anchor. Call with lock.
+    """
+    def __prune(self):
+        if len(self.__timestamps) == 0 or self.retention is None:
+            return
+        horizon = self.__timestamps[-1] - self.retention
+        anchor = bisect_right(self.__timestamps, horizon) -1
+        if anchor > 0:
+            del self.__timestamps[:anchor]
+            del self.__kw_totals[:anchor]
+
+
+    def diag(self) -> dict:
+        with self.__lock:
+            return {
+                "samples"   : len(self.__timestamps),
+                "retention" : str(self.retention),
+                "first"     : self.__timestamps[0] if len(self.__timestamps) > 0 else None,
+                "last"      : self.__timestamps[-1] if len(self.__timestamps) > 0 else None
+            }
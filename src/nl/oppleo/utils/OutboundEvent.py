@@ -23,16 +23,20 @@
     - ignore public
     - status?
 
+ triggerEvent hands the event to the OutboundEventDispatcher, the sinks (websocket, MQTT, Home Assistant) deliver it
+ on their own queue and worker, see OutboundEventDispatcher.
 
 """
 
 
      
 import logging
-import json
+import time
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.config.OppleoConfig import OppleoConfig
 from nl.oppleo.services.OppleoMqttClient import OppleoMqttClient
+from nl.oppleo.utils.OutboundEventDispatcher import OutboundEventDispatcher, MqttSink
+from nl.oppleo.utils import PayloadSerializer
 
 oppleoSystemConfig = OppleoSystemConfig()
 oppleoConfig = OppleoConfig()
@@ -54,29 +58,21 @@ class OutboundEvent(object):
                       public=False,          \
                       room=None):
 
-        # Send websocket event (always enabled)
-        OutboundEvent.emitWebsocketEvent( wsEmitQueue=oppleoConfig.wsEmitQueue,     \
-                                          event=event,                              \
-                                          data=data,                                \
-                                          status=status,                            \
-                                          id=id,                                    \
-                                          namespace=namespace,                      \
-                                          public=public,                            \
-                                          room=room)
-
-        # Send MQTT event if enabled
-        if oppleoSystemConfig.mqttOutboundEnabled and room is not None:
-            OutboundEvent.__logger.debug('Webclient specific message (system status on connect) not send to MQTT.')
-        if oppleoSystemConfig.mqttOutboundEnabled and room is None:
-            OutboundEvent.emitMQTTEvent( event=event,                               \
-                                         data=data,                                 \
-                                         status=status,                             \
-                                         id=id,                                     \
-                                         namespace=namespace)
+        # Hand the event to the sinks (websocket always, MQTT if enabled, ...), delivery is asynchronous
+        OutboundEventDispatcher().dispatch({
+                                    'event'     : event,
+                                    'data'      : data,
+                                    'status'    : status,
+                                    'id'        : id,
+                                    'namespace' : namespace,
+                                    'public'    : public,
+                                    'room'      : room
+                                    })
 
 
     """ 
-
+      Queued for the MQTT sink, unless direct. Direct publishes on the calling thread, for threads pacing their own
+      publishing (MqttSendHistoryThread) and for the MQTT sink itself.
     """ 
     @staticmethod
     def emitMQTTEvent( event='event',
@@ -84,10 +80,56 @@ class OutboundEvent(object):
                        status=None,
                        id=None,
                        namespace='/all',
-                       waitForPublish=False):
+                       waitForPublish=False,
+                       direct=False):
+
+        if not direct:
+            OutboundEventDispatcher().dispatch({
+                                        'event'     : event,
+                                        'data'      : data,
+                                        'status'    : status,
+                                        'id'        : id,
+                                        'namespace' : namespace
+                                        },
+                                        sinks=[ MqttSink.name ])
+            return
+
+        try:
+            OutboundEvent.publishMQTTEvent(event=event, data=data, status=status, id=id, namespace=namespace,
+                                           waitForPublish=waitForPublish)
+        except Exception as e:
+            OutboundEvent.__logger.error('MQTT server enabled but not reachable! {}'.format(str(e)))
+
+
+    """ 
+      Publishes on the calling thread, raises when the broker is not reachable
+    """ 
+    @staticmethod
+    def publishMQTTEvent( event='event',
+                          data=None,
+                          status=None,
+                          id=None,
+                          namespace='/all',
+                          waitForPublish=False) -> bool:
 
         oppleoMqttClient = OppleoMqttClient()
 
+        topic, message = OutboundEvent.mqttMessage(event=event, data=data, status=status, id=id, namespace=namespace)
+
+        OutboundEvent.__logger.debug(f'Submit msg to MQTT topic ... {message}')
+        return oppleoMqttClient.publish(topic=topic, message=message, waitForPublish=waitForPublish)
+
+
+    """
+      Returns the (topic, json message) of an MQTT event
+    """
+    @staticmethod
+    def mqttMessage( event='event',
+                     data=None,
+                     status=None,
+                     id=None,
+                     namespace='/all') -> tuple:
+
         topic = 'oppleo/' + oppleoSystemConfig.chargerID + namespace + '/' + event
 
         msg = {}
@@ -98,11 +140,8 @@ class OutboundEvent(object):
         if status is not None:
             msg['status'] = status
 
-        OutboundEvent.__logger.debug(f'Submit msg to MQTT topic ... {msg}')
-        try:
-            oppleoMqttClient.publish(topic=topic, message=json.dumps(msg, default=str), waitForPublish=waitForPublish)
-        except Exception as e:
-            OutboundEvent.__logger.error('MQTT server enabled but not reachable! {}'.format(str(e)))
+        # Reuses the encoding of a Payload shared with the other sinks
+        return topic, PayloadSerializer.dumps(msg, default=str, separators=PayloadSerializer.SEPARATORS)
 
 
     """ 
@@ -120,7 +159,9 @@ class OutboundEvent(object):
                             public=False,          \
                             room=None):
 
-        if wsEmitQueue is not None:
+        if wsEmitQueue is not None and not oppleoConfig.hasSubscribers(namespace, public=public, room=None if public else room):
+            OutboundEvent.__logger.debug('No websocket subscribers for {} {}, not queued'.format(namespace, event))
+        elif wsEmitQueue is not None:
             msg = {}
             msg['event'] = event
             """
@@ -138,6 +179,8 @@ class OutboundEvent(object):
                 msg['room'] = room
             msg['namespace'] = namespace
             msg['public'] = public
+            # Latency of the websocket emit is measured from here (WebSocketQueueReaderBackgroundTask)
+            msg['queued_at'] = time.monotonic()
             OutboundEvent.__logger.debug(f'Submit msg to websocket emit queue ... {msg}')
             wsEmitQueue.put(msg)
         else:
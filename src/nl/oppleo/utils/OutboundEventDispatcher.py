@@ -0,0 +1,251 @@
+import logging
+import threading
+from abc import ABC, abstractmethod
+from queue import Empty
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+from nl.oppleo.utils.OutboundEventQueue import OutboundEventQueue
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Fans the outbound events of OutboundEvent.triggerEvent out to sinks (WebSocket, MQTT, Home Assistant, ...).
+
+ dispatch() runs on the thread raising the event (energy device, rfid reader, evse reader, web request) and only
+ puts the msg dict on the queue of every sink accepting it. Each queued sink has its own bounded OutboundEventQueue
+ (state events coalesce, see OutboundEventQueue) and its own worker thread delivering the messages. A sink failing or
+ hanging (broker down, blocking connect) only fills its own queue, the other sinks and the caller are not affected.
+ After consecutive failures the worker backs off, up to MAX_BACKOFF seconds.
+
+ The msg dict is the one of the websocket emit queue: event, data, status, id, namespace, public, room.
+"""
+
+class Singleton(type):
+    _instances = {}
+    def __call__(cls, *args, **kwargs):
+        if cls not in cls._instances:
+            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return cls._instances[cls]
+
+
+class OutboundEventSink(ABC):
+    """
+        Sink delivering on the dispatching thread, for sinks which only hand the message to a queue of their own.
+        Sinks implement deliver().
+    """
+    name = 'sink'
+    delivered = 0
+    failed = 0
+    lastError = None
+
+    def accepts(self, msg:dict) -> bool:
+        return True
+
+    def submit(self, msg:dict):
+        try:
+            self.deliver(msg)
+            self.delivered += 1
+        except Exception as e:
+            self.failed += 1
+            self.lastError = str(e)
+
+    @abstractmethod
+    def deliver(self, msg:dict):
+        pass
+
+    def diag(self) -> dict:
+        return {
+            "delivered"         : self.delivered,
+            "failed"            : self.failed,
+            "lastError"         : self.lastError
+            }
+
+
+class QueuedSink(OutboundEventSink):
+    """
+        Sink with its own queue and worker thread, started on the first message
+    """
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    MAX_SIZE = 500
+    # Seconds
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 30
+    consecutiveFailures = 0
+    backoff = 0
+
+    def __init__(self, maxsize:int=MAX_SIZE, stateEvents:dict=None):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.queue = OutboundEventQueue(maxsize=maxsize) if stateEvents is None else \
+                     OutboundEventQueue(maxsize=maxsize, stateEvents=stateEvents)
+        self.__thread = None
+        self.__threadLock = threading.Lock()
+        self.__stop_event = threading.Event()
+
+
+    def submit(self, msg:dict):
+        self.queue.put(msg)
+        if self.__thread is None or not self.__thread.is_alive():
+            self.start()
+
+
+    def start(self):
+        with self.__threadLock:
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+            self.__stop_event.clear()
+            self.__thread = threading.Thread(target=self.__loop, name='{}SinkThread'.format(self.name), daemon=True)
+            self.__thread.start()
+
+
+    def stop(self):
+        self.__stop_event.set()
+
+
+    def __loop(self):
+        self.__logger.debug('{} sink worker started'.format(self.name))
+        while not self.__stop_event.is_set():
+            try:
+                msg = self.queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                self.deliver(msg)
+                self.delivered += 1
+                self.consecutiveFailures = 0
+                self.backoff = 0
+            except Exception as e:
+                self.failed += 1
+                self.consecutiveFailures += 1
+                self.lastError = str(e)
+                self.backoff = min(self.MAX_BACKOFF, self.MIN_BACKOFF * 2 ** (self.consecutiveFailures -1))
+                self.__logger.warning('{} sink could not deliver {} ({}), retry in {}s'.format(
+                                        self.name, msg.get('event'), str(e), self.backoff))
+            finally:
+                self.queue.task_done()
+            if self.backoff > 0:
+                # Messages keep queueing (coalescing, dropping the oldest) meanwhile
+                self.__stop_event.wait(self.backoff)
+        self.__logger.debug('{} sink worker stopped'.format(self.name))
+
+
+    def diag(self) -> dict:
+        diag = super().diag()
+        diag.update({
+            "alive"               : self.__thread is not None and self.__thread.is_alive(),
+            "consecutiveFailures" : self.consecutiveFailures,
+            "backoff"             : self.backoff,
+            "queue"               : self.queue.diag()
+            })
+        return diag
+
+
+class WebSocketSink(OutboundEventSink):
+    """
+        The websocket emit queue and its WebSocketQueueReaderBackgroundTask are the queue and worker of this sink
+    """
+    name = 'websocket'
+
+    def deliver(self, msg:dict):
+        # Import here, OutboundEvent imports this module
+        from nl.oppleo.config.OppleoConfig import OppleoConfig
+        from nl.oppleo.utils.OutboundEvent import OutboundEvent
+        OutboundEvent.emitWebsocketEvent(wsEmitQueue=OppleoConfig().wsEmitQueue,
+                                         event=msg.get('event'),
+                                         data=msg.get('data'),
+                                         status=msg.get('status'),
+                                         id=msg.get('id'),
+                                         namespace=msg.get('namespace'),
+                                         public=msg.get('public', False),
+                                         room=msg.get('room'))
+
+
+class MqttSink(QueuedSink):
+    name = 'mqtt'
+
+    def accepts(self, msg:dict) -> bool:
+        # Webclient specific messages (system status on connect) are not send to MQTT
+        return oppleoSystemConfig.mqttOutboundEnabled and msg.get('room') is None
+
+    def deliver(self, msg:dict):
+        from nl.oppleo.utils.OutboundEvent import OutboundEvent
+        OutboundEvent.publishMQTTEvent(event=msg.get('event'),
+                                       data=msg.get('data'),
+                                       status=msg.get('status'),
+                                       id=msg.get('id'),
+                                       namespace=msg.get('namespace'))
+
+
+class HomeAssistantSink(QueuedSink):
+    """
+        Energy measurements (status_update on /usage) to the HomeAssistantMqttHandlerThread
+    """
+    name = 'homeassistant'
+
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+
+    def accepts(self, msg:dict) -> bool:
+        return msg.get('namespace') == '/usage' and msg.get('event') == 'status_update' and \
+               isinstance(msg.get('data'), dict)
+
+    def deliver(self, msg:dict):
+        self.handler.energyUpdate(device_measurement=msg.get('data'))
+
+
+class LiveStateSink(OutboundEventSink):
+    """
+        The state carrying events to the LiveStateStore, on the dispatching thread (a dict assignment)
+    """
+    name = 'livestate'
+
+    def accepts(self, msg:dict) -> bool:
+        # Not the messages for one webclient, the snapshot itself is one
+        return msg.get('room') is None
+
+    def deliver(self, msg:dict):
+        # Import here, the LiveStateStore imports the modules raising the events
+        from nl.oppleo.services.LiveStateStore import LiveStateStore
+        LiveStateStore().update(msg)
+
+
+class OutboundEventDispatcher(object, metaclass=Singleton):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+
+    def __init__(self):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.__sinks = {}
+        self.__lock = threading.Lock()
+        self.addSink(WebSocketSink())
+        self.addSink(MqttSink())
+        self.addSink(LiveStateSink())
+
+
+    def addSink(self, sink:OutboundEventSink):
+        with self.__lock:
+            self.__sinks[sink.name] = sink
+
+
+    def removeSink(self, name:str):
+        with self.__lock:
+            sink = self.__sinks.pop(name, None)
+        if isinstance(sink, QueuedSink):
+            sink.stop()
+
+
+    """
+        sinks limits the dispatch to the named sinks
+    """
+    def dispatch(self, msg:dict, sinks:list=None):
+        for sink in list(self.__sinks.values()):
+            if sinks is not None and sink.name not in sinks:
+                continue
+            try:
+                if sink.accepts(msg):
+                    sink.submit(msg)
+            except Exception as e:
+                self.__logger.warning('Could not dispatch {} to {} sink: {}'.format(msg.get('event'), sink.name, str(e)))
+
+
+    def diag(self) -> dict:
+        return { name: sink.diag() for name, sink in list(self.__sinks.items()) }
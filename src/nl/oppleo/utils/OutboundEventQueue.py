@@ -0,0 +1,119 @@
+import logging
+from collections import deque
+from queue import Queue
+
+from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
+
+oppleoSystemConfig = OppleoSystemConfig()
+
+"""
+ Bounded queue for outbound event messages (the msg dicts of OutboundEvent and WebSocketUtil), a drop-in for the
+ queue.Queue the WebSocketQueueReaderBackgroundTask reads from.
+
+ State events only matter for their latest value. A state event has one slot per (namespace, event, room, entity),
+ a new value for a pending slot replaces the queued message in place and keeps its position and queued_at. The
+ entity is taken from a data field, charge_session_data_update of one session must not replace that of another.
+
+ Other events are fire-and-forget. put() never blocks the producing thread (energy device, charger handler), when the
+ queue is full the oldest fire-and-forget message is dropped to make room. When the queue only holds state slots the
+ new message is dropped.
+"""
+
+# (namespace, event) -> data field identifying the entity, None if the event has one value per room
+STATE_EVENTS = {
+    ('/usage', 'status_update')                         : 'energy_device_id',
+    ('/charge_session', 'charge_session_data_update')   : 'id',
+    ('/mqtt', 'mqtt_send_history_update')               : None
+    }
+
+class OutboundEventQueue(Queue):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+    MAX_SIZE = 1000
+
+    # Counters
+    queued = 0
+    coalesced = 0
+    dropped = 0
+
+    def __init__(self, maxsize:int=MAX_SIZE, stateEvents:dict=STATE_EVENTS):
+        self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))
+        self.stateEvents = stateEvents
+        # Slot key -> pending msg dict
+        self.slots = {}
+        self.droppedPerEvent = {}
+        super().__init__(maxsize=maxsize)
+
+
+    def __key(self, msg:dict):
+        namespace, event = msg.get('namespace'), msg.get('event')
+        if (namespace, event) not in self.stateEvents:
+            return None
+        field = self.stateEvents[(namespace, event)]
+        data = msg.get('data')
+        entity = data.get(field) if field is not None and isinstance(data, dict) else None
+        return (namespace, event, msg.get('room'), entity)
+
+
+    def __drop(self, msg:dict):
+        self.dropped += 1
+        event = '{}/{}'.format(msg.get('namespace'), msg.get('event'))
+        self.droppedPerEvent[event] = self.droppedPerEvent.get(event, 0) + 1
+
+
+    """
+        Never blocks, block and timeout are accepted for compatibility with Queue.put()
+    """
+    def put(self, msg:dict, block:bool=True, timeout:float=None):
+        with self.not_full:
+            key = self.__key(msg)
+            if key is not None and key in self.slots:
+                pending = self.slots[key]
+                queuedAt = pending.get('queued_at')
+                pending.clear()
+                pending.update(msg)
+                if queuedAt is not None:
+                    pending['queued_at'] = queuedAt
+                self.coalesced += 1
+                return
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                # Evict the oldest fire-and-forget message
+                victim = next((pending for pending in self.queue if self.__key(pending) is None), None)
+                if victim is None:
+                    self.__drop(msg)
+                    self.__logger.debug('Queue full of state events, dropped {}'.format(msg.get('event')))
+                    return
+                self.queue.remove(victim)
+                self.unfinished_tasks -= 1
+                self.__drop(victim)
+                self.__logger.debug('Queue full, dropped {}'.format(victim.get('event')))
+            self._put(msg)
+            if key is not None:
+                self.slots[key] = msg
+            self.queued += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+    def _init(self, maxsize):
+        self.queue = deque()
+
+
+    def _get(self):
+        msg = self.queue.popleft()
+        key = self.__key(msg)
+        if key is not None and self.slots.get(key) is msg:
+            del self.slots[key]
+        return msg
+
+
+    def diag(self) -> dict:
+        with self.mutex:
+            return {
+                "maxSize"           : self.maxsize,
+                "depth"             : self._qsize(),
+                "stateSlots"        : len(self.slots),
+                "queued"            : self.queued,
+                "coalesced"         : self.coalesced,
+                "dropped"           : self.dropped,
+                "droppedPerEvent"   : dict(self.droppedPerEvent)
+                }
@@ -0,0 +1,187 @@
+import json
+import threading
+from collections import OrderedDict
+from json.encoder import encode_basestring, encode_basestring_ascii
+from datetime import datetime
+
+"""
+ Canonical serialization of the measurement and charge session payloads.
+
+ A payload is built once per measurement or session update (EnergyDeviceMeasureModel.payload(),
+ ChargeSessionModel.to_str()) as a Payload, a dict which caches its own json encoding. The same Payload object travels
+ through the OutboundEventDispatcher to the websocket, MQTT and Home Assistant sinks. dumps() splices the cached
+ encoding of every Payload it finds into the document it builds, so the websocket packet, the MQTT message and the HTTP
+ response encode a payload once between them. This module is the json module of Flask-SocketIO (dumps, loads).
+
+ The payload format is unchanged: values are strings, timestamps formatted as 'dd/mm/YYYY, HH:MM:SS'.
+ timestamp_str() formats those from a cached date part and lookup tables instead of strftime.
+
+ Stored measurements do not change, their payloads are kept in a small LRU (PayloadCache) by id. The usage HTTP
+ routes serve the latest measurements from the payloads built when they were measured.
+
+ Payloads are shared and read-only for their consumers, a consumer needing changes copies it (dict(payload)).
+ Assigning a field of the measurement drops its payload, the next one is built from the new values.
+"""
+
+TIMESTAMP_FORMAT = '%d/%m/%Y, %H:%M:%S'
+# Compact, the separators of Socket.IO packets. MQTT and HTTP use the same to share the encoding.
+SEPARATORS = (',', ':')
+
+# Encoders of the payloads by separators, json.dumps builds one per call
+_encoders = {}
+
+_TWO_DIGITS = [ '{:02d}'.format(i) for i in range(60) ]
+_dates = {}
+_MAX_DATES = 1024
+
+
+def timestamp_str(ts:datetime) -> str | None:
+    """
+        ts formatted as TIMESTAMP_FORMAT
+    """
+    if ts is None:
+        return None
+    date = ts.date()
+    dateStr = _dates.get(date)
+    if dateStr is None:
+        if len(_dates) >= _MAX_DATES:
+            _dates.clear()
+        dateStr = _dates[date] = ts.strftime('%d/%m/%Y, ')
+    return dateStr + _TWO_DIGITS[ts.hour] + ':' + _TWO_DIGITS[ts.minute] + ':' + _TWO_DIGITS[ts.second]
+
+
+class Payload(dict):
+    """
+        Payload dict caching its json encoding. Changing the dict drops the cached encoding.
+        values holds the source values (floats, datetimes) for consumers computing with them.
+    """
+    __slots__ = ('values', '_encoded')
+
+    def __init__(self, *args, values:dict=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = values
+        self._encoded = None
+
+    def encode(self, separators:tuple=SEPARATORS) -> str:
+        if self._encoded is None or self._encoded[0] != separators:
+            encoder = _encoders.get(separators)
+            if encoder is None:
+                encoder = _encoders[separators] = json.JSONEncoder(default=str, separators=separators)
+            self._encoded = (separators, encoder.encode(self))
+        return self._encoded[1]
+
+    def __setitem__(self, key, value):
+        self._encoded = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._encoded = None
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self._encoded = None
+        super().update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._encoded = None
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self._encoded = None
+        return super().pop(*args)
+
+    def popitem(self):
+        self._encoded = None
+        return super().popitem()
+
+    def clear(self):
+        self._encoded = None
+        super().clear()
+
+
+_LITERALS = { True: 'true', False: 'false', None: 'null' }
+
+
+def _contains_payload(obj, depth:int) -> bool:
+    for value in (obj.values() if isinstance(obj, dict) else obj):
+        if isinstance(value, Payload):
+            return True
+        if depth > 1 and isinstance(value, (dict, list, tuple)) and _contains_payload(value, depth -1):
+            return True
+    return False
+
+
+def _encode(obj, separators:tuple, encode_string, kwargs:dict, depth:int) -> str:
+    if isinstance(obj, Payload):
+        return obj.encode(separators)
+    if isinstance(obj, str):
+        return encode_string(obj)
+    if obj is None or obj is True or obj is False:
+        return _LITERALS[obj]
+    if depth == 0 or not isinstance(obj, (dict, list, tuple)) or not _contains_payload(obj, depth):
+        return json.dumps(obj, separators=separators, **kwargs)
+    if isinstance(obj, dict):
+        return '{' + separators[0].join(
+                    encode_string(key if isinstance(key, str) else json.dumps(key)) + separators[1] +
+                        _encode(value, separators, encode_string, kwargs, depth -1)
+                            for key, value in obj.items()) + '}'
+    return '[' + separators[0].join(_encode(value, separators, encode_string, kwargs, depth -1) for value in obj) + ']'
+
+
+def dumps(obj, **kwargs) -> str:
+    """
+        json.dumps, with the cached encoding of the Payloads in obj
+    """
+    if kwargs.get('indent') is not None or kwargs.get('sort_keys') or kwargs.get('cls') is not None:
+        return json.dumps(obj, **kwargs)
+    separators = tuple(kwargs.pop('separators', None) or (', ', ': '))
+    encode_string = encode_basestring_ascii if kwargs.get('ensure_ascii', True) else encode_basestring
+    return _encode(obj, separators, encode_string, kwargs, 3)
+
+
+def loads(s, **kwargs):
+    return json.loads(s, **kwargs)
+
+
+class PayloadCache(object):
+    """
+        LRU of the payloads of immutable rows (stored measurements), by key
+    """
+    MAX_SIZE = 1000
+    hits = 0
+    misses = 0
+
+    def __init__(self, maxsize:int=MAX_SIZE):
+        self.maxsize = maxsize
+        self.__payloads = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key) -> Payload | None:
+        with self.__lock:
+            payload = self.__payloads.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self.__payloads.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key, payload:Payload):
+        with self.__lock:
+            self.__payloads[key] = payload
+            self.__payloads.move_to_end(key)
+            if len(self.__payloads) > self.maxsize:
+                self.__payloads.popitem(last=False)
+
+    def discard(self, key):
+        with self.__lock:
+            self.__payloads.pop(key, None)
+
+    def diag(self) -> dict:
+        with self.__lock:
+            return {
+                "size"      : len(self.__payloads),
+                "maxSize"   : self.maxsize,
+                "hits"      : self.hits,
+                "misses"    : self.misses
+                }
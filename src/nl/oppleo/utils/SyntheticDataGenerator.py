@@ -0,0 +1,261 @@
+import logging
+import random
+from datetime import datetime, date, timedelta
+
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, Float, DateTime, Boolean, desc, insert
+
+"""
+ Synthetic multi-year, multi-device data for the energy_device_measures, charge_session and rfid tables, written
+ with bulk Core inserts. Reproduces the volume of a charger that has been running for years on a development box, for
+ the benchmark (benchmark_database.py) and query plan checks.
+
+ The tables are defined here (mirroring the models and the Liquibase indexes), the generator does not import the
+ models and therefore does not connect to the configured Oppleo database. Use a table prefix to generate next to
+ existing data, or an empty scratch database without prefix to get the real table names.
+
+ The measurements follow what EnergyDevice stores: while a vehicle charges every changed reading is stored (one per
+ modbus interval), while idle only one reading per hour. storeEveryNthReading > 1 thins out the charging readings,
+ for a smaller database with the same session pattern.
+"""
+
+TRIGGER_RFID = 'RFID'
+TRIGGER_AUTO = 'AUTO'
+
+VEHICLES = [
+    ('Tesla', 'Model 3'), ('Tesla', 'Model Y'), ('Polestar', '2'), ('Volkswagen', 'ID.3'), ('Kia', 'EV6'),
+    ('Hyundai', 'Ioniq 5'), ('Renault', 'Zoe'), ('Nissan', 'Leaf')
+    ]
+
+
+def define_tables(metadata:MetaData=None, prefix:str='') -> dict:
+    metadata = metadata if metadata is not None else MetaData()
+    measures = Table(prefix + 'energy_device_measures', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('energy_device_id', String, nullable=False),
+        Column('created_at', DateTime, nullable=False),
+        *[ Column(name, Float) for name in [ 'kwh_l1', 'kwh_l2', 'kwh_l3', 'a_l1', 'a_l2', 'a_l3', 'p_l1', 'p_l2', 'p_l3',
+                                             'v_l1', 'v_l2', 'v_l3', 'kw_total', 'hz' ] ],
+        Index('idx_{}edm_device_created_at_desc'.format(prefix), 'energy_device_id', desc('created_at'))
+        )
+    sessions = Table(prefix + 'charge_session', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('rfid', String(128), nullable=False),
+        Column('energy_device_id', String(128), nullable=False),
+        Column('start_value', Float),
+        Column('end_value', Float),
+        Column('start_time', DateTime, nullable=False),
+        Column('end_time', DateTime),
+        Column('tariff', Float),
+        Column('total_energy', Float),
+        Column('total_price', Float),
+        Column('km', Integer),
+        Column('trigger', String(12)),
+        Index('idx_{}charge_rfid_start_time_desc'.format(prefix), 'rfid', desc('start_time'))
+        )
+    rfid = Table(prefix + 'rfid', metadata,
+        Column('rfid', String(100), primary_key=True),
+        Column('enabled', Boolean),
+        Column('created_at', DateTime),
+        Column('last_used_at', DateTime),
+        Column('name', String(100)),
+        Column('valid_from', DateTime),
+        Column('valid_until', DateTime),
+        Column('vehicle_make', String(100)),
+        Column('vehicle_model', String(100)),
+        Column('license_plate', String(20)),
+        Column('vehicle_name', String(100)),
+        Column('vehicle_vin', String(100)),
+        Column('api_account', String(256)),
+        Column('get_odometer', Boolean)
+        )
+    return { 'measures': measures, 'sessions': sessions, 'rfid': rfid }
+
+
+class SyntheticDataGenerator(object):
+    __logger = logging.getLogger(f"{__name__}.{__qualname__}")
+
+    # Volume
+    devices = 1
+    deviceNames = None              # Defaults to synthetic_device_1 .. n
+    rfids = 3
+    years = 5
+    endDate = None
+    # Session pattern
+    sessionsPerDay = 0.7            # Per device
+    eveningShare = 0.7              # Sessions starting 17:00-22:00, the others during the day
+    autoSessionShare = 0.1
+    minSessionEnergy = 4.0          # kWh
+    maxSessionEnergy = 60.0
+    chargePower = 11.0              # kW, 3 phases 16A
+    tariffs = [ 0.22, 0.23, 0.25, 0.31, 0.29, 0.27 ]    # €/kWh, one per year, the last one repeats
+    # Compression, see EnergyDevice
+    modbusInterval = 10             # Seconds between readings while charging
+    idleInterval = 3600             # Seconds between stored readings while idle
+    storeEveryNthReading = 1
+    # Bulk insert
+    batchSize = 5000
+    seed = 1
+
+    counts = None
+
+    def __init__(self, engine, tables:dict=None, **kwargs):
+        self.engine = engine
+        self.tables = tables if tables is not None else define_tables()
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise KeyError('Unknown generator setting {}'.format(key))
+            setattr(self, key, value)
+        if self.deviceNames is not None:
+            self.devices = len(self.deviceNames)
+        self.endDate = self.endDate if self.endDate is not None else date.today()
+        self.random = random.Random(self.seed)
+        self.counts = { 'measures': 0, 'sessions': 0, 'rfid': 0 }
+
+
+    def create_tables(self, drop:bool=False):
+        tables = list(self.tables.values())
+        metadata = tables[0].metadata
+        if drop:
+            metadata.drop_all(self.engine, tables=tables)
+        metadata.create_all(self.engine, tables=tables)
+
+
+    def drop_tables(self):
+        tables = list(self.tables.values())
+        tables[0].metadata.drop_all(self.engine, tables=tables)
+
+
+    def estimate(self) -> dict:
+        days = self.years * 365
+        sessions = int(days * self.devices * self.sessionsPerDay)
+        avgHours = (self.minSessionEnergy + self.maxSessionEnergy) / 2 / self.chargePower
+        charging = int(sessions * avgHours * 3600 / self.modbusInterval / self.storeEveryNthReading)
+        idle = int(days * self.devices * 24 * 3600 / self.idleInterval)
+        return { 'measures': charging + idle, 'sessions': sessions, 'rfid': self.rfids }
+
+
+    """
+        Generate everything, returns the number of rows per table
+    """
+    def generate(self) -> dict:
+        startDate = self.endDate - timedelta(days=self.years * 365)
+        self.__logger.info('generate() - {} device(s), {} rfid(s), {} until {}, estimate {}'.format(
+                self.devices, self.rfids, startDate, self.endDate, self.estimate()))
+        tokens = self.__generateRfids(startDate)
+        self.__measures = []
+        self.__sessions = []
+        deviceNames = self.deviceNames if self.deviceNames is not None else \
+                        [ 'synthetic_device_{}'.format(device +1) for device in range(self.devices) ]
+        for device in deviceNames:
+            self.__generateDevice(device, startDate, tokens)
+        self.__flush(force=True)
+        self.__logger.info('generate() - done {}'.format(self.counts))
+        return dict(self.counts)
+
+
+    def __generateRfids(self, startDate:date) -> list:
+        tokens = []
+        rows = []
+        for i in range(self.rfids):
+            make, model = self.random.choice(VEHICLES)
+            token = '{:012d}'.format(self.random.randrange(10**11, 10**12))
+            created = datetime.combine(startDate, datetime.min.time())
+            rows.append({ 'rfid': token, 'enabled': True, 'created_at': created, 'last_used_at': None,
+                          'name': 'Synthetic {}'.format(i +1), 'valid_from': created, 'valid_until': None,
+                          'vehicle_make': make, 'vehicle_model': model, 'license_plate': 'SYN-{:03d}'.format(i +1),
+                          'vehicle_name': '{} {}'.format(make, model), 'vehicle_vin': None, 'api_account': None,
+                          'get_odometer': False })
+            tokens.append({ 'rfid': token, 'km': self.random.randrange(0, 50000), 'last_used_at': None })
+        with self.engine.begin() as connection:
+            connection.execute(insert(self.tables['rfid']), rows)
+        self.counts['rfid'] += len(rows)
+        return tokens
+
+
+    def __tariff(self, day:date, startDate:date) -> float:
+        return self.tariffs[min(len(self.tariffs) -1, (day - startDate).days // 365)]
+
+
+    def __generateDevice(self, device:str, startDate:date, tokens:list):
+        kwTotal = round(self.random.uniform(0, 500), 1)
+        # Idle readings up to (excluding) this moment
+        cursor = datetime.combine(startDate, datetime.min.time())
+        day = startDate
+        while day < self.endDate:
+            for start in self.__sessionStarts(day):
+                if start <= cursor:
+                    # Overlaps the previous session
+                    continue
+                self.__idle(device, cursor, start, kwTotal)
+                token = self.random.choice(tokens)
+                energy = round(self.random.uniform(self.minSessionEnergy, self.maxSessionEnergy), 1)
+                end = self.__charge(device, start, kwTotal, energy)
+                tariff = self.__tariff(day, startDate)
+                token['km'] += self.random.randrange(50, 800)
+                self.__sessions.append({ 'rfid': token['rfid'], 'energy_device_id': device,
+                                         'start_value': kwTotal, 'end_value': round(kwTotal + energy, 1),
+                                         'start_time': start, 'end_time': end, 'tariff': tariff,
+                                         'total_energy': energy, 'total_price': round(energy * tariff, 2),
+                                         'km': token['km'],
+                                         'trigger': TRIGGER_AUTO if self.random.random() < self.autoSessionShare else TRIGGER_RFID })
+                kwTotal = round(kwTotal + energy, 1)
+                cursor = end
+            day += timedelta(days=1)
+            self.__flush()
+        self.__idle(device, cursor, datetime.combine(self.endDate, datetime.min.time()), kwTotal)
+
+
+    def __sessionStarts(self, day:date) -> list:
+        # Poisson-like, mostly 0 or 1, sometimes 2 sessions a day
+        sessions = 0
+        remaining = self.sessionsPerDay
+        while remaining > 0 and self.random.random() < min(remaining, 1):
+            sessions += 1
+            remaining -= 1
+        starts = []
+        for _ in range(sessions):
+            hour = self.random.uniform(17, 22) if self.random.random() < self.eveningShare else self.random.uniform(7, 16)
+            starts.append(datetime.combine(day, datetime.min.time()) + timedelta(hours=hour))
+        return sorted(starts)
+
+
+    def __reading(self, device:str, at:datetime, kwTotal:float, amps:float) -> dict:
+        volts = [ round(self.random.gauss(230, 2), 1) for _ in range(3) ]
+        return { 'energy_device_id': device, 'created_at': at,
+                 'kwh_l1': round(kwTotal / 3, 1), 'kwh_l2': round(kwTotal / 3, 1), 'kwh_l3': round(kwTotal / 3, 1),
+                 'a_l1': amps, 'a_l2': amps, 'a_l3': amps,
+                 'p_l1': round(amps * volts[0] / 1000, 2), 'p_l2': round(amps * volts[1] / 1000, 2), 'p_l3': round(amps * volts[2] / 1000, 2),
+                 'v_l1': volts[0], 'v_l2': volts[1], 'v_l3': volts[2],
+                 'kw_total': round(kwTotal, 1), 'hz': round(self.random.gauss(50, 0.02), 2) }
+
+
+    def __idle(self, device:str, start:datetime, end:datetime, kwTotal:float):
+        at = start
+        while at < end:
+            self.__measures.append(self.__reading(device, at, kwTotal, 0.0))
+            at += timedelta(seconds=self.idleInterval)
+
+
+    def __charge(self, device:str, start:datetime, kwTotal:float, energy:float) -> datetime:
+        seconds = int(energy / self.chargePower * 3600)
+        step = self.modbusInterval * self.storeEveryNthReading
+        amps = round(self.chargePower * 1000 / 3 / 230, 1)
+        for offset in range(0, seconds, step):
+            self.__measures.append(self.__reading(device, start + timedelta(seconds=offset),
+                                                  kwTotal + energy * offset / seconds, amps))
+        end = start + timedelta(seconds=seconds)
+        self.__measures.append(self.__reading(device, end, kwTotal + energy, 0.0))
+        return end
+
+
+    def __flush(self, force:bool=False):
+        if len(self.__measures) >= self.batchSize or (force and len(self.__measures) > 0):
+            with self.engine.begin() as connection:
+                connection.execute(insert(self.tables['measures']), self.__measures)
+            self.counts['measures'] += len(self.__measures)
+            self.__measures = []
+        if len(self.__sessions) >= self.batchSize or (force and len(self.__sessions) > 0):
+            with self.engine.begin() as connection:
+                connection.execute(insert(self.tables['sessions']), self.__sessions)
+            self.counts['sessions'] += len(self.__sessions)
+            self.__sessions = []
@@ -0,0 +1,50 @@
+import threading
+import time
+
+"""
+ Token bucket rate limiter. The bucket fills with rate tokens per second up to capacity (the burst), a consumer takes
+ the tokens it needs and waits for the shortfall.
+
+ Taking more than is available leaves the bucket in debt, the next consumer waits for the debt to be paid off. This
+ allows a single amount larger than the capacity (a big MQTT payload against a bytes per second limit) without ever
+ blocking forever. A rate of 0 or None is unlimited.
+"""
+
+class TokenBucket(object):
+    # Seconds waited in total
+    waited = 0
+
+    def __init__(self, rate:float=None, capacity:float=None):
+        self.__lock = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.__tokens = self.capacity or 0
+        self.__last = time.monotonic()
+
+
+    """
+        Takes amount tokens, returns the seconds to wait before the amount may be used
+    """
+    def reserve(self, amount:float=1) -> float:
+        if not self.rate:
+            return 0
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            self.__tokens -= amount
+            return -self.__tokens / self.rate if self.__tokens < 0 else 0
+
+
+    """
+        Takes amount tokens and waits until they may be used. A set stop_event ends the wait early.
+    """
+    def consume(self, amount:float=1, stop_event:threading.Event=None) -> float:
+        wait = self.reserve(amount)
+        if wait > 0:
+            self.waited += wait
+            if stop_event is not None:
+                stop_event.wait(wait)
+            else:
+                time.sleep(wait)
+        return wait
@@ -10,6 +10,7 @@ from nl.oppleo.utils.OutboundEvent import OutboundEvent
 
 from nl.oppleo.models.ChargeSessionModel import ChargeSessionModel
 from nl.oppleo.models.RfidModel import RfidModel
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
 
 from nl.oppleo.api.VehicleApi import VehicleApi
 
@@ -166,6 +167,7 @@ class UpdateOdometerUtil:
                 return
             charge_session.km = odometer
             charge_session.save()
+            OpenChargeSessionRegistry().track(charge_session)
         self.__logger.debug("Obtained odometer {} for {} ".format(
             charge_session.km,
             rfid_model.vehicle_name if rfid_model.vehicle_name is not None else 'unknown vehicle'
@@ -211,6 +213,7 @@ class UpdateOdometerUtil:
                         closed_charge_session=same_charge_session,
                         new_charge_session=charge_session
                         )
+                    OpenChargeSessionRegistry().track(charge_session)
                     if (len(oppleoConfig.connectedClients) > 0):
                         # Send change notification
                         self.sendChargeSessionUpdate(event='charge_session_condensed', data={ 'surviveId': charge_session.id, 'deleteId': same_charge_session_id })
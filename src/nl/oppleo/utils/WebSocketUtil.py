@@ -1,5 +1,6 @@
     
 import logging
+import time
 
 class WebSocketUtil(object):
     __logger = logging.getLogger(f"{__name__}.{__qualname__}")
@@ -36,6 +37,8 @@ class WebSocketUtil(object):
                 msg['room'] = room
             msg['namespace'] = namespace
             msg['public'] = public
+            # Latency of the websocket emit is measured from here (WebSocketQueueReaderBackgroundTask)
+            msg['queued_at'] = time.monotonic()
             WebSocketUtil.__logger.debug(f'Submit msg to websocket emit queue ... {msg}')
             wsEmitQueue.put(msg)
         else:
@@ -69,8 +69,10 @@ try:
     # https://flask-wtf.readthedocs.io/en/v0.12/csrf.html
     CSRFProtect(app)
 
-    from flask_socketio import SocketIO, emit
-    appSocketIO = SocketIO(app)
+    from flask_socketio import SocketIO, emit, join_room
+    from nl.oppleo.utils import PayloadSerializer
+    # PayloadSerializer encodes the packets, reusing the encoding of the measurement and session payloads
+    appSocketIO = SocketIO(app, json=PayloadSerializer)
     # Make it available through oppleoConfig
     oppleoConfig.appSocketIO = appSocketIO
 
@@ -79,7 +81,8 @@ try:
 
     from flask_login import LoginManager, current_user
     import threading
-    from queue import Queue
+    from nl.oppleo.utils.OutboundEventQueue import OutboundEventQueue
+    from nl.oppleo.utils.OutboundEventDispatcher import OutboundEventDispatcher, HomeAssistantSink
     from sqlalchemy.exc import OperationalError
     from sqlalchemy import event
 
@@ -93,6 +96,10 @@ try:
     from nl.oppleo.daemon.ChargerHandlerThread import ChargerHandlerThread
     from nl.oppleo.daemon.PeakHoursMonitorThread import PeakHoursMonitorThread
     from nl.oppleo.services.HomeAssistantMqttHandlerThread import HomeAssistantMqttHandlerThread 
+    from nl.oppleo.services.RfidCache import RfidCache
+    from nl.oppleo.services.UserCache import UserCache
+    from nl.oppleo.services.LiveStateStore import LiveStateStore
+    from nl.oppleo.services.WriteSpool import WriteSpool
     
     from nl.oppleo.services.Buzzer import Buzzer
     from nl.oppleo.services.EvseOutput import EvseOutput
@@ -104,7 +111,7 @@ try:
     from nl.oppleo.utils.BackupUtil import BackupUtil
 
     # Create an emit queue, for other Threads to communicate to th ews emit background task
-    wsEmitQueue = Queue()
+    wsEmitQueue = OutboundEventQueue()
     oppleoConfig.wsEmitQueue = wsEmitQueue
     oppleoSystemConfig.wsEmitQueue = wsEmitQueue
 
@@ -117,6 +124,7 @@ try:
 
     threadLock = threading.Lock()
     wsqrbBackgroundTask = WebSocketQueueReaderBackgroundTask()
+    oppleoConfig.wsqrbTask = wsqrbBackgroundTask
 
     wsClientCnt = 0
 
@@ -166,7 +174,8 @@ try:
 
     @oppleoConfig.login_manager.user_loader
     def load_user(username):
-        return User.get(username)
+        # Cached, every request and socket connect resolves the user
+        return UserCache().get(username)
 
     @appSocketIO.on("connect", namespace="/system_status")
     @appSocketIO.on("connect", namespace="/charge_session")
@@ -185,13 +194,12 @@ try:
 
         with threadLock:
             wsClientCnt += 1
-            if request.sid not in oppleoConfig.connectedClients.keys():
-                oppleoConfig.connectedClients[request.sid] = {
-                                    'sid'       : request.sid,
-                                    'auth'      : False if current_user is None or not current_user.is_authenticated else True,
-                                    'stats'     : 'connected',
-                                    'namespace' : request.namespace if request.namespace is not None else 'UNKNOWN'
-                                    }
+            authenticated = False if current_user is None or not current_user.is_authenticated else True
+            if oppleoConfig.addConnectedClient(sid=request.sid,
+                                               namespace=request.namespace if request.namespace is not None else 'UNKNOWN',
+                                               auth=authenticated) and authenticated:
+                # Private events of this namespace are emitted to the auth room
+                join_room(oppleoConfig.AUTH_ROOM, sid=request.sid, namespace=request.namespace)
         # TODO REMOVE - EXTRA LOGGING
         oppleoLogger.debug('socketio.connect [2] (sid: {sid}, wsClientCnt: {wsClientCnt})'.format(sid=request.sid, wsClientCnt=wsClientCnt))
                 
@@ -227,6 +235,16 @@ try:
                 public=False,
                 room=request.sid
             )
+        if request.namespace == LiveStateStore.NAMESPACE:
+            # The live state in one message, the client does not have to ask for it (database)
+            OutboundEvent.triggerEvent(
+                    event=LiveStateStore.EVENT,
+                    id=oppleoConfig.chargerID,
+                    data=LiveStateStore().snapshot(auth=authenticated),
+                    namespace=LiveStateStore.NAMESPACE,
+                    public=False,
+                    room=request.sid
+                )
         # TODO REMOVE - EXTRA LOGGING
         oppleoLogger.debug('socketio.connect [4] (sid: {sid}, wsClientCnt: {wsClientCnt})'.format(sid=request.sid, wsClientCnt=wsClientCnt))
 
@@ -249,7 +267,8 @@ try:
 
         with threadLock:
             wsClientCnt -= 1
-            res = oppleoConfig.connectedClients.pop(request.sid, None)
+            # The socketio server removes the sid from its rooms on disconnect
+            res = oppleoConfig.removeConnectedClient(request.sid)
 
         oppleoLogger.debug('socketio.disconnect sid: {} wsClientCnt: {} connectedClients:{} res:{}'.format( \
                         request.sid, \
@@ -299,6 +318,31 @@ try:
     def RfidModel_after_update(mapper, connection, target):
         global oppleoLogger
         oppleoLogger.debug("'after_insert' or 'after_update' event for RfidModel")
+        # Keep the rfid cache current
+        RfidCache().put(target)
+
+
+    @event.listens_for(RfidModel, 'after_delete')
+    def RfidModel_after_delete(mapper, connection, target):
+        global oppleoLogger
+        oppleoLogger.debug("'after_delete' event for RfidModel")
+        RfidCache().invalidate(target.rfid)
+
+
+    @event.listens_for(User, 'after_update')
+    @event.listens_for(User, 'after_insert')
+    def User_after_update(mapper, connection, target):
+        global oppleoLogger
+        oppleoLogger.debug("'after_insert' or 'after_update' event for User")
+        # Password, 2FA or login state changed, effective on the next request
+        UserCache().put(target)
+
+
+    @event.listens_for(User, 'after_delete')
+    def User_after_delete(mapper, connection, target):
+        global oppleoLogger
+        oppleoLogger.debug("'after_delete' event for User")
+        UserCache().invalidate(target.username)
 
 
     if __name__ == "__main__":
@@ -344,6 +388,9 @@ try:
                 wsEmitQueue=wsEmitQueue
                 )
 
+        # Replays writes spooled during a database outage in a previous run
+        WriteSpool()
+
         # Start the Energy Device Monitor
         if meuThread is not None:
             meuThread.start()
@@ -400,8 +447,8 @@ try:
 
         homeAssistantMqttHandlerThread = HomeAssistantMqttHandlerThread()
 
-        if meuThread is not None:
-            meuThread.addCallback(homeAssistantMqttHandlerThread.energyUpdate)
+        # Measurements (status_update events) reach Home Assistant through its own sink queue and worker
+        OutboundEventDispatcher().addSink(HomeAssistantSink(homeAssistantMqttHandlerThread))
 
         # Loop the thread
         homeAssistantMqttHandlerThread.start()
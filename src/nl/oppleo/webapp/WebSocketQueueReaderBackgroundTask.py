@@ -1,6 +1,8 @@
 import logging
 import threading
 import time
+from collections import deque
+from queue import Empty
 
 from nl.oppleo.config.OppleoSystemConfig import OppleoSystemConfig
 from nl.oppleo.config.OppleoConfig import OppleoConfig
@@ -9,11 +11,20 @@ from nl.oppleo.config.OppleoConfig import OppleoConfig
   As Flask uses it's own socketio implementation, which allows emit only from the main Thread or greenlet threads
   started as background task, this is a greenlet thread background task reading from a queue and emitting messages
   to web sockets
+
+  Every wakeup drains all queued messages (up to MAX_BATCH) and emits them in one go. In threading mode the task
+  blocks on the queue until a message arrives. In eventlet/gevent mode the producers are OS threads which cannot wake
+  a greenlet, a blocking get would stall the whole hub, so the task yields for POLL_ACTIVE seconds while messages keep
+  coming and backs off to POLL_IDLE when the queue stays empty.
+  The messages carry the time they were queued (QUEUED_AT), the latency is measured from there to the emit.
 """
 
 oppleoSystemConfig = OppleoSystemConfig()
 oppleoConfig = OppleoConfig()
 
+# Key in the queued msg dict holding time.monotonic() at submit
+QUEUED_AT = 'queued_at'
+
 class WebSocketQueueReaderBackgroundTask(object):
     # Count the message updates send through the websocket
     __logger = logging.getLogger(f"{__name__}.{__qualname__}")
@@ -23,86 +34,126 @@ class WebSocketQueueReaderBackgroundTask(object):
     wsEmitQueue = None
     stop_event = None
 
+    # Seconds
+    BLOCK_TIMEOUT = 0.5
+    POLL_ACTIVE = 0.02
+    POLL_IDLE = 0.25
+    # Messages emitted per wakeup, the rest waits for the next wakeup
+    MAX_BATCH = 250
+
+    batches = 0
+    maxBatch = 0
+    maxDepth = 0
+    skipped = 0
+    lastLatency = 0
+    maxLatency = 0
+    __latencies = None
+
     def __init__(self):
         self.__logger.setLevel(level=oppleoSystemConfig.getLogLevelForModule(self.__class__.__module__))   
         self.thread = None
         self.stop_event = threading.Event()
+        self.__latencies = deque(maxlen=1000)
 
     def stop(self):
         self.__logger.debug('Requested to stop')
         self.stop_event.set()
 
+    def __blocking(self) -> bool:
+        return getattr(self.appSocketIO, 'async_mode', None) == 'threading'
+
+    """
+        Returns the queued messages, waits for the first one
+    """
+    def __next_batch(self, poll:float) -> list:
+        batch = []
+        if self.__blocking():
+            try:
+                batch.append(self.wsEmitQueue.get(block=True, timeout=self.BLOCK_TIMEOUT))
+            except Empty:
+                return batch
+        else:
+            self.appSocketIO.sleep(poll)
+        while len(batch) < self.MAX_BATCH:
+            try:
+                batch.append(self.wsEmitQueue.get_nowait())
+            except Empty:
+                break
+        return batch
+
     def websocket_start(self):
         global oppleoConfig
         self.__logger.debug('Starting background task...')
+        poll = self.POLL_IDLE
         while not self.stop_event.is_set():
-            # Sleep is interruptable by other threads, so sleep for 0.1 seconds, then check passed time
-
-            if not self.wsEmitQueue.empty():
-                # Blocking call, make sure there is a message to obtain
-                msg = self.wsEmitQueue.get()
-                """
-                msg is a dict object with event, data, and namespace
-                """
-                # Emit as web socket update
-                self.counter += 1
-                self.__logger.debug(f'Send msg {self.counter} via websocket ...{msg}')
-                m_body = {}
-                if 'data' in msg and msg['data'] is not None:
-                    m_body['data'] = msg['data']
-                if 'id' in msg and  msg['id'] is not None:
-                    m_body['id'] = msg['id']
-                if 'status' in msg and  msg['status'] is not None:
-                    m_body['status'] = msg['status']
-                if ('public' in msg and msg['public']):
-                    self.appSocketIO.emit(
-                            event=msg['event'],
-                            data=m_body,
-                            namespace=msg['namespace']
-                        )
-                else:
-                    """
-                        Private message
-                        - Emit only to recipient or to all authenticated clients
-                        - room is the request.sid of the specific client
-                    """
-                    if ('room' in msg and msg['room'] is not None):
-                        # Emit only to a specific room, or recipient (sid)
-                        self.appSocketIO.emit(
-                                event=msg['event'],
-                                data=m_body,
-                                namespace=msg['namespace'],
-                                room=msg['room']
-                                )
-                    else:
-                        # Emit to authenticated clients
-                        # room is the request.sid of the specific client
-                        # connectedClients can change at any time. Iterating can cause issues. list() creates a copy of the keys
-                        for sid in list(oppleoConfig.connectedClients):
-                            # oppleoConfig.connectedClients[sid] raises KeyError is key does not exist. Get does not.
-                            connectedClient = oppleoConfig.connectedClients.get(sid, None)
-                            if connectedClient is None:
-                                # pass this sid, no longer connected
-                                continue
-                            if 'auth' in connectedClient and connectedClient['auth']:
-                                # Authenticated client, emit data
-                                self.__logger.debug('Sending msg {} via websocket to {}...'.format(msg, connectedClient['sid']))
-                                self.appSocketIO.emit(
-                                        event=msg['event'],
-                                        data=m_body,
-                                        namespace=msg['namespace'],
-                                        room=connectedClient['sid']
-                                        )
-                            else:
-                                self.__logger.debug('NOT sending msg {} via websocket to {}...'.format(msg, connectedClient['sid']))
-
-
-                self.wsEmitQueue.task_done()
-            self.appSocketIO.sleep(0.5)
+            depth = self.wsEmitQueue.qsize()
+            self.maxDepth = max(self.maxDepth, depth)
+            batch = self.__next_batch(poll)
+            if len(batch) == 0:
+                poll = min(self.POLL_IDLE, poll * 2)
+                continue
+            poll = self.POLL_ACTIVE
+            self.batches += 1
+            self.maxBatch = max(self.maxBatch, len(batch))
+            for msg in batch:
+                try:
+                    self.__emit(msg)
+                except Exception as e:
+                    self.__logger.warning('Could not emit msg {} via websocket: {}'.format(msg.get('event'), e))
+                finally:
+                    self.wsEmitQueue.task_done()
+            if not self.__blocking():
+                # Let the emits go out before draining the next batch
+                self.appSocketIO.sleep(0)
 
         self.__logger.debug(f'Terminating thread')
         # Releasing session if applicable
 
+    def __emit(self, msg:dict):
+        """
+        msg is a dict object with event, data, and namespace
+        """
+        public = 'public' in msg and msg['public']
+        # Public messages go to the whole namespace
+        room = None if public else msg.get('room', None)
+        if not oppleoConfig.hasSubscribers(msg['namespace'], public=public, room=room):
+            # Nobody listening (anymore), do not build or serialize the message
+            self.skipped += 1
+            return
+        # Emit as web socket update
+        self.counter += 1
+        self.__logger.debug(f'Send msg {self.counter} via websocket ...{msg}')
+        m_body = {}
+        if 'data' in msg and msg['data'] is not None:
+            m_body['data'] = msg['data']
+        if 'id' in msg and  msg['id'] is not None:
+            m_body['id'] = msg['id']
+        if 'status' in msg and  msg['status'] is not None:
+            m_body['status'] = msg['status']
+        if public:
+            self.appSocketIO.emit(
+                    event=msg['event'],
+                    data=m_body,
+                    namespace=msg['namespace']
+                )
+        else:
+            """
+                Private message
+                - Emit only to recipient or to all authenticated clients
+                - room is the request.sid of the specific client, or the auth room of the namespace which all
+                  authenticated clients join on connect
+            """
+            self.appSocketIO.emit(
+                    event=msg['event'],
+                    data=m_body,
+                    namespace=msg['namespace'],
+                    to=room if room is not None else oppleoConfig.AUTH_ROOM
+                    )
+        if msg.get(QUEUED_AT) is not None:
+            self.lastLatency = time.monotonic() - msg[QUEUED_AT]
+            self.maxLatency = max(self.maxLatency, self.lastLatency)
+            self.__latencies.append(self.lastLatency)
+
 
     def start(self, appSocketIO, wsEmitQueue):
         self.stop_event.clear()
@@ -114,3 +165,22 @@ class WebSocketQueueReaderBackgroundTask(object):
 
     def wait(self):
         self.thread.join()
+
+
+    def diag(self) -> dict:
+        latencies = sorted(self.__latencies)
+        return {
+            "asyncMode"         : getattr(self.appSocketIO, 'async_mode', None),
+            "emitted"           : self.counter,
+            "skipped"           : self.skipped,
+            "batches"           : self.batches,
+            "avgBatch"          : round(self.counter / self.batches, 1) if self.batches > 0 else 0,
+            "maxBatch"          : self.maxBatch,
+            "queueDepth"        : 0 if self.wsEmitQueue is None else self.wsEmitQueue.qsize(),
+            "maxQueueDepth"     : self.maxDepth,
+            "latencyLastMs"     : round(self.lastLatency * 1000, 1),
+            "latencyAvgMs"      : round(sum(latencies) / len(latencies) * 1000, 1) if len(latencies) > 0 else 0,
+            "latencyP95Ms"      : round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if len(latencies) > 0 else 0,
+            "latencyMaxMs"      : round(self.maxLatency * 1000, 1),
+            "queue"             : self.wsEmitQueue.diag() if hasattr(self.wsEmitQueue, 'diag') else {}
+            }
@@ -48,6 +48,8 @@ from nl.oppleo.api.VehicleApi import VehicleApi
 from nl.oppleo.utils.UpdateOdometerUtil import UpdateOdometerUtil
 from nl.oppleo.services.EvseOutput import EvseOutput
 from nl.oppleo.utils.OutboundEvent import OutboundEvent
+from nl.oppleo.utils.OutboundEventDispatcher import OutboundEventDispatcher
+from nl.oppleo.utils import PayloadSerializer
 from nl.oppleo.utils.GitUtil import GitUtil
 from nl.oppleo.utils.Authenticator import (keyUri, makeQR, generateTotpSharedSecret, encryptAES, decryptAES, validateTotp)
 from nl.oppleo.utils.IPv4 import IPv4
@@ -63,6 +65,11 @@ from nl.oppleo.services.PushMessageProwl import pushMessageProwl
 
 from nl.oppleo.services.OppleoMqttClient import OppleoMqttClient 
 from nl.oppleo.services.HomeAssistantMqttHandlerThread import HomeAssistantMqttHandlerThread 
+from nl.oppleo.services.OpenChargeSessionRegistry import OpenChargeSessionRegistry
+from nl.oppleo.services.LiveStateStore import LiveStateStore
+from nl.oppleo.services.RfidCache import RfidCache
+from nl.oppleo.services.WriteSpool import WriteSpool
+from nl.oppleo.services.OffPeakCalendar import OffPeakCalendar
 
 # https://en.wikipedia.org/wiki/List_of_HTTP_status_codes
 HTTP_CODE_200_OK                    = 200
@@ -130,6 +137,96 @@ def RepresentsFloat(s):
         return False
 
 
+"""
+    Value checks of the settings, shared by /update_settings and /update_settings_bulk. Each returns the value to set,
+    or raises ValueError if the value is not valid.
+"""
+def settingMatch(validation:str):
+    def validate(value):
+        value = str(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+        if not isinstance(value, str) or not re.match(validation, value):
+            raise ValueError('Invalid value')
+        return value
+    return validate
+
+def settingBackupInterval(value) -> str:
+    if value not in [oppleoConfig.BACKUP_INTERVAL_WEEKDAY, oppleoConfig.BACKUP_INTERVAL_CALDAY]:
+        raise ValueError('Invalid backup interval')
+    return value
+
+def settingBackupIntervalDays(days:int):
+    def validate(value) -> str:
+        lst = json.loads(value) if isinstance(value, str) else list(value)
+        if days == 31 and len(lst) == 32:
+            # List is 1 offset, make 0 offset by popping the first entry
+            lst.pop(0)
+        if len(lst) != days or not all(isinstance(x, bool) for x in lst):
+            raise ValueError('Expected a list of {} booleans'.format(days))
+        return json.dumps(lst, default=str)
+    return validate
+
+def settingBackupTimeOfDay(value) -> time:
+    match = re.match(r'^([01]\d|2[0-3]):?([0-5]\d)$', value) if isinstance(value, str) else None
+    if match is None:
+        raise ValueError('Invalid time of day')
+    return time(hour=int(match.group(1)), minute=int(match.group(2)), second=0, microsecond=0)
+
+def settingHistory(value) -> int:
+    return int(settingMatch(r"^(0?[1-9]|[1-9][0-9])$")(value))
+
+settingValidators = {
+    'chargerNameText'       : settingMatch(r"^[0-9a-zA-Z!@#$%^&*()\-\+._/\\[\]{}',:;\" ]+$"),
+    'chargerTariff'         : lambda value: float(settingMatch(r"^(?:0|[1-9][0-9]*)(?:\.[0-9]{1,2})?$")(value)),
+    'receiptPrefix'         : settingMatch(r"^[A-Za-z0-9.-]{0,20}$"),
+    'backupInterval'        : settingBackupInterval,
+    'backupIntervalWeekday' : settingBackupIntervalDays(7),
+    'backupIntervalCalday'  : settingBackupIntervalDays(31),
+    'backupTimeOfDay'       : settingBackupTimeOfDay,
+    'backupLocalHistory'    : settingHistory,
+    'osBackupHistory'       : settingHistory,
+    'webauthnExpectedOrigin': settingMatch(r"^([a-zA-Z0-9]|[\s.:,;|])*$")
+}
+
+"""
+    Start or stop the backup monitor thread with backupEnabled. Call with BackupUtil().lock held, to keep the thread
+    and the setting in sync.
+"""
+def syncBackupMonitorThread():
+    if oppleoConfig.backupEnabled:
+        BackupUtil().startBackupMonitorThread()
+    else:
+        BackupUtil().stopBackupMonitorThread()
+
+"""
+    Announce a change of offpeakEnabled or allowPeakOnePeriod
+"""
+def announceOffPeakStatus():
+    OutboundEvent.triggerEvent(
+            event='off_peak_status_update', 
+            id=oppleoConfig.chargerID,
+            data={ 'isOffPeak': OffPeakCalendar().is_off_peak_now(),
+                    'offPeakEnabled': oppleoConfig.offpeakEnabled,
+                    'peakAllowOnePeriod': oppleoConfig.allowPeakOnePeriod
+            },
+            namespace='/charge_session',
+            public=True
+        )
+
+"""
+    Announce switching the vehicle data on the dashboard off, or request an update when switched on
+"""
+def syncVehicleDataOnDashboard():
+    if not oppleoConfig.vehicleDataOnDashboard:
+        OutboundEvent.triggerEvent(
+            event='vehicle_charge_status_stopped', 
+            id=oppleoConfig.chargerID,
+            namespace='/charge_session',
+            public=False
+            )
+    elif oppleoConfig.vcsmThread is not None:
+        oppleoConfig.vcsmThread.requestChargeStatusUpdate()
+
+
 
 # Resource is only served for logged in user
 def authenticated_resource(function):
@@ -774,6 +871,7 @@ def delete_charge_session(id=None):
         flaskRoutesLogger.debug('delete_charge_session requested and authorized.')
         charge_session = ChargeSessionModel.get_one_charge_session(id)
         charge_session.delete()
+        OpenChargeSessionRegistry().forget(charge_session.id)
         flaskRoutesLogger.debug('delete_charge_session() - id:{} - deleted'.format(id))
         # Send ws update
         OutboundEvent.triggerEvent(
@@ -841,7 +939,7 @@ def start_charge_session(token=None):
         flaskRoutesLogger.debug('start_charge_session requested. authorized with authWebCharge={}.'.format(oppleoConfig.authWebCharge))
 
         with threadLock:
-            charge_session = ChargeSessionModel.get_open_charge_session_for_device(oppleoConfig.chargerID)
+            charge_session = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
             if charge_session is None:
                 if oppleoConfig.chThread.rfidAuthorized(token):
                     oppleoConfig.chThread.start_charge_session(
@@ -852,7 +950,7 @@ def start_charge_session(token=None):
                     oppleoConfig.chThread.buzz_ok()
                     oppleoConfig.chThread.update_charger_and_led(True)
                 else:
-                    rfidToken = RfidModel.get_one(token)
+                    rfidToken = RfidCache().get(token)
 
                     if not rfidToken.enabled:
                         flaskRoutesLogger.warn('Could not start charge session for rfid {} [{}], NotAuthorized!'.format(rfidToken.name, token))
@@ -863,7 +961,7 @@ def start_charge_session(token=None):
                                 )
                    
                     if oppleoConfig.chThread.isExpired(rfidToken.valid_from, rfidToken.valid_until):
-                        rfidToken = RfidModel.get_one(token)
+                        rfidToken = RfidCache().get(token)
                         flaskRoutesLogger.warn('Could not start charge session for rfid {}. Expired!'.format(token))
                         return render_template("errorpages/401-ExpiredException.html", 
                                 requesttitle=str("RFID token niet geldig!"),
@@ -1040,6 +1138,11 @@ def settings(active=1):
     diag['threading'] = {}
     diag['threading']['active_count'] = threading.active_count()
     diag['threading']['rfid_log'] = oppleoConfig.chThread.rfidReaderLog()
+    diag['websocket'] = {} if oppleoConfig.wsqrbTask is None else oppleoConfig.wsqrbTask.diag()
+    diag['outbound'] = OutboundEventDispatcher().diag()
+    diag['liveState'] = LiveStateStore().diag()
+    diag['writeSpool'] = WriteSpool().diag()
+    diag['mqtt'] = OppleoMqttClient().diag() if oppleoSystemConfig.mqttOutboundEnabled else {}
     diag_json = json.dumps(diag)
     # threading.enumerate() not json serializable
     diag['threading']['enum'] = threading.enumerate()
@@ -1055,6 +1158,7 @@ def settings(active=1):
     diag['offPeak']['friday'] = OffPeakHoursModel.get_friday()
     diag['offPeak']['saturday'] = OffPeakHoursModel.get_saturday()
     diag['offPeak']['sunday'] = OffPeakHoursModel.get_sunday()
+    diag['offPeak']['calendar'] = OffPeakCalendar().diag()
 
     diag['modbusConfigOptions'] = modbusConfigOptions
 
@@ -1228,7 +1332,8 @@ def usage_data(cnt=100):
     for o in qr:
         qr_l.append(o.to_dict())  
 
-    return jsonify(qr_l)
+    # The payloads of recent measurements are cached, encoded once
+    return Response(PayloadSerializer.dumps(qr_l, separators=PayloadSerializer.SEPARATORS), mimetype='application/json')
 
 
 # Cnt is a maximum to limit impact of this request
@@ -1247,7 +1352,8 @@ def usage_data_since(since_timestamp, cnt=-1):
     for o in qr:
         qr_l.append(o.to_dict())  
 
-    return jsonify(qr_l)
+    # The payloads of recent measurements are cached, encoded once
+    return Response(PayloadSerializer.dumps(qr_l, separators=PayloadSerializer.SEPARATORS), mimetype='application/json')
 
 
 @flaskRoutes.route("/charger_config/", methods=["GET"])
@@ -1291,11 +1397,12 @@ def charge_session_usage_data(id=None):
     for o in qr:
         qr_l.append(o.to_dict())  
 
-    return jsonify({ 
-            'status'        : HTTP_CODE_200_OK,
-            'id'            : id,
-            'data'          : qr_l
-            })
+    return Response(PayloadSerializer.dumps({ 
+                        'status'        : HTTP_CODE_200_OK,
+                        'id'            : id,
+                        'data'          : qr_l
+                        }, separators=PayloadSerializer.SEPARATORS),
+                    mimetype='application/json')
 
 
 
@@ -1308,10 +1415,7 @@ def active_charge_session():
 
     flaskRoutesLogger.debug(f'active_charge_session()')
     # Open charge session for this energy device?
-    open_charge_session_for_device = \
-        ChargeSessionModel.get_open_charge_session_for_device(
-                oppleoConfig.chargerID
-        )
+    open_charge_session_for_device = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
     evseOutput = EvseOutput()
     if open_charge_session_for_device is None:
         # None, no active session
@@ -1328,7 +1432,7 @@ def active_charge_session():
             'reason'            : 'No active charge session'
             })
     try:
-        rfid_data = RfidModel.get_one(open_charge_session_for_device.rfid)
+        rfid_data = RfidCache().get(open_charge_session_for_device.rfid)
         return jsonify({ 
             'status'            : HTTP_CODE_200_OK,
             'id'                : oppleoConfig.chargerID, 
@@ -1541,6 +1645,7 @@ def charge_session(id:int=None):
 
     # Store the changes
     chargeSession.save()
+    OpenChargeSessionRegistry().track(chargeSession)
 
     OutboundEvent.triggerEvent(
             event='charge_session_data_update', 
@@ -2095,32 +2200,12 @@ def update_settings(param=None, value=None):
 
     if (param == 'offpeakEnabled'):
         oppleoConfig.offpeakEnabled = True if value.lower() in ['true', '1', 't', 'y', 'yes'] else False
-        ophm = OffPeakHoursModel()
-        OutboundEvent.triggerEvent(
-            event='off_peak_status_update', 
-            id=oppleoConfig.chargerID,
-            data={ 'isOffPeak': ophm.is_off_peak_now(),
-                    'offPeakEnabled': oppleoConfig.offpeakEnabled,
-                    'peakAllowOnePeriod': oppleoConfig.allowPeakOnePeriod
-            },
-            namespace='/charge_session',
-            public=True
-            )
+        announceOffPeakStatus()
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': oppleoConfig.offpeakEnabled })
 
     if (param == 'allowPeakOnePeriod'):
         oppleoConfig.allowPeakOnePeriod = True if value.lower() in ['true', '1', 't', 'y', 'yes'] else False
-        ophm = OffPeakHoursModel()
-        OutboundEvent.triggerEvent(
-                event='off_peak_status_update', 
-                id=oppleoConfig.chargerID,
-                data={ 'isOffPeak': ophm.is_off_peak_now(),
-                        'offPeakEnabled': oppleoConfig.offpeakEnabled,
-                        'peakAllowOnePeriod': oppleoConfig.allowPeakOnePeriod
-                },
-                namespace='/charge_session',
-                public=True
-            )
+        announceOffPeakStatus()
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': oppleoConfig.allowPeakOnePeriod })
 
     if (param == 'autoSessionEnabled'):
@@ -2156,19 +2241,13 @@ def update_settings(param=None, value=None):
     # chargerID
     # With an open charge session, there params are not allowed to change
     if (param == 'chargerID' and
-        ChargeSessionModel.has_open_charge_session_for_device(oppleoConfig.chargerID)):
+        OpenChargeSessionRegistry().has_open_session(oppleoConfig.chargerID)):
         return jsonify({ 'status': 409, 'param': param, 'reason': 'Er is een laadsessie actief.' })
 
     if (param == 'chargerID') and isinstance(value, str) and len(value) > 0:
         oppleoConfig.chargerID = value
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value })
 
-    # chargerNameText
-    validation = r"^[0-9a-zA-Z!@#$%^&*()\-\+._/\\[\]{}',:;\" ]+$"
-    if (param == 'chargerNameText') and isinstance(value, str) and re.match(validation, value):
-        oppleoConfig.chargerNameText = value
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
-
     # factorWhkm
     if (param == 'factorWhkm') and (isinstance(value, int) or RepresentsInt(value)):
         oppleoConfig.factorWhkm = int(value)
@@ -2177,12 +2256,17 @@ def update_settings(param=None, value=None):
     # chargerTariff
     # With an open charge session, there params are not allowed to change
     if (param == 'chargerTariff' and
-        ChargeSessionModel.has_open_charge_session_for_device(oppleoConfig.chargerID)):
+        OpenChargeSessionRegistry().has_open_session(oppleoConfig.chargerID)):
         return jsonify({ 'status': 409, 'param': param, 'reason': 'Er is een laadsessie actief.' })
-    validation = r"^(?:0|[1-9][0-9]*)(?:\.[0-9]{1,2})?$"
-    if (param == 'chargerTariff') and (isinstance(value, float) or RepresentsFloat(value)) and re.match(validation, value):
-        oppleoConfig.chargerTariff = float(value)
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value })
+
+    # chargerNameText, chargerTariff, receiptPrefix, the backup schedule, webauthnExpectedOrigin
+    if param in settingValidators:
+        try:
+            validValue = settingValidators[param](value)
+        except (TypeError, ValueError) as e:
+            return jsonify({ 'status': HTTP_CODE_400_BAD_REQUEST, 'param': param, 'value': value, 'reason': str(e) }), HTTP_CODE_400_BAD_REQUEST
+        setattr(oppleoConfig, param, validValue)
+        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
 
     # Enable/ disable the RFID Reader via SPI on the GPIO
     if (param == 'rfidEnabled') and isinstance(value, str):
@@ -2245,7 +2329,7 @@ def update_settings(param=None, value=None):
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value })
 
     # DATABASE_URL
-    validation = r"^postgresql://[a-zA-Z0-9_\-]+:[^@]+@[a-zA-Z0-9_.\-:/]+$"
+    validation = r"^(postgresql://[a-zA-Z0-9_\-]+:[^@]+@[a-zA-Z0-9_.\-:/]+|sqlite:///[a-zA-Z0-9_.\-/]+)$"
     if (param == 'DATABASE_URL') and isinstance(value, str) and re.match(validation, value):
         oppleoSystemConfig.DATABASE_URL = value
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value })
@@ -2603,12 +2687,6 @@ def update_settings(param=None, value=None):
         oppleoConfig.routerIPAddress = value
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
 
-    # receiptPrefix
-    validation = r"^[A-Za-z0-9.-]{0,20}$"
-    if (param == 'receiptPrefix') and isinstance(value, str) and re.match(validation, value):
-        oppleoConfig.receiptPrefix = value
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
-
     # httpPort
     validation = r"^([0-9]{1,4}|[1-5][0-9]{4}|6[0-4][0-9]{3}|65[0-4][0-9]{2}|655[0-2][0-9]|6553[0-5])$"
     if (param == 'httpPort') and isinstance(value, str) and re.match(validation, value):
@@ -2625,65 +2703,12 @@ def update_settings(param=None, value=None):
     if (param == 'backupEnabled'):
         backupUtil = BackupUtil()
         # Make sure the thread running and the config settings are in sync
-        backupUtil.lock.acquire()
-        enableBackup = True if value.lower() in ['true', '1', 't', 'y', 'yes'] else False
-        oppleoConfig.backupEnabled = enableBackup
-        if enableBackup:
-            BackupUtil().startBackupMonitorThread()
-        else:
-            BackupUtil().stopBackupMonitorThread()
-        backupUtil.lock.release()
+        with backupUtil.lock:
+            oppleoConfig.backupEnabled = True if value.lower() in ['true', '1', 't', 'y', 'yes'] else False
+            syncBackupMonitorThread()
 
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': oppleoConfig.backupEnabled }), HTTP_CODE_200_OK
 
-    # backupInterval
-    if ((param == 'backupInterval') and isinstance(value, str) and 
-        (value == oppleoConfig.BACKUP_INTERVAL_WEEKDAY or value == oppleoConfig.BACKUP_INTERVAL_CALDAY) ):
-        oppleoConfig.backupInterval = value
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
-
-    # backupIntervalWeekday
-    if (param == 'backupIntervalWeekday'):
-        try:
-            lst = json.loads(value)
-            if len(lst) == 7 and all(isinstance(x, bool) for x in lst):
-                oppleoConfig.backupIntervalWeekday = json.dumps(lst, default=str)
-                return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
-        except Exception as e:
-            pass
-        return jsonify({ 'status': HTTP_CODE_400_BAD_REQUEST, 'param': param, 'value': value }), HTTP_CODE_400_BAD_REQUEST
-
-    # backupIntervalWeekday
-    if (param == 'backupIntervalCalday'):
-        try:
-            lst = json.loads(value)
-            if len(lst) == 32:
-                # List is 1 offset, make 0 offset by popping the first entry
-                lst.pop(0)
-            if len(lst) == 31 and all(isinstance(x, bool) for x in lst):
-                oppleoConfig.backupIntervalCalday = json.dumps(lst, default=str)
-                return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
-        except Exception as e:
-            pass
-        return jsonify({ 'status': HTTP_CODE_400_BAD_REQUEST, 'param': param, 'value': value }), HTTP_CODE_400_BAD_REQUEST
-
-    # backupTimeOfDay
-    validation = r'^([01]\d|2[0-3]):?([0-5]\d)$'
-    if (param == 'backupTimeOfDay') and isinstance(value, str) and re.match(validation, value):
-        oppleoConfig.backupTimeOfDay = time(hour=int(value[0:2]), minute=int(value[3:5]), second=0, microsecond=0)
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
-
-    # backupLocalHistory
-    validation = r"^(0?[1-9]|[1-9][0-9])$"
-    if (param == 'backupLocalHistory') and isinstance(value, str) and re.match(validation, value):
-        try:
-            value = int(value)
-        except ValueError as e:
-            # Conditions not met
-            return jsonify({ 'status': HTTP_CODE_404_NOT_FOUND, 'param': param, 'reason': 'No valid integer value' }), HTTP_CODE_404_NOT_FOUND
-        oppleoConfig.backupLocalHistory = value
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
-
     # osBackupEnabled
     if (param == 'osBackupEnabled'):
         enableOsBackup = True if value.lower() in ['true', '1', 't', 'y', 'yes'] else False
@@ -2698,17 +2723,6 @@ def update_settings(param=None, value=None):
         oppleoConfig.osBackupType = value
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value }), HTTP_CODE_200_OK
 
-    # osBackupHistory
-    validation = r"^(0?[1-9]|[1-9][0-9])$"
-    if (param == 'osBackupHistory') and isinstance(value, str) and re.match(validation, value):
-        try:
-            value = int(value)
-        except ValueError as e:
-            # Conditions not met
-            return jsonify({ 'status': HTTP_CODE_404_NOT_FOUND, 'param': param, 'reason': 'No valid integer value' })
-        oppleoConfig.osBackupHistory = value
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': value })
-
     # smbBackupSettings
     if (param == 'smbBackupSettings'):
         try:
@@ -2760,17 +2774,7 @@ def update_settings(param=None, value=None):
     # vehicleDataOnDashboard
     if (param == 'vehicleDataOnDashboard'):
         oppleoConfig.vehicleDataOnDashboard = True if value.lower() in ['true', '1', 't', 'y', 'yes'] else False
-        if not oppleoConfig.vehicleDataOnDashboard:
-            # Announce switching off
-            OutboundEvent.triggerEvent(
-                event='vehicle_charge_status_stopped', 
-                id=oppleoConfig.chargerID,
-                namespace='/charge_session',
-                public=False
-                )
-        else:
-            # Enabling, also request update now
-            oppleoConfig.vcsmThread.requestChargeStatusUpdate()
+        syncVehicleDataOnDashboard()
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': oppleoConfig.vehicleDataOnDashboard })
 
     # wakeupVehicleOnDataRequest
@@ -2778,17 +2782,64 @@ def update_settings(param=None, value=None):
         oppleoConfig.wakeupVehicleOnDataRequest = True if value.lower() in ['true', '1', 't', 'y', 'yes'] else False
         return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': oppleoConfig.wakeupVehicleOnDataRequest })
 
-    # webauthnExpectedOrigin
-    validation = r"^([a-zA-Z0-9]|[\s.:,;|])*$"
-    if (param == 'webauthnExpectedOrigin') and isinstance(value, str) and re.match(validation, value):
-        oppleoConfig.webauthnExpectedOrigin = value
-        return jsonify({ 'status': HTTP_CODE_200_OK, 'param': param, 'value': oppleoConfig.webauthnExpectedOrigin })
-
     # No parameter found or conditions not met
     return jsonify({ 'status': HTTP_CODE_404_NOT_FOUND, 'param': param, 'reason': 'Not found' }), HTTP_CODE_404_NOT_FOUND
 
 
 
+# Always returns json
+# Bulk variant of /update_settings/<param>/<value> for the charger config settings. Body is a json object (or form) of 
+# param: value pairs. All are validated together and saved in one transaction, either all or none are applied.
+@flaskRoutes.route("/update_settings_bulk", strict_slashes=False, methods=["POST"])
+@authenticated_resource  # CSRF Token is valid
+def update_settings_bulk():
+    global oppleoConfig
+
+    values = request.get_json(silent=True)
+    if values is None:
+        values = request.form.to_dict()
+        # Not a setting
+        values.pop('csrf_token', None)
+    if not isinstance(values, dict) or len(values) == 0:
+        return jsonify({ 'status': HTTP_CODE_400_BAD_REQUEST, 'reason': 'No settings' }), HTTP_CODE_400_BAD_REQUEST
+
+    # With an open charge session, there params are not allowed to change
+    if ('chargerTariff' in values and
+        OpenChargeSessionRegistry().has_open_session(oppleoConfig.chargerID)):
+        return jsonify({ 'status': HTTP_CODE_409_CONFLICT, 'param': 'chargerTariff', 'reason': 'Er is een laadsessie actief.' }), HTTP_CODE_409_CONFLICT
+    # Same validation as the single parameter updates
+    for param in values.keys():
+        if param in settingValidators:
+            try:
+                values[param] = settingValidators[param](values[param])
+            except (TypeError, ValueError) as e:
+                return jsonify({ 'status': HTTP_CODE_400_BAD_REQUEST, 'param': param, 'reason': 'Invalid value' }), HTTP_CODE_400_BAD_REQUEST
+    # Only enable if valid settings
+    if ('osBackupEnabled' in values and 
+        ChargerConfigModel.coerceValue('os_backup_enabled', values['osBackupEnabled']) and
+        not BackupUtil().validOffsiteBackup()):
+        return jsonify({ 'status': HTTP_CODE_405_METHOD_NOT_ALLOWED, 'param': 'osBackupEnabled', 'reason': 'No valid offsite backup settings' }), HTTP_CODE_405_METHOD_NOT_ALLOWED
+
+    backupUtil = BackupUtil()
+    # Make sure the thread running and the config settings are in sync
+    with backupUtil.lock:
+        try:
+            changed = oppleoConfig.update(values)
+        except (KeyError, TypeError, ValueError) as e:
+            flaskRoutesLogger.warning('update_settings_bulk() - rejected: {}'.format(str(e)))
+            return jsonify({ 'status': HTTP_CODE_400_BAD_REQUEST, 'reason': str(e) }), HTTP_CODE_400_BAD_REQUEST
+        if 'backupEnabled' in changed:
+            syncBackupMonitorThread()
+
+    if 'offpeakEnabled' in changed or 'allowPeakOnePeriod' in changed:
+        announceOffPeakStatus()
+    if 'vehicleDataOnDashboard' in changed:
+        syncVehicleDataOnDashboard()
+
+    return jsonify({ 'status': HTTP_CODE_200_OK, 'changed': changed }), HTTP_CODE_200_OK
+
+
+
 # Always returns json
 @flaskRoutes.route("/backup/<path:cmd>", defaults={'data': None}, strict_slashes=False, methods=["GET"])
 @flaskRoutes.route("/backup/<path:cmd>/<path:data>", methods=["GET"])
@@ -3551,7 +3602,7 @@ def requestOdometerUpdate():
 
     flaskRoutesLogger.debug('/request_odometer_update/')
 
-    chargeSession = ChargeSessionModel.getOpenChargeSession(device=oppleoConfig.chargerID)
+    chargeSession = OpenChargeSessionRegistry().get(oppleoConfig.chargerID)
     if chargeSession is None:
         return jsonify({
             'status': HTTP_CODE_400_BAD_REQUEST,
@@ -3753,7 +3804,26 @@ def mqttHistory(action:str=None):
         # Start the process
         oppleoConfig.mqttshThread.mode = MqttSendHistoryThreadMode.MODE_TWO
 
-        result = oppleoConfig.mqttshThread.start()
+        # Optional filters, ISO 8601 timestamps and a comma separated list of energy device ids
+        try:
+            since = request.values.get('since', default=None, type=str)
+            until = request.values.get('until', default=None, type=str)
+            since_ts = datetime.fromisoformat(since) if since else None
+            until_ts = datetime.fromisoformat(until) if until else None
+        except ValueError:
+            return jsonify({
+                'status'    : HTTP_CODE_400_BAD_REQUEST,
+                'action'    : action,
+                'message'   : 'Invalid since or until timestamp',
+                'details'   : oppleoConfig.mqttshThread.status
+                })
+        devices = request.values.get('devices', default=None, type=str)
+        energy_device_ids = [ device.strip() for device in devices.split(',') if device.strip() != '' ] if devices else None
+        resume = request.values.get('restart', default='false', type=str).lower() not in ['true', 't', '1']
+        compact = request.values.get('compact', default='false', type=str).lower() in ['true', 't', '1']
+
+        result = oppleoConfig.mqttshThread.start(since_ts=since_ts, until_ts=until_ts,
+                                                 energy_device_ids=energy_device_ids, resume=resume, compact=compact)
         return jsonify({ 
             'status'    : HTTP_CODE_200_OK if result["success"] else HTTP_CODE_409_CONFLICT,
             'action'    : action,
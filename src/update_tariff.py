@@ -4,7 +4,9 @@
 # - optional energy_device_id
 # - write accounting log file [tariff_update_date_charger.log]
 
+import argparse
 import os
+import sys
 from datetime import datetime
 
 from nl.oppleo.config.OppleoSystemConfig import oppleoSystemConfig
@@ -20,6 +22,111 @@ auditLogFile = open(auditLogFilename, "a")
 print("Oppleo Tariff update utility")
 auditLogFile.write("Oppleo Tariff update utility - {}\n".format(timeStr))
 
+"""
+    Without arguments the utility asks for the tariff and the selection. With --tariff the selected sessions are
+    re-priced in one UPDATE, without questions:
+        python update_tariff.py --tariff 0.25 --since 2024-01-01 --until 2025-01-01 --rfid 123456789012 --dry-run
+    With --time-of-use the selected sessions are priced again from their measurements and the tariff_schedule:
+        python update_tariff.py --time-of-use --since 2024-01-01 --dry-run
+"""
+parser = argparse.ArgumentParser(description='Re-price charge sessions')
+parser.add_argument('--tariff', type=float, help='new tariff (€/kWh), selects the non-interactive mode')
+parser.add_argument('--time-of-use', action='store_true', help='price the selection with the tariff schedule')
+parser.add_argument('--from-id', type=int, help='first charge session id')
+parser.add_argument('--to-id', type=int, help='charge session id to stop at (excluded)')
+parser.add_argument('--since', type=datetime.fromisoformat, help='sessions ended at or after (yyyy-mm-dd[ hh:mm])')
+parser.add_argument('--until', type=datetime.fromisoformat, help='sessions ended before (yyyy-mm-dd[ hh:mm])')
+parser.add_argument('--rfid', help='only sessions of this RFID')
+parser.add_argument('--device', help='only sessions of this energy device')
+parser.add_argument('--dry-run', action='store_true', help='report the totals, change nothing')
+args = parser.parse_args()
+
+
+def bulkUpdate(args):
+    if round(args.tariff, 2) != args.tariff:
+        parser.error('provide a maximum of 2 decimals')
+    selection = "ids [{}, {}), ended [{}, {}), RFID {}, device {}".format(
+                    args.from_id or '-', args.to_id or '-', args.since or '-', args.until or '-',
+                    args.rfid or 'all', args.device or 'all')
+    auditLogFile.write("{} Bulk update{} to tariff €{:.2f} - {}\n".format(
+            datetime.now().strftime("%d-%m-%Y %H:%M.%S"), " (dry run)" if args.dry_run else "", args.tariff, selection))
+
+    def audit(rows):
+        # Written before the update is committed, a failing write rolls the update back
+        now = datetime.now().strftime("%d-%m-%Y %H:%M.%S")
+        for id, rfid, total_energy, old_tariff, old_price, new_price in rows:
+            auditLogFile.write("{} Charge session ID {:5} RFID {} {:4.1f}kWh - changed tariff from €{:3.2f} to €{:3.2f}, and price from €{:5.2f} to €{:5.2f}.\n".format(
+                    now, id, rfid, total_energy or 0, old_tariff or 0, args.tariff, old_price or 0, new_price or 0))
+        auditLogFile.flush()
+        os.fsync(auditLogFile.fileno())
+
+    try:
+        totals = ChargeSessionModel.retariff(
+                    tariff=args.tariff, startId=args.from_id, toId=args.to_id, from_ts=args.since, to_ts=args.until,
+                    rfid=args.rfid, energy_device_id=args.device, dry_run=args.dry_run, audit=audit)
+    except Exception as e:
+        auditLogFile.write("{} Bulk update failed, nothing changed - {}\n".format(datetime.now().strftime("%d-%m-%Y %H:%M.%S"), str(e)))
+        print(" update failed, nothing changed ({})".format(str(e)))
+        return
+    summary = "{} {} charge sessions ({:.1f}kWh), total price from €{:.2f} to €{:.2f} ({}€{:.2f})".format(
+                    "Would update" if args.dry_run else "Updated",
+                    totals['sessions'], totals['energy'], totals['old_price'], totals['new_price'],
+                    "+" if totals['new_price'] >= totals['old_price'] else "-", abs(totals['new_price'] - totals['old_price']))
+    print(" " + summary)
+    auditLogFile.write("{} {}.\n".format(datetime.now().strftime("%d-%m-%Y %H:%M.%S"), summary))
+
+
+def timeOfUseUpdate(args):
+    from nl.oppleo.services.TimeOfUseTariff import TimeOfUseTariff
+    timeOfUseTariff = TimeOfUseTariff()
+    if not timeOfUseTariff.enabled():
+        print(" no tariff schedule (tariff_schedule table), nothing to do.")
+        return
+    sessions = ChargeSessionModel.get_sessions_from_id_to_id(startId=args.from_id, toId=args.to_id,
+                                                             rfid=args.rfid, energy_device_id=args.device) or []
+    sessions = [ session for session in sessions
+                    if session.end_time is not None and
+                       (args.since is None or session.end_time >= args.since) and
+                       (args.until is None or session.end_time < args.until) ]
+    auditLogFile.write("{} Time-of-use update{} of {} selected charge sessions\n".format(
+            datetime.now().strftime("%d-%m-%Y %H:%M.%S"), " (dry run)" if args.dry_run else "", len(sessions)))
+    updates = []
+    oldTotal = newTotal = 0
+    for session in sessions:
+        price = timeOfUseTariff.recompute(session)
+        oldTotal += session.total_price or 0
+        newTotal += price
+        if price != session.total_price:
+            updates.append((session.id, { 'total_price': price }))
+            auditLogFile.write("{} Charge session ID {:5} RFID {} {:4.1f}kWh - time-of-use price from €{:5.2f} to €{:5.2f}.\n".format(
+                    datetime.now().strftime("%d-%m-%Y %H:%M.%S"), session.id, session.rfid, session.total_energy or 0,
+                    session.total_price or 0, price))
+    auditLogFile.flush()
+    if not args.dry_run:
+        try:
+            ChargeSessionModel.update_columns_many(updates)
+        except Exception as e:
+            auditLogFile.write("{} Time-of-use update failed, nothing changed - {}\n".format(datetime.now().strftime("%d-%m-%Y %H:%M.%S"), str(e)))
+            print(" update failed, nothing changed ({})".format(str(e)))
+            return
+    summary = "{} {} of {} charge sessions, total price from €{:.2f} to €{:.2f}".format(
+                    "Would update" if args.dry_run else "Updated", len(updates), len(sessions), oldTotal, newTotal)
+    print(" " + summary)
+    auditLogFile.write("{} {}.\n".format(datetime.now().strftime("%d-%m-%Y %H:%M.%S"), summary))
+
+
+if args.time_of_use:
+    timeOfUseUpdate(args)
+    auditLogFile.close()
+    print('Auditlog created ({})'.format(auditLogFilename))
+    sys.exit(0)
+
+if args.tariff is not None:
+    bulkUpdate(args)
+    auditLogFile.close()
+    print('Auditlog created ({})'.format(auditLogFilename))
+    sys.exit(0)
+
 def RepresentsInt(s):
     try: 
         int(s)